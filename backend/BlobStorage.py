@@ -0,0 +1,89 @@
+# Cloud Storage
+from azure.core.exceptions import ResourceExistsError
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+# Asynchronous
+import asyncio
+# OS Handling
+import os
+# logging
+import logging
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Connection string of the local Azurite emulator, its account and key are public and the same in every installation
+AZURITE_CONNECTION_STRING: str = (
+    'DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;'
+    'AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;'
+    'BlobEndpoint=http://{host}/devstoreaccount1;'
+)
+
+# Use the Azurite emulator instead of the storage account, for development and offline benchmarks
+AZURE_STORAGE_EMULATOR: bool = os.getenv('AZURE_STORAGE_EMULATOR', 'false').lower() == 'true'
+AZURITE_HOST: str = os.getenv('AZURITE_HOST', '127.0.0.1:10000')
+# Blob operations running at the same time in this process
+BLOB_MAX_CONCURRENCY: int = int(os.getenv('BLOB_MAX_CONCURRENCY', 8))
+# Blobs larger than this are uploaded in blocks of this size
+BLOB_CHUNK_SIZE: int = int(os.getenv('BLOB_CHUNK_SIZE', 4 * 1024 * 1024))
+# Blocks of a single blob uploaded in parallel
+BLOB_UPLOAD_CONCURRENCY: int = int(os.getenv('BLOB_UPLOAD_CONCURRENCY', 2))
+
+
+class BlobStorage:
+    def __init__(self, connection_string: str | None, container_name: str):
+        self.connection_string = AZURITE_CONNECTION_STRING.format(host=AZURITE_HOST) if AZURE_STORAGE_EMULATOR \
+            else connection_string
+        self.container_name = container_name
+        # Limits the operations in flight so large uploads cannot exhaust the sockets or the memory of the process
+        self.semaphore = asyncio.Semaphore(BLOB_MAX_CONCURRENCY)
+        self.service_client: BlobServiceClient | None = None
+        self.container_client: ContainerClient | None = None
+
+    async def start(self) -> None:
+        # A single client, and its HTTP session, is shared by every request
+        self.service_client = BlobServiceClient.from_connection_string(
+            self.connection_string,
+            max_single_put_size=BLOB_CHUNK_SIZE,
+            max_block_size=BLOB_CHUNK_SIZE,
+        )
+        self.container_client = self.service_client.get_container_client(self.container_name)
+
+        # The emulator starts empty
+        if AZURE_STORAGE_EMULATOR:
+            try:
+                await self.container_client.create_container()
+                logging.info(f"Created container '{self.container_name}' in the storage emulator")
+            except ResourceExistsError:
+                pass
+
+    async def close(self) -> None:
+        if self.service_client is not None:
+            await self.service_client.close()
+            self.service_client = None
+            self.container_client = None
+
+    async def upload(self, name: str, data: bytes, overwrite: bool = False) -> None:
+        """
+        Uploads a blob, in blocks of BLOB_CHUNK_SIZE when it is larger than that.
+
+        Args:
+            name (str): The name of the blob.
+            data (bytes): The content of the blob.
+            overwrite (bool): Whether to replace an existing blob with the same name.
+
+        Returns:
+            None
+
+        Raises:
+            ResourceExistsError: If the blob already exists and `overwrite` is False.
+        """
+
+        async with self.semaphore:
+            await self.container_client.upload_blob(
+                name=name, data=data, overwrite=overwrite, max_concurrency=BLOB_UPLOAD_CONCURRENCY
+            )
+
+    async def delete(self, name: str) -> None:
+        async with self.semaphore:
+            await self.container_client.delete_blob(name)
@@ -0,0 +1,323 @@
+# Database Connectivity
+from sqlalchemy import Engine, URL, create_engine, event
+# Asynchronous
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import AsyncIterator, Callable
+import threading
+# Time Handling
+import time
+# logging
+import logging
+# OS Handling
+import os
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Connection pool settings, opening a connection to Azure SQL is expensive so they are kept and checked before use
+DB_POOL_SIZE: int = int(os.getenv('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW: int = int(os.getenv('DB_MAX_OVERFLOW', 5))
+DB_POOL_TIMEOUT: float = float(os.getenv('DB_POOL_TIMEOUT', 30))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE: int = int(os.getenv('DB_POOL_RECYCLE', 1800))  # Seconds before a connection is replaced
+DB_LEAK_WARNING: float = float(os.getenv('DB_LEAK_WARNING', 30))  # Seconds a connection can be held before warning
+
+
+class PoolMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0  # Number of connections handed out by the pool
+        self.total_wait = 0.0  # Accumulated seconds spent waiting for a connection
+        self.max_wait = 0.0  # Longest wait for a connection
+        self.errors = 0  # Failed checkouts (pool timeout or connection errors)
+        self.connects = 0  # New connections opened to the database
+        self.total_connect = 0.0  # Accumulated seconds spent opening connections
+        self.max_connect = 0.0  # Slowest connection opened
+        self.leaks = 0  # Checkouts held longer than the leak warning threshold
+        self.max_held = 0.0  # Longest time a connection was held
+
+    def checkout(self, wait: float) -> None:
+        with self.lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def connect(self, elapsed: float) -> None:
+        with self.lock:
+            self.connects += 1
+            self.total_connect += elapsed
+            self.max_connect = max(self.max_connect, elapsed)
+
+    def checkin(self, held: float) -> None:
+        with self.lock:
+            self.max_held = max(self.max_held, held)
+
+    def leak(self) -> None:
+        with self.lock:
+            self.leaks += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'checkouts': self.checkouts,
+                'errors': self.errors,
+                'avg_wait_ms': (self.total_wait / self.checkouts) * 1000 if self.checkouts else 0.0,
+                'max_wait_ms': self.max_wait * 1000,
+                'connects': self.connects,
+                'avg_connect_ms': (self.total_connect / self.connects) * 1000 if self.connects else 0.0,
+                'max_connect_ms': self.max_connect * 1000,
+                'leaks': self.leaks,
+                'max_held_ms': self.max_held * 1000,
+            }
+
+
+class Database:
+    def __init__(self, engine: Engine, max_workers: int, leak_warning_seconds: float = 30.0):
+        self.engine = engine
+        # Blocking pyodbc calls run in their own sized thread pool so they never stall the event loop
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        # A connection held for longer than this is reported as a possible leak
+        self.leak_warning_seconds = leak_warning_seconds
+        self.metrics = PoolMetrics()
+        # Connections currently checked out: the time and thread that took them, and whether they were reported
+        self.checked_out: dict[int, list] = {}
+        # Connections that are never returned are only found by sweeping the ones checked out
+        self.stop_sweep = threading.Event()
+        self.sweeper = threading.Thread(target=self.sweep_periodically, name='db-leak-sweep', daemon=True)
+        self.sweeper.start()
+
+        event.listen(engine, 'do_connect', self.on_do_connect)
+        event.listen(engine, 'connect', self.on_connect)
+        event.listen(engine, 'checkout', self.on_checkout)
+        event.listen(engine, 'checkin', self.on_checkin)
+
+    @classmethod
+    def from_env(cls) -> 'Database':
+        """
+        Creates the Azure SQL engine and its database wrapper from the DB_* environment variables.
+
+        Used by the server and by the command line scripts, which must not import the whole API to get a connection.
+
+        Returns:
+            Database: The database with its own connection pool and thread pool.
+        """
+
+        driver = '{ODBC Driver 18 for SQL Server}'
+        odbc_conn = (f'DRIVER={driver};SERVER={os.getenv("DB_SERVER")};PORT=1433;'
+                     f'DATABASE={os.getenv("DB_SERVER_DATABASE_NAME")};'
+                     f'UID={os.getenv("DB_SERVER_USER")};PWD={os.getenv("DB_SERVER_PASS")}')
+        connection_url = URL.create(
+            drivername="mssql+pyodbc",
+            query={
+                "odbc_connect": odbc_conn
+            }
+        )
+        engine = create_engine(
+            connection_url,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=True,
+        )
+        # Threads for blocking database calls, kept within the size of the engine's connection pool
+        return cls(engine, max_workers=int(os.getenv('DB_THREADS', DB_POOL_SIZE + DB_MAX_OVERFLOW)),
+                   leak_warning_seconds=DB_LEAK_WARNING)
+
+    ''' POOL EVENTS '''
+
+    @staticmethod
+    def on_do_connect(_, connection_record, *__) -> None:
+        # Runs right before a new DBAPI connection is opened
+        connection_record.info['connect_start'] = time.perf_counter()
+
+    def on_connect(self, _, connection_record) -> None:
+        start = connection_record.info.pop('connect_start', None)
+        if start is not None:
+            self.metrics.connect(time.perf_counter() - start)
+
+    def on_checkout(self, _, connection_record, __) -> None:
+        self.checked_out[id(connection_record)] = [time.perf_counter(), threading.current_thread().name, False]
+
+    def on_checkin(self, _, connection_record) -> None:
+        checkout = self.checked_out.pop(id(connection_record), None)
+        if checkout is None:
+            return
+        held = time.perf_counter() - checkout[0]
+        if held > self.leak_warning_seconds and not checkout[2]:
+            logging.warning(f'Database connection taken by {checkout[1]} was held for {held:.1f}s, it may be leaking')
+            self.metrics.leak()
+        self.metrics.checkin(held)
+
+    def sweep_leaks(self) -> None:
+        # Reports each checkout once, as soon as it has been held past the threshold
+        now = time.perf_counter()
+        for checkout in list(self.checked_out.values()):
+            if not checkout[2] and now - checkout[0] > self.leak_warning_seconds:
+                checkout[2] = True
+                logging.warning(f'Database connection taken by {checkout[1]} has been held for '
+                                f'{now - checkout[0]:.1f}s and not returned, it may be leaking')
+                self.metrics.leak()
+
+    def sweep_periodically(self) -> None:
+        while not self.stop_sweep.wait(max(self.leak_warning_seconds / 2, 1)):
+            self.sweep_leaks()
+
+    def pool_metrics(self) -> dict:
+        """
+        Returns the state of the connection pool along with its accumulated metrics.
+
+        Returns:
+            dict: Pool size and checked out connections, wait and connect latencies, and the checkouts
+                currently held for longer than the leak warning threshold.
+        """
+
+        now = time.perf_counter()
+        held = [
+            {'thread': thread, 'held_s': round(now - start, 1)}
+            for start, thread, _ in list(self.checked_out.values())
+            if now - start > self.leak_warning_seconds
+        ]
+        pool = self.engine.pool
+        return {
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': pool.overflow(),
+            **self.metrics.snapshot(),
+            'possible_leaks': held,
+        }
+
+    ''' QUERIES '''
+
+    @staticmethod
+    def rows_to_dicts(cursor, rows: list) -> list[dict]:
+        """
+        Converts the rows fetched by a cursor into a list of dictionaries keyed by column name.
+
+        Args:
+            cursor: The cursor that executed the query.
+            rows (list): The rows fetched from the cursor.
+
+        Returns:
+            list[dict]: One dictionary per row.
+        """
+
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def _checkout(self):
+        start = time.perf_counter()
+        try:
+            conn = self.engine.raw_connection()
+        except Exception:
+            self.metrics.errors += 1
+            raise
+        self.metrics.checkout(time.perf_counter() - start)
+        return conn
+
+    def _run(self, work: Callable, *args) -> any:
+        # Connection and cursor lifecycle, the transaction is rolled back if the work fails
+        conn = self._checkout()
+        cursor = None
+        try:
+            cursor = conn.cursor()
+            return work(conn, cursor, *args)
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if cursor:
+                cursor.close()
+            conn.close()
+
+    async def run(self, work: Callable, *args) -> any:
+        """
+        Runs a unit of work with its own connection and cursor in the database thread pool.
+
+        The work receives the connection and the cursor as its first two arguments and is in charge
+        of committing. Both are closed once it returns, and any uncommitted change is rolled back if it fails.
+
+        Args:
+            work (Callable): A blocking function with the signature `work(conn, cursor, *args)`.
+            *args: Extra arguments for the work.
+
+        Returns:
+            any: The value returned by the work.
+        """
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(self._run, work, *args))
+
+    def _open_cursor(self, query: str, params: tuple) -> tuple:
+        conn = self._checkout()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(query, params)
+            return conn, cursor
+        except Exception:
+            conn.close()
+            raise
+
+    @staticmethod
+    def _close_cursor(conn, cursor) -> None:
+        cursor.close()
+        conn.close()
+
+    async def stream(self, query: str, params: tuple = (), batch_size: int = 500) -> AsyncIterator[list[dict]]:
+        """
+        Runs a query and yields its rows in batches as they come off the cursor.
+
+        The connection is held until the iteration ends, each batch is fetched with `fetchmany` in the
+        database thread pool, so the whole result is never loaded in memory.
+
+        Args:
+            query (str): The query to run.
+            params (tuple): The parameters of the query.
+            batch_size (int): The number of rows fetched at once.
+
+        Yields:
+            list[dict]: The next batch of rows as dictionaries.
+        """
+
+        loop = asyncio.get_running_loop()
+        conn, cursor = await loop.run_in_executor(self.executor, self._open_cursor, query, params)
+        try:
+            columns = [column[0] for column in cursor.description]
+            while rows := await loop.run_in_executor(self.executor, cursor.fetchmany, batch_size):
+                yield [dict(zip(columns, row)) for row in rows]
+        finally:
+            await loop.run_in_executor(self.executor, self._close_cursor, conn, cursor)
+
+    async def fetch_all(self, query: str, params: tuple = ()) -> list[dict]:
+        # Rows of a query as a list of dictionaries
+        def work(_, cursor):
+            cursor.execute(query, params)
+            return self.rows_to_dicts(cursor, cursor.fetchall())
+
+        return await self.run(work)
+
+    async def fetch_one(self, query: str, params: tuple = ()) -> any:
+        # First row of a query, None if there are no rows
+        def work(_, cursor):
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+        return await self.run(work)
+
+    async def execute(self, query: str, params: tuple = ()) -> int:
+        # Executes and commits a statement, returning the number of affected rows
+        def work(conn, cursor):
+            cursor.execute(query, params)
+            rowcount = cursor.rowcount
+            conn.commit()
+            return rowcount
+
+        return await self.run(work)
+
+    def close(self) -> None:
+        self.stop_sweep.set()
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()
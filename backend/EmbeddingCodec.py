@@ -0,0 +1,72 @@
+# Numeric Processing
+import numpy as np
+# OS Handling
+import os
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Storage format of the face encodings in the roster store and the encodings cache:
+# float64 as computed, float16 (a quarter of the size) or int8 with a scale per vector (an eighth of the size)
+FORMATS: tuple = ('float64', 'float16', 'int8')
+EMBEDDING_FORMAT: str = os.getenv('EMBEDDING_FORMAT', 'float64').lower()
+
+if EMBEDDING_FORMAT not in FORMATS:
+    raise ValueError(f'EMBEDDING_FORMAT must be one of {", ".join(FORMATS)}, got {EMBEDDING_FORMAT}')
+
+
+def encode(vectors: np.ndarray, embedding_format: str = EMBEDDING_FORMAT) -> tuple[np.ndarray, np.ndarray | None]:
+    """
+    Converts face encodings to a storage format.
+
+    Args:
+        vectors (np.ndarray): The encodings, one per row.
+        embedding_format (str): One of FORMATS.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray | None]: The stored values and, for int8, the scale of each row.
+    """
+
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float64))
+    if embedding_format == 'float16':
+        return vectors.astype(np.float16), None
+    if embedding_format == 'int8':
+        # Symmetric quantization, the largest component of each row maps to 127
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return vectors, None
+
+
+def decode(codes: np.ndarray, scales: np.ndarray | None = None) -> np.ndarray:
+    # Back to float for the distance computations, the result is not stored
+    if scales is not None:
+        return codes.astype(np.float32) * scales[:, None]
+    return codes.astype(np.float64, copy=False)
+
+
+def distances(codes: np.ndarray, scales: np.ndarray | None, encoding: np.ndarray) -> np.ndarray:
+    """
+    Euclidean distance from an encoding to every stored encoding, like face_recognition.face_distance.
+
+    Args:
+        codes (np.ndarray): The stored values, one row per encoding.
+        scales (np.ndarray | None): The scale of each row for int8, None otherwise.
+        encoding (np.ndarray): The encoding to compare.
+
+    Returns:
+        np.ndarray: The distance to each row.
+    """
+
+    if len(codes) == 0:
+        return np.empty(0)
+    return np.linalg.norm(decode(codes, scales) - encoding, axis=1)
+
+
+def nbytes(embedding_format: str, dimensions: int = 128) -> int:
+    # Bytes each encoding takes in a format
+    if embedding_format == 'int8':
+        return dimensions + 4
+    return dimensions * np.dtype(embedding_format).itemsize
@@ -0,0 +1,70 @@
+# Redis
+import RedisPool
+# Encoding
+import base64
+# Numeric Processing
+import numpy as np
+import EmbeddingCodec
+
+
+class EncodingCache:
+    # Hash with the face encoding of each student, keyed by StudentID
+    KEY: str = 'face:encodings'
+
+    def __init__(self):
+        self.redis_client = RedisPool.get_async_client()
+
+    @staticmethod
+    def pack(encoding: np.ndarray) -> str:
+        # The pool decodes replies as text, so the raw bytes are stored as base64, prefixed by their format
+        codes, scales = EmbeddingCodec.encode(encoding)
+        data = codes.tobytes() + (scales.tobytes() if scales is not None else b'')
+        return f'{EmbeddingCodec.EMBEDDING_FORMAT}:{base64.b64encode(data).decode("ascii")}'
+
+    @staticmethod
+    def unpack(value: str) -> np.ndarray:
+        # Entries written in another format, or before formats were prefixed (float64), are still readable
+        embedding_format, _, data = value.rpartition(':')
+        data = base64.b64decode(data)
+        if embedding_format == 'int8':
+            codes = np.frombuffer(data[:-4], dtype=np.int8).reshape(1, -1)
+            scales = np.frombuffer(data[-4:], dtype=np.float32)
+            return EmbeddingCodec.decode(codes, scales)[0].astype(np.float64)
+        return np.frombuffer(data, dtype=embedding_format or 'float64').astype(np.float64)
+
+    async def get_many(self, student_ids: list) -> dict:
+        """
+        Retrieves the cached face encodings of many students at once.
+
+        Args:
+            student_ids (list): The IDs of the students.
+
+        Returns:
+            dict: The encoding of each student that has one cached, keyed by the given IDs.
+        """
+
+        if not student_ids:
+            return {}
+        values = await self.redis_client.hmget(self.KEY, [str(student_id) for student_id in student_ids])
+        return {student_id: self.unpack(value) for student_id, value in zip(student_ids, values) if value}
+
+    async def set_many(self, encodings: dict) -> None:
+        """
+        Caches the face encodings of many students.
+
+        Args:
+            encodings (dict): The encoding of each student keyed by StudentID.
+
+        Returns:
+            None
+        """
+
+        if encodings:
+            await self.redis_client.hset(self.KEY, mapping={
+                str(student_id): self.pack(encoding) for student_id, encoding in encodings.items()
+            })
+
+    async def delete(self, *student_ids) -> None:
+        # Drops the encodings of students whose photo changed or who were deleted
+        if student_ids:
+            await self.redis_client.hdel(self.KEY, *[str(student_id) for student_id in student_ids])
@@ -0,0 +1,388 @@
+# Redis
+import RedisPool
+from redis.exceptions import ResponseError
+# Numeric Processing
+import numpy as np
+# Asynchronous
+import asyncio
+import threading
+# OS Handling
+import os
+import socket
+# Serialization
+import json
+import pickle
+# logging
+import logging
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# File the gallery is persisted to, shared by the server and the assistance workers
+FACE_GALLERY_PATH: str = os.getenv('FACE_GALLERY_PATH', 'models/face_gallery.bin')
+# Identities the index has room for before it grows
+FACE_GALLERY_MAX_ELEMENTS: int = int(os.getenv('FACE_GALLERY_MAX_ELEMENTS', 100000))
+# Candidates explored per query, higher is more accurate and slower
+FACE_GALLERY_EF: int = int(os.getenv('FACE_GALLERY_EF', 64))
+# Seconds between saves of the changes to disk, and between refreshes of the workers that do not save
+FACE_GALLERY_SAVE_INTERVAL: float = float(os.getenv('FACE_GALLERY_SAVE_INTERVAL', 30))
+# Node this process runs on, each node keeps its own gallery file written by one of its workers
+FACE_GALLERY_NODE_ID: str = os.getenv('NODE_ID', socket.gethostname())
+# This worker, among every uvicorn worker of every node
+FACE_GALLERY_WORKER_ID: str = f'{FACE_GALLERY_NODE_ID}:{os.getpid()}'
+# Changes kept in the stream for the nodes that are behind, a node away for longer rebuilds its gallery
+FACE_GALLERY_CHANGES_MAXLEN: int = int(os.getenv('FACE_GALLERY_CHANGES_MAXLEN', 100000))
+
+
+class FaceGallery:
+    DIMENSIONS: int = 128
+    # Same tolerance face_recognition.compare_faces uses by default
+    TOLERANCE: float = 0.6
+
+    # Gallery of the current process, see `shared`
+    _shared: 'FaceGallery | None' = None
+
+    # Prefix of the key of the worker that writes the file of each node, held while it keeps renewing it
+    WRITER_PREFIX: str = 'face_gallery:writer:'
+    # Stream with the changes made by every worker, read by the writer of each node through its own group
+    CHANGES_KEY: str = 'face_gallery:changes'
+    # Prefix of the consumer group of each node
+    GROUP_PREFIX: str = 'node:'
+
+    # Renews the writer key if it is held by this worker, or takes it if no worker holds it
+    # KEYS[1]: writer key, ARGV: worker id, ttl ms
+    CLAIM_WRITER_SCRIPT: str = '''
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            redis.call('PEXPIRE', KEYS[1], ARGV[2])
+            return 1
+        end
+        if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+            return 1
+        end
+        return 0
+    '''
+
+    # Gives the writer key up only if it is still held by this worker
+    # KEYS[1]: writer key, ARGV: worker id
+    RELEASE_WRITER_SCRIPT: str = '''
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    '''
+
+    def __init__(self, path: str = FACE_GALLERY_PATH, max_elements: int = FACE_GALLERY_MAX_ELEMENTS):
+        # Without hnswlib the gallery is searched exhaustively with numpy and saved in its own format
+        self.path = path if hnswlib is not None else f'{path}.npz'
+        if hnswlib is None:
+            logging.warning('hnswlib is not installed, the face gallery is searched exhaustively with numpy, '
+                            'lookups slow down linearly with the number of students (pip3 install hnswlib)')
+        self.max_elements = max_elements
+        self.lock = threading.Lock()
+        # Only one save writes the file at a time, lookups only wait for the in-memory copy
+        self.save_lock = threading.Lock()
+        # Whether there are changes that have not been saved yet
+        self.dirty = False
+        # Modification time of the file the gallery was loaded from or saved to
+        self.mtime: float | None = None
+        self.index = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, self.DIMENSIONS), dtype=np.float32)
+        self.saver: asyncio.Task | None = None
+        # Set by `start`, the assistance workers and the command line scripts use the gallery without Redis
+        self.redis_client = None
+        self.worker_id = FACE_GALLERY_WORKER_ID
+        self.writer_key = f'{self.WRITER_PREFIX}{FACE_GALLERY_NODE_ID}'
+        self.group = f'{self.GROUP_PREFIX}{FACE_GALLERY_NODE_ID}'
+        self.writer = False
+        # Changes made by this worker since the last sync, as they are sent to the writer
+        self.changes: list[dict] = []
+        self.load()
+
+    @classmethod
+    def shared(cls) -> 'FaceGallery':
+        # Gallery of worker processes, loaded once and refreshed from disk before each run
+        if cls._shared is None:
+            cls._shared = cls()
+        else:
+            cls._shared.refresh()
+        return cls._shared
+
+    def _new_index(self, max_elements: int):
+        index = hnswlib.Index(space='l2', dim=self.DIMENSIONS)
+        index.init_index(max_elements=max_elements, ef_construction=200, M=16)
+        index.set_ef(FACE_GALLERY_EF)
+        return index
+
+    def load(self) -> None:
+        # Read outside the lock, lookups only wait for the new gallery to be swapped in
+        index, mtime = None, None
+        ids, vectors = np.empty(0, dtype=np.int64), np.empty((0, self.DIMENSIONS), dtype=np.float32)
+        if not os.path.exists(self.path):
+            if hnswlib is not None:
+                index = self._new_index(self.max_elements)
+        else:
+            mtime = os.path.getmtime(self.path)
+            if hnswlib is not None:
+                # Pickled, so it can be serialized in memory under the lock and written outside it
+                with open(self.path, 'rb') as file:
+                    index = pickle.load(file)
+                if index.get_max_elements() < self.max_elements:
+                    index.resize_index(self.max_elements)
+                index.set_ef(FACE_GALLERY_EF)
+            else:
+                data = np.load(self.path)
+                ids, vectors = data['ids'], data['vectors']
+
+        with self.lock:
+            self.index, self.ids, self.vectors, self.mtime = index, ids, vectors, mtime
+            self.dirty = False
+        if mtime is not None:
+            logging.info(f'Loaded face gallery from {self.path} with {len(self)} identities')
+
+    def refresh(self) -> None:
+        # Picks up the changes saved by the writer, local changes are never thrown away
+        if not self.dirty and os.path.exists(self.path) and os.path.getmtime(self.path) != self.mtime:
+            self.load()
+
+    def __len__(self) -> int:
+        # Identities removed from the hnswlib index are only marked as deleted and still counted
+        return self.index.get_current_count() if self.index is not None else len(self.ids)
+
+    def add(self, encodings: dict) -> None:
+        """
+        Adds or replaces the face encodings of many students.
+
+        Args:
+            encodings (dict): The encoding of each student keyed by StudentID.
+
+        Returns:
+            None
+        """
+
+        if not encodings:
+            return
+        ids = np.array([int(student_id) for student_id in encodings], dtype=np.int64)
+        vectors = np.array(list(encodings.values()), dtype=np.float32)
+        self._add(ids, vectors)
+        if self.redis_client is not None:
+            with self.lock:
+                self.changes.append({'add': dict(zip(ids.tolist(), vectors.tolist()))})
+
+    def _add(self, ids: np.ndarray, vectors: np.ndarray) -> None:
+        with self.lock:
+            if self.index is not None:
+                # Grow ahead of time, hnswlib cannot add past its capacity
+                needed = self.index.get_current_count() + len(ids)
+                if needed > self.index.get_max_elements():
+                    self.index.resize_index(max(needed, self.index.get_max_elements() * 2))
+                for student_id in ids:
+                    try:
+                        self.index.unmark_deleted(int(student_id))
+                    except RuntimeError:
+                        pass  # Not in the index or not deleted
+                # Existing labels are updated in place
+                self.index.add_items(vectors, ids)
+            else:
+                existing = np.isin(self.ids, ids)
+                self.ids = np.concatenate([self.ids[~existing], ids])
+                self.vectors = np.concatenate([self.vectors[~existing], vectors])
+            self.dirty = True
+
+    def remove(self, *student_ids) -> None:
+        student_ids = [int(student_id) for student_id in student_ids]
+        self._remove(student_ids)
+        if self.redis_client is not None:
+            with self.lock:
+                self.changes.append({'remove': student_ids})
+
+    def _remove(self, student_ids: list[int]) -> None:
+        with self.lock:
+            if self.index is not None:
+                for student_id in student_ids:
+                    try:
+                        self.index.mark_deleted(student_id)
+                    except RuntimeError:
+                        pass  # Not in the index
+            else:
+                keep = ~np.isin(self.ids, np.array(student_ids, dtype=np.int64))
+                self.ids, self.vectors = self.ids[keep], self.vectors[keep]
+            self.dirty = True
+
+    def nearest(self, encoding: np.ndarray, tolerance: float = TOLERANCE) -> tuple[int, float] | None:
+        """
+        Finds the closest student to a face encoding in the whole institution.
+
+        Args:
+            encoding (np.ndarray): The face encoding to look up.
+            tolerance (float): The maximum distance to count as a match.
+
+        Returns:
+            tuple[int, float] | None: The StudentID and distance of the closest student, or None if no student is
+                within the tolerance.
+        """
+
+        query = np.asarray(encoding, dtype=np.float32).reshape(1, self.DIMENSIONS)
+        with self.lock:
+            if self.index is not None:
+                if self.index.get_current_count() == 0:
+                    return None
+                try:
+                    labels, distances = self.index.knn_query(query, k=1)
+                except RuntimeError:
+                    return None  # Every identity was removed
+                # The l2 space reports squared distances
+                student_id, distance = int(labels[0][0]), float(np.sqrt(distances[0][0]))
+            else:
+                if len(self.ids) == 0:
+                    return None
+                distances = np.linalg.norm(self.vectors - query, axis=1)
+                best = int(np.argmin(distances))
+                student_id, distance = int(self.ids[best]), float(distances[best])
+
+        return (student_id, distance) if distance <= tolerance else None
+
+    def save(self) -> None:
+        # Copied under the lock and written outside it, lookups on the event loop never wait for the disk
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                data = pickle.dumps(self.index) if self.index is not None else None
+                if data is None:
+                    # `add` and `remove` replace the arrays instead of modifying them, keeping them is a snapshot
+                    ids, vectors = self.ids, self.vectors
+                self.dirty = False
+
+            # Written to a temporary file first, readers never load a half written gallery
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                temporary_path = f'{self.path}.tmp'
+                with open(temporary_path, 'wb') as file:
+                    if data is not None:
+                        file.write(data)
+                    else:
+                        np.savez(file, ids=ids, vectors=vectors)
+                os.replace(temporary_path, self.path)
+                self.mtime = os.path.getmtime(self.path)
+            except Exception:
+                # Saved again on the next attempt
+                with self.lock:
+                    self.dirty = True
+                raise
+
+    def _apply(self, change: dict) -> None:
+        # A change made by another worker, see `add` and `remove`
+        if 'add' in change:
+            ids = np.array([int(student_id) for student_id in change['add']], dtype=np.int64)
+            self._add(ids, np.array(list(change['add'].values()), dtype=np.float32))
+        else:
+            self._remove(change['remove'])
+
+    async def start(self) -> None:
+        self.redis_client = RedisPool.get_async_client()
+        self.claim_writer_script = self.redis_client.register_script(self.CLAIM_WRITER_SCRIPT)
+        self.release_writer_script = self.redis_client.register_script(self.RELEASE_WRITER_SCRIPT)
+        try:
+            # A new node starts from its file, built with build_face_gallery.py, and the changes made from now on
+            await self.redis_client.xgroup_create(self.CHANGES_KEY, self.group, id='$', mkstream=True)
+        except ResponseError as e:
+            # The group already exists
+            if 'BUSYGROUP' not in str(e):
+                raise
+        await self.sync()
+        self.saver = asyncio.create_task(self.save_periodically())
+
+    async def stop(self) -> None:
+        if self.saver is not None:
+            self.saver.cancel()
+            try:
+                await self.saver
+            except asyncio.CancelledError:
+                pass
+            self.saver = None
+        if self.redis_client is None:
+            return
+        await self.sync()
+        if self.writer:
+            # Another worker takes over on its next sync instead of waiting for the key to expire
+            await self.release_writer_script(keys=[self.writer_key], args=[self.worker_id])
+            self.writer = False
+
+    async def sync(self) -> None:
+        """
+        Publishes the changes of this worker to every node, then saves the gallery if this worker is the writer
+        of its node, or refreshes it from disk otherwise.
+
+        Each node has its own gallery file and only one of its workers writes it, two writers would overwrite each
+        other's changes. The writer is the worker holding the node's writer key, if it stops renewing it another
+        worker of the node takes over on its next sync.
+
+        Returns:
+            None
+        """
+
+        ttl = int(FACE_GALLERY_SAVE_INTERVAL * 3 * 1000)
+        writer = bool(await self.claim_writer_script(keys=[self.writer_key], args=[self.worker_id, ttl]))
+        if writer != self.writer:
+            logging.info(f'Worker {self.worker_id} {"is now" if writer else "is no longer"} the face gallery writer')
+        self.writer = writer
+
+        with self.lock:
+            changes, self.changes = self.changes, []
+            if not writer:
+                # Saved by the writer, this worker picks them up from the file like the assistance workers
+                self.dirty = False
+
+        sent = 0
+        try:
+            for change in changes:
+                await self.redis_client.xadd(
+                    self.CHANGES_KEY, {'worker': self.worker_id, 'change': json.dumps(change)},
+                    maxlen=FACE_GALLERY_CHANGES_MAXLEN, approximate=True)
+                sent += 1
+        except Exception:
+            # The rest are sent again on the next sync
+            with self.lock:
+                self.changes[:0] = changes[sent:]
+                self.dirty = True
+            raise
+
+        if not writer:
+            await asyncio.to_thread(self.refresh)
+            return
+
+        # Changes left unacknowledged by a previous writer of this node, then the new ones
+        _, entries, *_ = await self.redis_client.xautoclaim(
+            self.CHANGES_KEY, self.group, self.worker_id, ttl, start_id='0-0', count=100)
+        ids = []
+        while True:
+            for entry_id, fields in entries:
+                ids.append(entry_id)
+                # The changes of this worker are already in its gallery
+                if fields and fields['worker'] != self.worker_id:
+                    self._apply(json.loads(fields['change']))
+            response = await self.redis_client.xreadgroup(
+                self.group, self.worker_id, {self.CHANGES_KEY: '>'}, count=100)
+            entries = response[0][1] if response else []
+            if not entries:
+                break
+
+        # Acknowledged once saved, a writer that dies before leaves them to the next one
+        await asyncio.to_thread(self.save)
+        if ids:
+            await self.redis_client.xack(self.CHANGES_KEY, self.group, *ids)
+
+    async def save_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(FACE_GALLERY_SAVE_INTERVAL)
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.error(f'Error syncing the face gallery: {e}')
@@ -0,0 +1,86 @@
+# Asynchronous
+import asyncio
+from typing import Awaitable, Callable
+# logging
+import logging
+
+
+class FlushCoordinator:
+    def __init__(self, writer: Callable[[list[tuple]], Awaitable[None]], max_batch_rows: int, max_concurrency: int):
+        # Writes the rows of a group of flushes in a single transaction
+        self.writer = writer
+        # Maximum number of rows written in a single transaction
+        self.max_batch_rows = max_batch_rows
+        # Maximum number of transactions running at the same time
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    @staticmethod
+    def to_rows(record: dict) -> list[tuple]:
+        """
+        Converts a flush record into the rows of the session results staging table.
+
+        Args:
+            record (dict): A flush record with its idempotency key, course, date and results.
+
+        Returns:
+            list[tuple]: Rows of (student_id, course_id, date, assistance_count, participation_count, flush_key).
+        """
+
+        return [
+            (int(student_id), record['course_id'], record['date'], assistance_count, participation_count, record['flush_key'])
+            for student_id, assistance_count, participation_count in record['results']
+        ]
+
+    def group(self, records: list[dict]) -> list[list[tuple]]:
+        """
+        Groups the rows of many flush records, from any course, into as few transactions as possible.
+
+        A record is never split between two transactions, its idempotency key is applied only once
+        and must cover all of its rows.
+
+        Args:
+            records (list[dict]): The flush records to write.
+
+        Returns:
+            list[list[tuple]]: The rows of each transaction.
+        """
+
+        batches = []
+        batch = []
+        for record in records:
+            rows = self.to_rows(record)
+            if batch and len(batch) + len(rows) > self.max_batch_rows:
+                batches.append(batch)
+                batch = []
+            batch.extend(rows)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def write_batch(self, rows: list[tuple]) -> None:
+        async with self.semaphore:
+            await self.writer(rows)
+
+    async def write(self, records: list[dict]) -> None:
+        """
+        Writes a group of flush records, coalesced from all the sessions, as a few batched transactions.
+
+        Transactions run with bounded concurrency. If any of them fails the error is raised once all have
+        finished, so the whole group is retried and the idempotency keys skip the ones already committed.
+
+        Args:
+            records (list[dict]): The flush records to write.
+
+        Returns:
+            None
+        """
+
+        batches = self.group(records)
+        results = await asyncio.gather(*(self.write_batch(rows) for rows in batches), return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        courses = {record['course_id'] for record in records}
+        logging.info(f'Flushed {len(records)} sessions of {len(courses)} courses in {len(batches)} transactions')
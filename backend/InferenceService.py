@@ -0,0 +1,271 @@
+# Computer Vision
+import cv2 as cv
+import face_recognition as face_rec
+# Numeric Processing
+import numpy as np
+# Multiprocessing
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+# Asynchronous
+import asyncio
+import threading
+from itertools import count
+# OS Handling
+import os
+# logging
+import logging
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Runs pose inference and face encoding in local worker processes instead of the API process
+INFERENCE_SERVICE: bool = os.getenv('INFERENCE_SERVICE', 'false').lower() == 'true'
+# Worker processes, each one loads its own YOLO model
+INFERENCE_WORKERS: int = int(os.getenv('INFERENCE_WORKERS', 2))
+# Threads PyTorch uses in each worker, the workers scale across cores instead of fighting for them
+INFERENCE_TORCH_THREADS: int = int(os.getenv('INFERENCE_TORCH_THREADS', 1))
+# Frames each worker can have in flight
+INFERENCE_RING_SLOTS: int = int(os.getenv('INFERENCE_RING_SLOTS', 4))
+# Size of each slot, a 1080p BGR frame by default, larger frames are sent through the queue instead
+INFERENCE_SLOT_BYTES: int = int(os.getenv('INFERENCE_SLOT_BYTES', 1920 * 1080 * 3))
+# Seconds to wait for a free slot, and then for the result, before giving up
+INFERENCE_TIMEOUT: float = float(os.getenv('INFERENCE_TIMEOUT', 10))
+# Seconds between checks that the workers are alive, a dead worker is replaced
+INFERENCE_MONITOR_INTERVAL: float = float(os.getenv('INFERENCE_MONITOR_INTERVAL', 1))
+# Keypoints used by the participation detection: face, shoulders, elbows and wrists
+POSE_KEYPOINTS: int = 11
+
+
+def detect_poses(yolo_model, frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Keypoints (people x 11 x [x, y, confidence]) and boxes (people x [x_min, y_min, x_max, y_max, confidence, class])
+    results = yolo_model(frame, verbose=False)[0]
+    poses = results.keypoints.data[:, 0:POSE_KEYPOINTS, :].cpu().numpy().astype(np.float32)
+    boxes = results.boxes.data.cpu().numpy().astype(np.float32)
+    return poses, boxes
+
+
+def encode_face(cropped_frame: np.ndarray, face_center: tuple) -> np.ndarray | None:
+    """
+    Encodes the face of a person within a cropped frame.
+
+    Args:
+        cropped_frame (np.ndarray): The BGR frame cropped to the person's bounding box.
+        face_center (tuple): The center of the person's face keypoints, relative to the crop.
+
+    Returns:
+        np.ndarray | None: The encoding of the face that contains the center, or None if there is no such face.
+    """
+
+    # Convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
+    rgb_frame = cv.cvtColor(cropped_frame, cv.COLOR_BGR2RGB)
+    for top, right, bottom, left in face_rec.face_locations(rgb_frame):
+        # Check if we detected the correct face
+        if left <= face_center[0] <= right and top <= face_center[1] <= bottom:
+            return face_rec.face_encodings(rgb_frame, [(top, right, bottom, left)])[0]
+    return None
+
+
+def _serve(shm_name: str, requests: mp.Queue, results: mp.Queue) -> None:
+    # Worker process loop, the frames are read from this worker's ring and only the small results go back
+    import torch
+    from ultralytics import YOLO
+
+    torch.set_num_threads(INFERENCE_TORCH_THREADS)
+    yolo_model = YOLO('models/yolov8s-pose.pt')
+    ring = SharedMemory(name=shm_name)
+
+    try:
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            request_id, operation, slot, shape, frame, args = request
+            try:
+                if frame is None:
+                    frame = np.ndarray(shape, dtype=np.uint8, buffer=ring.buf, offset=slot * INFERENCE_SLOT_BYTES)
+                if operation == 'pose':
+                    result = detect_poses(yolo_model, frame)
+                else:
+                    result = encode_face(frame, *args)
+                results.put((request_id, result, None))
+            except Exception as e:
+                results.put((request_id, None, str(e)))
+            finally:
+                # The view must not outlive the request, the slot is reused
+                del frame
+    finally:
+        ring.close()
+
+
+class InferenceService:
+    def __init__(self, workers: int = INFERENCE_WORKERS, slots: int = INFERENCE_RING_SLOTS):
+        self.workers = workers
+        self.slots = slots
+        # Spawned, the workers do not inherit the sockets, threads and event loop of the API process
+        self.context = mp.get_context('spawn')
+        self.processes: list = []
+        self.rings: list[SharedMemory] = []
+        self.requests: list = []
+        self.results = None
+        # Free slots as (worker, slot), waiting for one is the backpressure when every worker is busy
+        self.free_slots: asyncio.Queue | None = None
+        # Requests in flight by id: the future, its loop and its slot. The future of a request that timed out is
+        # None, its slot is given back when the late result arrives
+        self.pending: dict[int, tuple] = {}
+        # Shared by the event loop and the reader thread
+        self.pending_lock = threading.Lock()
+        self.ids = count()
+        self.reader: threading.Thread | None = None
+        self.monitor: asyncio.Task | None = None
+        # Set by `close`, the reader stops instead of retrying a queue that is being closed
+        self.closing = threading.Event()
+
+    async def start(self) -> None:
+        self.free_slots = asyncio.Queue()
+        self.results = self.context.Queue()
+        for worker in range(self.workers):
+            self.rings.append(SharedMemory(create=True, size=self.slots * INFERENCE_SLOT_BYTES))
+            self.requests.append(None)
+            self.processes.append(None)
+            self._spawn(worker)
+        # Interleaved, consecutive frames go to different workers
+        for slot in range(self.slots):
+            for worker in range(self.workers):
+                self.free_slots.put_nowait((worker, slot))
+
+        self._start_reader()
+        self.monitor = asyncio.create_task(self.monitor_workers())
+        logging.info(f'Started {self.workers} inference workers with {self.slots} frame slots each')
+
+    def _spawn(self, worker: int) -> None:
+        # A new request queue, the requests left in the old one were failed with the worker that read them
+        self.requests[worker] = self.context.Queue()
+        process = self.context.Process(target=_serve, args=(self.rings[worker].name, self.requests[worker],
+                                                            self.results), daemon=True)
+        process.start()
+        self.processes[worker] = process
+
+    def _start_reader(self) -> None:
+        self.reader = threading.Thread(target=self._read_results, name='inference-results', daemon=True)
+        self.reader.start()
+
+    async def monitor_workers(self) -> None:
+        # A worker that dies never answers, its requests would only fail on timeout and its slots would be lost
+        while True:
+            await asyncio.sleep(INFERENCE_MONITOR_INTERVAL)
+            if not self.reader.is_alive():
+                # Without the reader no result is delivered, every request would time out
+                logging.error('Inference results reader stopped, restarting it')
+                self._start_reader()
+            for worker, process in enumerate(self.processes):
+                if process.is_alive():
+                    continue
+                logging.error(f'Inference worker {worker} died with exit code {process.exitcode}, restarting it')
+                with self.pending_lock:
+                    lost = [request_id for request_id, (_, _, (owner, _)) in self.pending.items() if owner == worker]
+                    entries = [self.pending.pop(request_id) for request_id in lost]
+                for future, _, slot in entries:
+                    self._resolve(future, slot, None, f'worker {worker} died')
+                try:
+                    self._spawn(worker)
+                except Exception as e:
+                    logging.error(f'Error restarting inference worker {worker}: {e}')
+
+    def _read_results(self) -> None:
+        while not self.closing.is_set():
+            try:
+                message = self.results.get()
+                if message is None:
+                    break
+                request_id, result, error = message
+            except Exception as e:
+                # A worker killed while writing its result leaves a truncated message, the next ones are still read
+                logging.error(f'Error reading an inference result: {e}')
+                self.closing.wait(0.1)
+                continue
+            with self.pending_lock:
+                entry = self.pending.pop(request_id, None)
+            if entry is None:
+                continue  # Failed with a worker that died
+            future, loop, slot = entry
+            loop.call_soon_threadsafe(self._resolve, future, slot, result, error)
+
+    def _resolve(self, future: asyncio.Future | None, slot: tuple | None, result: any, error: str | None) -> None:
+        if slot is not None:
+            self.free_slots.put_nowait(slot)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(f'Inference worker error: {error}'))
+        else:
+            future.set_result(result)
+
+    async def _submit(self, operation: str, frame: np.ndarray, *args) -> any:
+        try:
+            worker, slot = await asyncio.wait_for(self.free_slots.get(), INFERENCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error(f'No inference slot was freed in {INFERENCE_TIMEOUT} seconds')
+            raise
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        if frame.nbytes <= INFERENCE_SLOT_BYTES:
+            view = np.ndarray(frame.shape, dtype=np.uint8, buffer=self.rings[worker].buf,
+                              offset=slot * INFERENCE_SLOT_BYTES)
+            view[...] = frame
+            del view
+            payload = None
+        else:
+            payload = frame
+
+        request_id = next(self.ids)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self.pending_lock:
+            self.pending[request_id] = (future, loop, (worker, slot))
+        self.requests[worker].put((request_id, operation, slot, frame.shape, payload, args))
+        try:
+            return await asyncio.wait_for(future, INFERENCE_TIMEOUT)
+        except asyncio.TimeoutError:
+            # The worker may still be reading the slot, it is given back when the late result arrives
+            with self.pending_lock:
+                if request_id in self.pending:
+                    self.pending[request_id] = (None, loop, (worker, slot))
+            logging.error(f'Inference worker {worker} did not answer in {INFERENCE_TIMEOUT} seconds')
+            raise
+
+    async def detect(self, frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Runs pose inference on a frame in a worker process.
+
+        Args:
+            frame (np.ndarray): The BGR frame.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The keypoints of the face and arms of each person, and their bounding boxes.
+        """
+
+        return await self._submit('pose', frame)
+
+    async def encode_face(self, cropped_frame: np.ndarray, face_center: tuple) -> np.ndarray | None:
+        # Same as the module's `encode_face`, in a worker process
+        return await self._submit('face', cropped_frame, face_center)
+
+    def close(self) -> None:
+        self.closing.set()
+        if self.monitor is not None:
+            self.monitor.cancel()
+            self.monitor = None
+        for requests in self.requests:
+            requests.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        if self.results is not None:
+            self.results.put(None)
+        if self.reader is not None:
+            self.reader.join(timeout=5)
+        for ring in self.rings:
+            ring.close()
+            ring.unlink()
+        self.processes, self.rings, self.requests = [], [], []
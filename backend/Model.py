@@ -1,17 +1,25 @@
-# Computer Vision
-import cv2 as cv
-import face_recognition as face_rec
 # Object Detection
 from ultralytics import YOLO
 # Numeric Processing
 import numpy as np
-from torch import Tensor
+from torch import Tensor, from_numpy
 # ID's
 from uuid import uuid4
 # Redis
-import redis
+import RedisPool
 # Detections
 from Detection import Detection
+# Face Gallery
+from FaceGallery import FaceGallery
+# Session Ownership
+from SessionRegistry import SessionLease
+# Roster Encodings
+import RosterStore
+from RosterStore import RosterEmbeddings
+# Inference
+from InferenceService import InferenceService, detect_poses, encode_face
+# Asynchronous
+import asyncio
 # logging
 import logging
 
@@ -21,17 +29,101 @@ class Model:
     ARM_RAISE_DURATION_THRESHOLD: int = 20
     LOST_THRESHOLD: int = 5
 
-    def __init__(self, course_id, session_count):
-        self.redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+    # Checked at the start of the scripts that write the session, they return nil without touching it once the
+    # session has another owner or epoch. Without KEYS[2] the check is skipped.
+    # KEYS[2]: owner hash of the session, ARGV[2]: worker id, ARGV[3]: epoch
+    FENCE: str = '''
+        if KEYS[2] and ((redis.call('HGET', KEYS[2], 'worker') or '') ~= ARGV[2] or
+                        (redis.call('HGET', KEYS[2], 'epoch') or '') ~= ARGV[3]) then
+            return false
+        end
+    '''
+
+    # Reads every student of the session and resets their counters in a single atomic call,
+    # marking the assistance of the present students as sent.
+    # KEYS[1]: set with the ids of the students, ARGV[1]: namespace of the session, see FENCE for the rest
+    SNAPSHOT_AND_RESET_SCRIPT: str = FENCE + '''
+        local snapshot = {}
+        for _, student_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+            local student_key = ARGV[1] .. ':student:' .. student_id
+            local student_info = redis.call('HGETALL', student_key)
+            if #student_info > 0 then
+                redis.call('HSET', student_key, 'participation_counter', '0')
+                if redis.call('HGET', student_key, 'assistance') == 'true' then
+                    redis.call('HSET', student_key, 'assistance_sent', 'true')
+                end
+                table.insert(snapshot, student_id)
+                table.insert(snapshot, student_info)
+            end
+        end
+        return snapshot
+    '''
+
+    # Removes the whole session namespace with UNLINK in a single call
+    # KEYS[1]: set with the ids of the students, ARGV[1]: namespace of the session, see FENCE for the rest
+    DELETE_NAMESPACE_SCRIPT: str = FENCE + '''
+        local keys = {KEYS[1], ARGV[1] .. ':visitors', ARGV[1] .. ':date'}
+        for _, student_id in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+            table.insert(keys, ARGV[1] .. ':student:' .. student_id)
+        end
+        local deleted = 0
+        for i = 1, #keys, 1000 do
+            deleted = deleted + redis.call('UNLINK', unpack(keys, i, math.min(i + 999, #keys)))
+        end
+        return deleted
+    '''
+
+    # Marks a student as present in a single call, only while the session still exists, so a check that finishes
+    # after the session was deleted does not create the key again
+    # KEYS[1]: hash of the student
+    MARK_PRESENT_SCRIPT: str = '''
+        if redis.call('EXISTS', KEYS[1]) == 1 then
+            return redis.call('HSET', KEYS[1], 'assistance', 'true')
+        end
+        return 0
+    '''
+
+    # Records the visitors with no participations yet in a single call, only while the session still exists
+    # KEYS[1]: set with the ids of the students, KEYS[2]: hash with the visitors, ARGV: ids of the visitors
+    RECORD_VISITORS_SCRIPT: str = '''
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        local added = 0
+        for _, visitor_id in ipairs(ARGV) do
+            added = added + redis.call('HSETNX', KEYS[2], visitor_id, 0)
+        end
+        return added
+    '''
+
+    def __init__(self, course_id, session_count, face_gallery: FaceGallery | None = None,
+                 inference: InferenceService | None = None):
+        self.redis_client = RedisPool.get_async_client()
+        self.course_id = course_id
         self.namespace: str = f'course:{course_id}:session:{session_count}'
-        # Images of all the students in the class
-        self.student_images: dict[str, np.ndarray] = {}
+        # Set with the ids of all the students saved in the namespace
+        self.students_key: str = f'{self.namespace}:students'
+        # Hash with the participations of the students from other sections that sit in the session
+        self.visitors_key: str = f'{self.namespace}:visitors'
+        # Date of the session, kept so a worker that drops the session once abandoned can still send its counts
+        self.date_key: str = f'{self.namespace}:date'
+        # Encodings of every student of the institution, searched when a face is not in the course
+        self.face_gallery: FaceGallery | None = face_gallery
+        # Server-side scripts
+        self.snapshot_and_reset_script = self.redis_client.register_script(self.SNAPSHOT_AND_RESET_SCRIPT)
+        self.delete_namespace_script = self.redis_client.register_script(self.DELETE_NAMESPACE_SCRIPT)
+        # Ownership of the session, the flushes and the final delete only apply while it is still held
+        self.lease: SessionLease | None = None
+        # Face encodings of all the students in the class, memory mapped from the roster store
+        self.roster: RosterEmbeddings | None = None
         # Date of the session
         self.date: any = None
         # Check if we no longer need to check for student's assistance
         self.finished_assistance: bool = False
-        # Load model
-        self.yolo_model: YOLO = YOLO('models/yolov8s-pose.pt')
+        # Worker processes that run the pose inference and face encoding, when the service is enabled
+        self.inference: InferenceService | None = inference
+        # Load model, only needed when the inference runs in this process
+        self.yolo_model: YOLO | None = YOLO('models/yolov8s-pose.pt') if inference is None else None
         # Pose and bounding box detections for the current frame
         self.model_detections: dict[str, None | Tensor] = {'poses': None, 'boxes': None}
         # Arm raised detections
@@ -43,25 +135,29 @@ class Model:
 
     ''' DATA MANAGEMENT '''
 
-    def save_data(self, students_info: dict[str, dict]) -> None:
+    async def save_data(self, students_info: dict[str, dict], resume: bool = False) -> None:
         """
         Saves student information to the Redis database and in a local dictionary.
 
         This method iterates through the provided student information dictionary, storing each
-        student's data in the Redis database under a unique namespace key. Images are stored
-        separately in a local dictionary for efficiency.
+        student's data in the Redis database under a unique namespace key. Images are written
+        to the roster store and memory mapped, so the workers can map them instead of copying them.
 
         Args:
             students_info (dict[str, dict]): A dictionary containing student IDs as keys and
                 their corresponding information (excluding images) as values.
+            resume (bool): Whether the session is resumed from a previous owner, the students already saved keep
+                their assistance and counters.
 
         Returns:
             None
         """
 
+        encodings = {}
         for student_id, student_info in students_info.items():
             # Save students info to Redis DB
             namespace_key = f'{self.namespace}:student:{student_id}'
+            fields = {}
 
             # Iterate through each field in student info
             for key, value in student_info.items():
@@ -72,29 +168,53 @@ class Model:
                     else:
                         value = str(value)
 
-                    # Update the specific field in the hash
-                    self.redis_client.hset(namespace_key, key, value)
+                    fields[key] = value
+
+            # Save all the fields of the hash in a single round trip
+            if fields and resume:
+                # Only the fields that are missing are set, a resumed session must not lose what it counted
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for key, value in fields.items():
+                        pipe.hsetnx(namespace_key, key, value)
+                    pipe.sadd(self.students_key, str(student_id))
+                    await pipe.execute()
+            elif fields:
+                await self.redis_client.hset(namespace_key, mapping=fields)
+                await self.redis_client.sadd(self.students_key, str(student_id))
 
-            # Save student image to the local dictionary
             if 'img' in student_info:
-                self.student_images[str(student_id)] = student_info['img']
+                encodings[str(student_id)] = student_info['img']
+
+        # Sessions of the course with the same roster share the same file
+        if encodings:
+            path = await asyncio.to_thread(RosterStore.write, self.course_id, encodings)
+            self.roster = RosterStore.open_roster(path)
+
+    async def save_date(self, date: str) -> None:
+        self.date = date
+        await self.redis_client.set(self.date_key, str(date))
 
-    def delete_all_data(self) -> None:
+    def fence(self) -> tuple[list, list]:
+        # Extra keys and arguments of the scripts that write the session, see FENCE
+        return self.lease.fence() if self.lease is not None else ([], [])
+
+    async def delete_all_data(self) -> bool:
         """
         Deletes all student-related data from the Redis database for the current namespace.
 
-        This method searches for and deletes all Redis keys that match the current namespace pattern,
-        effectively removing all data related to the current course session.
+        This method unlinks every key of the current namespace in a single server-side call,
+        effectively removing all data related to the current course session. With a lease, the
+        ownership is checked in the same call.
 
         Returns:
-            None
+            bool: False if the session has another owner by now and nothing was deleted.
         """
 
-        namespace_pattern = f'{self.namespace}:*'
-        for key in self.redis_client.scan_iter(namespace_pattern):
-            self.redis_client.delete(key)
+        keys, args = self.fence()
+        deleted = await self.delete_namespace_script(keys=[self.students_key, *keys], args=[self.namespace, *args])
+        return deleted is not None
 
-    def update_field(self, student_id: str, field: str, new_value: any) -> None:
+    async def update_field(self, student_id: str, field: str, new_value: any) -> None:
         """
         Updates a specific field in a student's information in the Redis database.
 
@@ -115,17 +235,17 @@ class Model:
         if isinstance(new_value, bool):
             # Convert boolean to 'true' or 'false' string
             value = 'true' if new_value else 'false'
-            self.redis_client.hset(namespace_key, field, value)
+            await self.redis_client.hset(namespace_key, field, value)
         elif isinstance(new_value, int) and new_value > 0:
             # Increment the integer field
-            self.redis_client.hincrby(namespace_key, field, new_value)
+            await self.redis_client.hincrby(namespace_key, field, new_value)
         elif isinstance(new_value, int) and new_value == 0:
             # Reset the numeric value
-            self.redis_client.hset(namespace_key, field, str(new_value))
+            await self.redis_client.hset(namespace_key, field, str(new_value))
         else:
             logging.error('Error setting the new value, make sure it\'s valid')
 
-    def get_field(self, student_id: str, field: str) -> any:
+    async def get_field(self, student_id: str, field: str) -> any:
         """
         Retrieves the value of a specified field from a student's information in Redis.
 
@@ -141,7 +261,7 @@ class Model:
         """
 
         namespace_key = f'{self.namespace}:student:{student_id}'
-        value = self.redis_client.hget(namespace_key, field)
+        value = await self.redis_client.hget(namespace_key, field)
 
         if value is not None:
             if value.isdigit():
@@ -152,7 +272,7 @@ class Model:
                 return value  # Return string as is
         return None
 
-    def get_student_info(self, student_id: str) -> dict:
+    async def get_student_info(self, student_id: str) -> dict:
         """
         Retrieves all available information for a specific student from Redis.
 
@@ -167,7 +287,7 @@ class Model:
         """
 
         namespace_key = f'{self.namespace}:student:{student_id}'
-        student_info = self.redis_client.hgetall(namespace_key)
+        student_info = await self.redis_client.hgetall(namespace_key)
 
         # Convert fields from string to their appropriate data types
         for key, value in student_info.items():
@@ -178,7 +298,7 @@ class Model:
 
         return student_info
 
-    def get_all_students_info(self) -> dict:
+    async def get_all_students_info(self) -> dict:
         """
         Retrieves information for all students associated with the current session from Redis.
 
@@ -191,10 +311,10 @@ class Model:
 
         students_data = {}
         student_pattern = f'{self.namespace}:student:*'
-        for key in self.redis_client.scan_iter(student_pattern):
+        async for key in self.redis_client.scan_iter(student_pattern):
             # Extracting student_id from the key
             student_id = key.split(':')[-1]
-            student_info = self.redis_client.hgetall(key)
+            student_info = await self.redis_client.hgetall(key)
 
             # Convert fields from string to their appropriate data types
             processed_info = {}
@@ -210,9 +330,45 @@ class Model:
 
         return students_data
 
+    async def snapshot_and_reset(self) -> dict | None:
+        """
+        Retrieves the information of all students and resets their counters in a single atomic call.
+
+        The participation counters are set back to zero and the assistance of the present students is marked
+        as sent, so events recorded after the snapshot are kept for the next one instead of being lost.
+        With a lease, the ownership is checked in the same call.
+
+        Returns:
+            dict | None: A dictionary with student IDs as keys and dictionaries of their information, as it was
+                before the reset, as values. None if the session has another owner by now.
+        """
+
+        keys, args = self.fence()
+        snapshot = await self.snapshot_and_reset_script(keys=[self.students_key, *keys], args=[self.namespace, *args])
+        return self.parse_snapshot(snapshot) if snapshot is not None else None
+
+    @staticmethod
+    def parse_snapshot(snapshot: list) -> dict:
+        # Students of the SNAPSHOT_AND_RESET_SCRIPT reply, with the fields converted like `get_all_students_info`
+        students_data = {}
+        for student_id, student_info in zip(snapshot[0::2], snapshot[1::2]):
+            # The hash comes as a flat list of fields and values
+            processed_info = {}
+            for field, value in zip(student_info[0::2], student_info[1::2]):
+                if value.isdigit():
+                    processed_info[field] = int(value)  # Convert to integer
+                elif value in ['true', 'false']:
+                    processed_info[field] = value == 'true'  # Convert to boolean
+                else:
+                    processed_info[field] = value  # Keep as string
+
+            students_data[student_id] = processed_info
+
+        return students_data
+
     ''' ASSISTANCE CHECKER '''
 
-    def check_assistance(self) -> bool:
+    async def check_assistance(self) -> bool:
         """
         Checks if all students have marked their assistance for the current session.
 
@@ -223,7 +379,7 @@ class Model:
             bool: True if all students are marked present, False otherwise.
         """
 
-        students_info = self.get_all_students_info()
+        students_info = await self.get_all_students_info()
         for student_info in students_info.values():
             if not student_info['assistance']:
                 return False
@@ -231,6 +387,28 @@ class Model:
 
     ''' POSE AND PARTICIPATION DETECTION '''
 
+    async def detect(self, frame: np.ndarray) -> None:
+        """
+        Gets the poses and bounding boxes of the people in a frame.
+
+        The inference runs in the inference service when it is enabled, its arrays are wrapped as tensors so the
+        detections are consumed the same way either way.
+
+        Args:
+            frame (np.ndarray): The current frame from the video feed as a NumPy array.
+
+        Returns:
+            None
+        """
+
+        if self.inference is not None:
+            poses, boxes = await self.inference.detect(frame)
+        else:
+            poses, boxes = detect_poses(self.yolo_model, frame)
+        # We only want to get the arms and shoulders of the pose
+        self.model_detections['poses'] = from_numpy(poses)
+        self.model_detections['boxes'] = from_numpy(boxes)
+
     @staticmethod
     def get_face_center(face_coords: dict) -> tuple:
         """
@@ -421,13 +599,15 @@ class Model:
                     return True
         return False
 
-    def face_rec_scan(self, curr_frame: np.ndarray, curr_detection: Detection) -> tuple:
+    async def face_rec_scan(self, curr_frame: np.ndarray, curr_detection: Detection) -> tuple:
         """
         Performs facial recognition within a specified bounding box of the current frame.
 
         The function first crops the frame based on the bounding box coordinates. It then detects faces within
-        this cropped area and compares these faces against known student faces in `students_images`. If a match
+        this cropped area and compares these faces against the known student faces in `roster`. If a match
         is found, the function updates the student's assistance status and participation counter in the Redis DB.
+        Faces that are not in the course are looked up in the institution's face gallery, students from other
+        sections are recorded as visitors of the session.
 
         Parameters:
             curr_frame (np.ndarray): The current video frame as a NumPy array.
@@ -435,54 +615,56 @@ class Model:
 
         Returns:
             tuple: For the first value - True if a face within the bounding box matches a known student face, False otherwise.
-                For the second value - True if the face is not part of the `students_images`, False otherwise.
+                For the second value - True if the face is not part of the `roster` nor the gallery, False otherwise.
         """
 
         # Get the person's bounding box
         box_x_min, box_y_min, box_x_max, box_y_max = curr_detection.bbox
+        if curr_detection.face_center == (None, None):
+            # No face key points found
+            return False, False
+
         # Crop the frame to only get the frame inside the bounding box
         cropped_frame = curr_frame[box_y_min:box_y_max, box_x_min:box_x_max]
-        # Convert the image from BGR color (which OpenCV uses) to RGB color (which face_recognition uses)
-        cropped_frame = cv.cvtColor(cropped_frame, cv.COLOR_BGR2RGB)
-        # Find all the faces and face encodings in the current frame of video
-        face_locations = face_rec.face_locations(cropped_frame)
+        # The face center relative to the crop, only the face that contains it is the person's face
+        face_center = (curr_detection.face_center[0] - box_x_min, curr_detection.face_center[1] - box_y_min)
         # Detected face encoding
-        face_enc = None
-
-        if curr_detection.face_center == (None, None) or len(face_locations) == 0:
-            # No face key points found or the face is not found
-            return False, False
+        if self.inference is not None:
+            face_enc = await self.inference.encode_face(cropped_frame, face_center)
+        else:
+            face_enc = encode_face(cropped_frame, face_center)
 
-        for face_location in face_locations:
-            # Get the face's bounding box
-            top = face_location[0] + box_y_min
-            right = face_location[1] + box_x_min
-            bottom = face_location[2] + box_y_min
-            left = face_location[3] + box_x_min
-            # Check if we detected the correct face
-            if left <= curr_detection.face_center[0] <= right and top <= curr_detection.face_center[1] <= bottom:
-                logging.info('Detection - Correct face detected')
-                # The argument known_face_locations must be a list, but considering
-                # we are only checking one face, we wrap the `face_location` in a list
-                # and only get the first index to get the encoding out of the outer list
-                face_enc = face_rec.face_encodings(cropped_frame, [face_location])[0]
-                break
-
-        # We iterate over each student in the course to compare with their faces
         if face_enc is not None:
-            for student_id, student_img in self.student_images.items():
-                # Check if the current student's image is the same from the `face_enc`
-                match = face_rec.compare_faces([student_img], face_enc)[0]
-                # Check if it's a match
-                if match:
-                    student_name = self.get_field(student_id, 'name')
-                    logging.info(f'Student {student_name} has participated')
-                    # Student found, update assistance and participation
-                    self.update_field(student_id, 'assistance', True)
-                    self.update_field(student_id, 'participation_counter', 1)
-                    return True, False
+            logging.info('Detection - Correct face detected')
+            # Course first, we look for the closest student in the course in a single comparison
+            student_id = None
+            if self.roster is not None:
+                distances = self.roster.distances(face_enc)
+                closest = int(np.argmin(distances))
+                if distances[closest] <= FaceGallery.TOLERANCE:
+                    student_id = self.roster.ids[closest]
+
+            # Then the whole institution, for students of other sections sitting in
+            if student_id is None and self.face_gallery is not None:
+                match = self.face_gallery.nearest(face_enc)
+                if match is not None:
+                    if self.roster is not None and str(match[0]) in self.roster:
+                        student_id = str(match[0])
+                    else:
+                        logging.info(f'Student {match[0]} from another section has participated')
+                        await self.redis_client.hincrby(self.visitors_key, str(match[0]), 1)
+                        return True, False
+
+            if student_id is not None:
+                student_name = await self.get_field(student_id, 'name')
+                logging.info(f'Student {student_name} has participated')
+                # Student found, update assistance and participation
+                await self.update_field(student_id, 'assistance', True)
+                await self.update_field(student_id, 'participation_counter', 1)
+                return True, False
+
             # Even though we got the face of the person that raised their arm, we got no matches
-            # from the list of students in the course, therefore, this person is not a student
+            # from the students of the institution, therefore, this person is not a student
             logging.info('Got no matches from list of students, therefore, this person is not a student')
             return False, True
 
@@ -550,7 +732,7 @@ class Model:
         curr_detection.face_center = face_center
         curr_detection.last_frame_detected = curr_frame_count
 
-    def iterate_over_detections(self, frame: np.ndarray) -> None:
+    async def iterate_over_detections(self, frame: np.ndarray) -> None:
         """
         Iterates over all detected poses and bounding boxes in a given frame, processes each detection,
         and updates or creates new detection instances as needed.
@@ -633,7 +815,7 @@ class Model:
                         if detection.arm_raised_counter >= self.ARM_RAISE_DURATION_THRESHOLD and not detection.face_scanned and not detection.not_a_student:
                             # Person has raised the arm for the correct amount of frames, run facial recognition and update new info
                             logging.info(f'Detection {uuid} - Getting face recognition')
-                            scanned, not_a_student = self.face_rec_scan(frame, detection)
+                            scanned, not_a_student = await self.face_rec_scan(frame, detection)
                             detection.face_scanned = scanned
                             detection.not_a_student = not_a_student
 
@@ -657,7 +839,7 @@ class Model:
                             else:
                                 # Face has yet to be scanned
                                 logging.info(f'Detection {uuid} - Getting face recognition')
-                                scanned, not_a_student = self.face_rec_scan(frame, detection)
+                                scanned, not_a_student = await self.face_rec_scan(frame, detection)
                                 detection.face_scanned = scanned
                                 detection.not_a_student = not_a_student
 
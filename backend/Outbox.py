@@ -0,0 +1,231 @@
+# Redis
+import RedisPool
+from redis.exceptions import ResponseError
+# Asynchronous
+import asyncio
+from typing import Awaitable, Callable
+# Serialization
+import json
+# OS Handling
+import os
+import socket
+# logging
+import logging
+
+
+class Outbox:
+    STREAM_KEY: str = 'outbox:session_flush'
+    # Records that kept failing on their own while others were written, kept for inspection
+    DEAD_KEY: str = 'outbox:session_flush:dead'
+    # Times each pending record failed on its own while others were written, failures during an outage do not count
+    FAILURES_KEY: str = 'outbox:session_flush:failures'
+    # Failures of the first records written one by one, with nothing written, that mean the database is down
+    OUTAGE_PROBES: int = 3
+    # Errors that go away on their own and are always retried: deadlock victim (1205), timeouts, lost connections
+    TRANSIENT_ERRORS: tuple = ('40001', '1205', 'HYT00', 'HYT01', '08S01', '08001', 'timeout', 'timed out')
+    GROUP: str = 'flushers'
+    # Pending records of a consumer idle for this long are claimed by another one
+    CLAIM_IDLE_MS: int = 60_000
+
+    def __init__(self, writer: Callable[[list[dict]], Awaitable[None]], batch_size: int = 100, block_ms: int = 1000,
+                 coalesce_ms: int = 0, initial_backoff: float = 1.0, max_backoff: float = 60.0,
+                 max_failures: int = 5):
+        self.redis_client = RedisPool.get_async_client()
+        # Writes a batch of flush records to the database, raising if the batch must be retried
+        self.writer = writer
+        # Maximum number of records handed to the writer at once
+        self.batch_size = batch_size
+        # Milliseconds to block waiting for new records
+        self.block_ms = block_ms
+        # Milliseconds to keep collecting records after the first one arrives, so bursts are written together
+        self.coalesce_ms = coalesce_ms
+        # Seconds to wait before retrying a failed batch, doubled on every consecutive failure
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        # Times a record fails on its own before it is moved to the dead-letter stream
+        self.max_failures = max_failures
+        # Name of this drainer within the consumer group
+        self.consumer: str = f'{socket.gethostname()}:{os.getpid()}'
+        self.drainer: asyncio.Task | None = None
+
+    async def enqueue(self, flush_key: str, course_id: int, date: str, session_results: list) -> None:
+        """
+        Writes a flush record to the durable outbox.
+
+        The record is kept in a Redis Stream until the drainer has written it to the database, so it
+        survives failures of the database and restarts of this process.
+
+        Args:
+            flush_key (str): Idempotency key of the record, the database applies each key only once.
+            course_id (int): The course of the session.
+            date (str): The date of the session.
+            session_results (list): Rows of (student_id, assistance_count, participation_count), where
+                assistance_count is None if the assistance was already sent.
+
+        Returns:
+            None
+        """
+
+        record = {'flush_key': flush_key, 'course_id': course_id, 'date': date, 'results': session_results}
+        await self.redis_client.xadd(self.STREAM_KEY, {'record': json.dumps(record)})
+
+    async def start(self) -> None:
+        try:
+            await self.redis_client.xgroup_create(self.STREAM_KEY, self.GROUP, id='0', mkstream=True)
+        except ResponseError as e:
+            # The group already exists
+            if 'BUSYGROUP' not in str(e):
+                raise
+        self.drainer = asyncio.create_task(self.drain())
+
+    async def stop(self) -> None:
+        if self.drainer is not None:
+            self.drainer.cancel()
+            try:
+                await self.drainer
+            except asyncio.CancelledError:
+                pass
+            self.drainer = None
+
+    async def read_batch(self) -> list[tuple]:
+        # Records left by consumers that died before acknowledging them
+        _, entries, *_ = await self.redis_client.xautoclaim(
+            self.STREAM_KEY, self.GROUP, self.consumer, self.CLAIM_IDLE_MS, start_id='0-0', count=self.batch_size)
+        if entries:
+            return entries
+
+        # Records of this consumer that failed before, read together with new ones so a record that keeps failing
+        # is written next to records that do not, and can be told apart from a database outage
+        response = await self.redis_client.xreadgroup(
+            self.GROUP, self.consumer, {self.STREAM_KEY: '0'}, count=self.batch_size)
+        entries = response[0][1] if response else []
+        if len(entries) < self.batch_size:
+            response = await self.redis_client.xreadgroup(
+                self.GROUP, self.consumer, {self.STREAM_KEY: '>'}, count=self.batch_size - len(entries),
+                block=None if entries else self.block_ms)
+            entries.extend(response[0][1] if response else [])
+        return entries
+
+    async def read_coalesced_batch(self) -> list[tuple]:
+        entries = await self.read_batch()
+        if not entries or self.coalesce_ms <= 0:
+            return entries
+
+        # Keep reading new records until the window closes or the batch is full
+        deadline = asyncio.get_running_loop().time() + self.coalesce_ms / 1000
+        while len(entries) < self.batch_size:
+            remaining_ms = int((deadline - asyncio.get_running_loop().time()) * 1000)
+            if remaining_ms <= 0:
+                break
+            response = await self.redis_client.xreadgroup(
+                self.GROUP, self.consumer, {self.STREAM_KEY: '>'}, count=self.batch_size - len(entries), block=remaining_ms)
+            if response:
+                entries.extend(response[0][1])
+        return entries
+
+    @classmethod
+    def is_transient(cls, error: Exception) -> bool:
+        # Timeouts and connection errors, by type or by the SQLSTATE and SQL Server codes in the driver message
+        if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+            return True
+        message = f'{type(error).__name__} {error}'.lower()
+        return any(marker.lower() in message for marker in cls.TRANSIENT_ERRORS)
+
+    async def write_one_by_one(self, records: list[tuple]) -> tuple[list, list]:
+        """
+        Writes the records of a failed batch one at a time, to find the ones that cannot be written.
+
+        A record that fails with a permanent error while others are written counts a failure, and is moved to
+        the dead-letter stream after `max_failures` of them. Transient errors are always retried. If the first
+        records all fail the database is assumed to be down, and the whole batch is retried.
+
+        Args:
+            records (list[tuple]): The stream id and the flush record of each entry.
+
+        Returns:
+            tuple[list, list]: The ids that can be acknowledged, written or dead-lettered, and the ids to retry.
+        """
+
+        written, failed = [], []
+        for entry_id, record in records:
+            # Nothing got through, every other record would wait for its own connect or pool timeout
+            if not written and len(failed) >= self.OUTAGE_PROBES:
+                return [], [entry_id for entry_id, _ in records]
+            try:
+                await self.writer([record])
+                written.append(entry_id)
+            except Exception as e:
+                failed.append((entry_id, record, e))
+
+        if not written:
+            return [], [entry_id for entry_id, _, _ in failed]
+
+        done, retry = written, []
+        for entry_id, record, error in failed:
+            if self.is_transient(error):
+                logging.warning(f'Session flush {record.get("flush_key")} failed, retrying: {error}')
+                retry.append(entry_id)
+                continue
+
+            failures = await self.redis_client.hincrby(self.FAILURES_KEY, entry_id, 1)
+            if failures >= self.max_failures:
+                await self.redis_client.xadd(
+                    self.DEAD_KEY, {'record': json.dumps(record), 'error': str(error), 'stream_id': entry_id})
+                logging.error(f'Session flush {record.get("flush_key")} failed {failures} times, '
+                              f'moved to {self.DEAD_KEY}: {error}')
+                done.append(entry_id)
+            else:
+                logging.warning(f'Session flush {record.get("flush_key")} failed ({failures} times): {error}')
+                retry.append(entry_id)
+        return done, retry
+
+    async def acknowledge(self, ids: list) -> None:
+        if ids:
+            await self.redis_client.xack(self.STREAM_KEY, self.GROUP, *ids)
+            await self.redis_client.xdel(self.STREAM_KEY, *ids)
+            await self.redis_client.hdel(self.FAILURES_KEY, *ids)
+
+    async def drain(self) -> None:
+        """
+        Writes the pending flush records to the database in batches until cancelled.
+
+        Records are only acknowledged and removed from the stream once they have been written. The records
+        of a failed batch are retried one at a time, the ones that keep failing on their own are dead-lettered
+        and the rest are retried with exponential backoff.
+
+        Returns:
+            None
+        """
+
+        backoff = self.initial_backoff
+        while True:
+            try:
+                entries = await self.read_coalesced_batch()
+                if not entries:
+                    continue
+
+                # Entries deleted from the stream while pending come back without fields
+                records = [(entry_id, json.loads(fields['record'])) for entry_id, fields in entries if fields]
+                done = [entry_id for entry_id, fields in entries if not fields]
+                try:
+                    if records:
+                        await self.writer([record for _, record in records])
+                    done.extend(entry_id for entry_id, _ in records)
+                    retry = []
+                except Exception as e:
+                    logging.error(f'Error writing {len(records)} session flushes, writing them one by one: {e}')
+                    written, retry = await self.write_one_by_one(records)
+                    done.extend(written)
+
+                await self.acknowledge(done)
+                if retry:
+                    raise RuntimeError(f'{len(retry)} session flushes could not be written')
+                backoff = self.initial_backoff
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logging.error(f'Error draining the session flush outbox, retrying in {backoff}s: {e}')
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
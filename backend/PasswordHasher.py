@@ -0,0 +1,93 @@
+# Password Hashing
+from passlib.hash import argon2
+# Asynchronous
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+# OS Handling
+import os
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Argon2 parameters, passlib's defaults are used for the ones that are not set
+ARGON2_PARAMS: dict = {
+    param: int(os.environ[variable])
+    for param, variable in (
+        ('time_cost', 'ARGON2_TIME_COST'),
+        ('memory_cost', 'ARGON2_MEMORY_COST'),  # KiB
+        ('parallelism', 'ARGON2_PARALLELISM'),
+    )
+    if os.getenv(variable)
+}
+# Hashes computed at the same time, each one holds memory_cost KiB while it runs
+PASSWORD_HASH_WORKERS: int = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+# Requests allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_MAX_QUEUE: int = int(os.getenv('PASSWORD_HASH_MAX_QUEUE', 32))
+
+
+class HasherOverloaded(Exception):
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, max_workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+                 params: dict = ARGON2_PARAMS):
+        self.hasher = argon2.using(**params) if params else argon2
+        # argon2-cffi releases the GIL, so a small thread pool keeps the hashes off the event loop
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='argon2')
+        # Hashes running plus the ones waiting for a worker
+        self.max_pending = max_workers + max_queue
+        self.pending = 0
+
+    async def _submit(self, function: Callable, *args) -> any:
+        # Turning requests away is cheaper than letting a login burst queue up for seconds
+        if self.pending >= self.max_pending:
+            raise HasherOverloaded(f'{self.pending} password hashes pending')
+
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, function, *args)
+        finally:
+            self.pending -= 1
+
+    async def hash(self, password: str) -> str:
+        """
+        Hashes a password in the hashing pool.
+
+        Args:
+            password (str): The plain-text password.
+
+        Returns:
+            str: The Argon2 hash of the password.
+
+        Raises:
+            HasherOverloaded: If too many hashes are already pending.
+        """
+
+        return await self._submit(self.hasher.hash, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        """
+        Verifies a password against its stored hash in the hashing pool.
+
+        Args:
+            password (str): The plain-text password.
+            password_hash (str): The stored Argon2 hash.
+
+        Returns:
+            bool: Whether the password matches.
+
+        Raises:
+            HasherOverloaded: If too many hashes are already pending.
+        """
+
+        return await self._submit(self.hasher.verify, password, password_hash)
+
+    def metrics(self) -> dict:
+        return {'pending': self.pending, 'max_pending': self.max_pending}
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
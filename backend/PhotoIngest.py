@@ -0,0 +1,80 @@
+# Image Processing
+import io
+from PIL import Image, ImageOps
+import face_recognition as face_rec
+# Numeric Processing
+import numpy as np
+# Hashing
+import hashlib
+# OS Handling
+import os
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Longest side of the stored photos, in pixels
+PHOTO_MAX_SIZE: int = int(os.getenv('PHOTO_MAX_SIZE', 480))
+PHOTO_JPEG_QUALITY: int = int(os.getenv('PHOTO_JPEG_QUALITY', 85))
+# Longest side of the copy the face is detected in, full resolution phone photos make the detector slow
+DETECT_MAX_SIZE: int = 800
+# Space kept around the face, as a fraction of its size
+FACE_MARGIN: float = 0.6
+
+
+def content_hash(image_data: bytes) -> str:
+    # Hash of the photo as uploaded, used to skip the pipeline when the same photo is uploaded again
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def normalize_photo(image_data: bytes) -> tuple[bytes, np.ndarray, str]:
+    """
+    Prepares a student photo for storage: fixes its orientation, crops it around the face, resizes it to at most
+    PHOTO_MAX_SIZE pixels and re-encodes it as JPEG. Runs in worker processes, it is CPU bound.
+
+    Args:
+        image_data (bytes): The photo as uploaded.
+
+    Returns:
+        tuple[bytes, np.ndarray, str]: The normalized JPEG, the face encoding computed from it and the hash of the
+            uploaded photo.
+
+    Raises:
+        ValueError: If the file is not an image or it does not have exactly one face.
+    """
+
+    try:
+        image = ImageOps.exif_transpose(Image.open(io.BytesIO(image_data))).convert('RGB')
+    except Exception as e:
+        raise ValueError(f'Not a valid image: {e}')
+
+    preview = image.copy()
+    preview.thumbnail((DETECT_MAX_SIZE, DETECT_MAX_SIZE))
+    locations = face_rec.face_locations(np.array(preview))
+    if len(locations) != 1:
+        raise ValueError(f'Expected one face, found {len(locations)}')
+
+    # Face box in the full resolution image
+    scale = image.width / preview.width
+    top, right, bottom, left = (value * scale for value in locations[0])
+
+    margin = FACE_MARGIN * max(bottom - top, right - left)
+    crop_left, crop_top = max(int(left - margin), 0), max(int(top - margin), 0)
+    crop_right, crop_bottom = min(int(right + margin), image.width), min(int(bottom + margin), image.height)
+    image = image.crop((crop_left, crop_top, crop_right, crop_bottom))
+    image.thumbnail((PHOTO_MAX_SIZE, PHOTO_MAX_SIZE), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=PHOTO_JPEG_QUALITY, optimize=True)
+
+    # The encoding is taken from the normalized photo, so it matches what a session would compute from the stored one
+    ratio = image.width / (crop_right - crop_left)
+    face_box = (
+        int((top - crop_top) * ratio),
+        int((right - crop_left) * ratio),
+        int((bottom - crop_top) * ratio),
+        int((left - crop_left) * ratio),
+    )
+    encoding = face_rec.face_encodings(np.array(image), known_face_locations=[face_box])[0]
+
+    return buffer.getvalue(), encoding, content_hash(image_data)
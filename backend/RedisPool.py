@@ -0,0 +1,178 @@
+# Redis
+import redis
+import redis.asyncio as aioredis
+# OS Handling
+import os
+# Time Handling
+import time
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Connection settings, shared by the async pool of the API process and the sync pools of the workers
+REDIS_HOST: str = os.getenv('REDIS_HOST', 'localhost')
+REDIS_PORT: int = int(os.getenv('REDIS_PORT', 6379))
+REDIS_DB: int = int(os.getenv('REDIS_DB', 0))
+# Maximum number of connections per pool
+REDIS_POOL_SIZE: int = int(os.getenv('REDIS_POOL_SIZE', 50))
+REDIS_WORKER_POOL_SIZE: int = int(os.getenv('REDIS_WORKER_POOL_SIZE', 4))
+# Seconds to wait for a free connection before giving up
+REDIS_POOL_TIMEOUT: float = float(os.getenv('REDIS_POOL_TIMEOUT', 5))
+# Seconds to wait for the socket to connect and for a command reply
+REDIS_CONNECT_TIMEOUT: float = float(os.getenv('REDIS_CONNECT_TIMEOUT', 2))
+REDIS_SOCKET_TIMEOUT: float = float(os.getenv('REDIS_SOCKET_TIMEOUT', 5))
+
+
+class PoolMetrics:
+    def __init__(self, max_connections: int):
+        self.pid = os.getpid()  # Process that owns the pool
+        self.max_connections = max_connections  # Configured size of the pool
+        self.checkouts = 0  # Number of connections handed out by the pool
+        self.in_use = 0  # Connections currently checked out
+        self.errors = 0  # Failed checkouts (pool timeout or connection errors)
+        self.total_wait = 0.0  # Accumulated seconds spent waiting for a connection
+        self.max_wait = 0.0  # Longest wait for a connection
+
+    def checkout(self, wait: float) -> None:
+        self.checkouts += 1
+        self.in_use += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def checkin(self) -> None:
+        self.in_use = max(self.in_use - 1, 0)
+
+    def snapshot(self) -> dict:
+        return {
+            'pid': self.pid,
+            'max_connections': self.max_connections,
+            'checkouts': self.checkouts,
+            'in_use': self.in_use,
+            'errors': self.errors,
+            'avg_wait_ms': (self.total_wait / self.checkouts) * 1000 if self.checkouts else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+
+class MeteredAsyncPool(aioredis.BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics(self.max_connections)
+
+    async def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except Exception:
+            self.metrics.errors += 1
+            raise
+        self.metrics.checkout(time.perf_counter() - start)
+        return connection
+
+    async def release(self, connection) -> None:
+        self.metrics.checkin()
+        await super().release(connection)
+
+
+class MeteredSyncPool(redis.BlockingConnectionPool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics(self.max_connections)
+
+    def get_connection(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            connection = super().get_connection(*args, **kwargs)
+        except Exception:
+            self.metrics.errors += 1
+            raise
+        self.metrics.checkout(time.perf_counter() - start)
+        return connection
+
+    def release(self, connection) -> None:
+        self.metrics.checkin()
+        super().release(connection)
+
+
+def _pool_options(max_connections: int) -> dict:
+    return {
+        'host': REDIS_HOST,
+        'port': REDIS_PORT,
+        'db': REDIS_DB,
+        'decode_responses': True,
+        'max_connections': max_connections,
+        'timeout': REDIS_POOL_TIMEOUT,
+        'socket_connect_timeout': REDIS_CONNECT_TIMEOUT,
+        'socket_timeout': REDIS_SOCKET_TIMEOUT,
+    }
+
+
+# Process-wide pools, the async one serves the WebSocket sessions and the sync one the worker processes
+_async_pool: MeteredAsyncPool | None = None
+_sync_pool: MeteredSyncPool | None = None
+# Last metrics reported by each worker process, keyed by pid
+_worker_metrics: dict[int, dict] = {}
+
+
+def get_async_client() -> aioredis.Redis:
+    """
+    Returns an async Redis client backed by the process-wide connection pool.
+
+    The pool is created on first use and shared by every session of this process, clients
+    are cheap wrappers around it and must not close or disconnect it.
+
+    Returns:
+        aioredis.Redis: A client that checks out connections from the shared pool.
+    """
+
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = MeteredAsyncPool(**_pool_options(REDIS_POOL_SIZE))
+    return aioredis.Redis(connection_pool=_async_pool)
+
+
+def get_sync_client() -> redis.Redis:
+    """
+    Returns a sync Redis client backed by this process' own connection pool.
+
+    Meant for worker processes, the pool is created once per process (a forked child never
+    reuses the sockets of its parent) and reused between runs.
+
+    Returns:
+        redis.Redis: A client that checks out connections from the process pool.
+    """
+
+    global _sync_pool
+    if _sync_pool is None or _sync_pool.metrics.pid != os.getpid():
+        _sync_pool = MeteredSyncPool(**_pool_options(REDIS_WORKER_POOL_SIZE))
+    return redis.Redis(connection_pool=_sync_pool)
+
+
+def init_worker() -> None:
+    # Initializer for worker processes, warms up the process pool before the first run
+    get_sync_client()
+
+
+def worker_metrics() -> dict:
+    # Metrics of this worker process' pool, to be sent back to the API process
+    return _sync_pool.metrics.snapshot() if _sync_pool else {}
+
+
+def record_worker_metrics(snapshot: dict) -> None:
+    if snapshot:
+        _worker_metrics[snapshot['pid']] = snapshot
+
+
+def metrics() -> dict:
+    return {
+        'api': _async_pool.metrics.snapshot() if _async_pool else {},
+        'workers': list(_worker_metrics.values()),
+    }
+
+
+async def close_async_pool() -> None:
+    global _async_pool
+    if _async_pool is not None:
+        await _async_pool.disconnect()
+        _async_pool = None
@@ -0,0 +1,216 @@
+# Redis
+import RedisPool
+# Asynchronous
+import asyncio
+# Data Structures
+from collections import OrderedDict
+# Hashing
+import hashlib
+# Time Handling
+import time
+# logging
+import logging
+
+
+class ResponseCache:
+    KEY_PREFIX: str = 'cache'
+    # Channel used to tell every server process which tags were invalidated
+    INVALIDATION_CHANNEL: str = 'cache:invalidate'
+
+    # Stores a response only if none of its tags was invalidated since it started loading
+    # KEYS[1]: response key, KEYS[2..n+1]: generation of each tag, KEYS[n+2..2n+1]: responses of each tag
+    # ARGV: body, etag, tags, ttl ms, generation of each tag when the response started loading
+    STORE_SCRIPT: str = '''
+        local n = (#KEYS - 1) / 2
+        for i = 1, n do
+            if (redis.call('GET', KEYS[1 + i]) or '0') ~= ARGV[4 + i] then
+                return 0
+            end
+        end
+        redis.call('HSET', KEYS[1], 'body', ARGV[1], 'etag', ARGV[2], 'tags', ARGV[3])
+        redis.call('PEXPIRE', KEYS[1], ARGV[4])
+        for i = 1, n do
+            redis.call('SADD', KEYS[1 + n + i], KEYS[1])
+            redis.call('PEXPIRE', KEYS[1 + n + i], ARGV[4])
+        end
+        return 1
+    '''
+
+    def __init__(self, max_entries: int, ttl: float, use_redis: bool = False):
+        # Maximum number of responses kept in this process
+        self.max_entries = max_entries
+        # Seconds a response is kept before it is loaded again
+        self.ttl = ttl
+        # Rendered responses by key, in least recently used order: (expires, body, etag)
+        self.entries: OrderedDict[str, tuple[float, bytes, str]] = OrderedDict()
+        # Keys of the responses that depend on each tag
+        self.tags: dict[str, set[str]] = {}
+        # Times each tag was invalidated in this process, a response loaded across an invalidation is not stored
+        self.generations: dict[str, int] = {}
+        # Times the whole local cache was cleared, after losing the invalidations of other processes
+        self.clears = 0
+        # Optional second level shared by all the server processes
+        self.redis_client = RedisPool.get_async_client() if use_redis else None
+        self.store_script = self.redis_client.register_script(self.STORE_SCRIPT) if use_redis else None
+        self.listener: asyncio.Task | None = None
+
+    @staticmethod
+    def make_etag(body: bytes) -> str:
+        return f'"{hashlib.sha1(body).hexdigest()}"'
+
+    def _store_local(self, key: str, body: bytes, etag: str, tags: tuple, ttl: float) -> None:
+        self.entries[key] = (time.monotonic() + ttl, body, etag)
+        self.entries.move_to_end(key)
+        for tag in tags:
+            self.tags.setdefault(tag, set()).add(key)
+
+        # Evict the least recently used responses
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _invalidate_local(self, tags: tuple) -> None:
+        for tag in tags:
+            self.generations[tag] = self.generations.get(tag, 0) + 1
+            for key in self.tags.pop(tag, set()):
+                self.entries.pop(key, None)
+
+    async def generation(self, tags: tuple) -> tuple:
+        """
+        Captures the generation of the given tags, to be taken before loading a response and passed to `set`.
+
+        Args:
+            tags (tuple): Tags of the data the response depends on.
+
+        Returns:
+            tuple: The local generations and, if Redis is enabled, the shared generations of the tags.
+        """
+
+        local = (self.clears, *(self.generations.get(tag, 0) for tag in tags))
+        if self.redis_client is None or not tags:
+            return local, ()
+        shared = await self.redis_client.mget([f'{self.KEY_PREFIX}:generation:{tag}' for tag in tags])
+        return local, tuple(value or '0' for value in shared)
+
+    async def get(self, key: str) -> tuple[bytes, str] | None:
+        """
+        Retrieves a cached response, first from this process and then from Redis if enabled.
+
+        Args:
+            key (str): The key of the response.
+
+        Returns:
+            tuple[bytes, str] | None: The body and ETag of the response, or None if it is not cached or expired.
+        """
+
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, body, etag = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                return body, etag
+            del self.entries[key]
+
+        if self.redis_client is not None:
+            redis_key = f'{self.KEY_PREFIX}:{key}'
+            cached, ttl = await asyncio.gather(self.redis_client.hgetall(redis_key), self.redis_client.pttl(redis_key))
+            if cached and ttl > 0:
+                body = cached['body'].encode('utf-8')
+                tags = tuple(cached['tags'].split(',')) if cached['tags'] else ()
+                # Keep it locally only for the time it has left in Redis
+                self._store_local(key, body, cached['etag'], tags, ttl / 1000)
+                return body, cached['etag']
+
+        return None
+
+    async def set(self, key: str, body: bytes, tags: tuple, generation: tuple) -> tuple[bytes, str]:
+        """
+        Caches a rendered response, unless any of its tags was invalidated while it was loading.
+
+        Args:
+            key (str): The key of the response.
+            body (bytes): The rendered body of the response.
+            tags (tuple): Tags of the data the response depends on, invalidating any of them drops the response.
+            generation (tuple): The generation of the tags taken with `generation` before the response was loaded.
+
+        Returns:
+            tuple[bytes, str]: The body and the ETag of the response, returned even if it was not stored.
+        """
+
+        etag = self.make_etag(body)
+        local, shared = generation
+        # The response may have been read before the data changed, the next request loads it again
+        if local != (self.clears, *(self.generations.get(tag, 0) for tag in tags)):
+            return body, etag
+
+        if self.redis_client is not None:
+            redis_key = f'{self.KEY_PREFIX}:{key}'
+            stored = await self.store_script(
+                keys=[redis_key, *(f'{self.KEY_PREFIX}:generation:{tag}' for tag in tags),
+                      *(f'{self.KEY_PREFIX}:tag:{tag}' for tag in tags)],
+                args=[body.decode('utf-8'), etag, ','.join(tags), int(self.ttl * 1000), *shared],
+            )
+            if not stored:
+                return body, etag
+
+        self._store_local(key, body, etag, tags, self.ttl)
+        return body, etag
+
+    async def invalidate(self, *tags: str) -> None:
+        """
+        Drops every cached response that depends on any of the given tags, in all the server processes.
+
+        Args:
+            *tags (str): The tags of the data that changed.
+
+        Returns:
+            None
+        """
+
+        self._invalidate_local(tags)
+
+        if self.redis_client is not None:
+            tag_keys = [f'{self.KEY_PREFIX}:tag:{tag}' for tag in tags]
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                # Before dropping the responses, so one still loading from the old data is not stored after
+                for tag in tags:
+                    pipe.incr(f'{self.KEY_PREFIX}:generation:{tag}')
+                for tag_key in tag_keys:
+                    pipe.smembers(tag_key)
+                members = (await pipe.execute())[len(tags):]
+            redis_keys = set().union(*members)
+            await self.redis_client.unlink(*tag_keys, *redis_keys)
+            await self.redis_client.publish(self.INVALIDATION_CHANNEL, ','.join(tags))
+
+    async def start(self) -> None:
+        if self.redis_client is not None:
+            self.listener = asyncio.create_task(self.listen())
+
+    async def stop(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+            try:
+                await self.listener
+            except asyncio.CancelledError:
+                pass
+            self.listener = None
+
+    async def listen(self) -> None:
+        # Drops the local responses invalidated by other server processes
+        while True:
+            try:
+                async with self.redis_client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.INVALIDATION_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self._invalidate_local(tuple(message['data'].split(',')))
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                # Anything cached while disconnected may be stale
+                logging.error(f'Error listening to cache invalidations: {e}')
+                self.entries.clear()
+                self.tags.clear()
+                self.clears += 1
+                await asyncio.sleep(1)
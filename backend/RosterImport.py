@@ -0,0 +1,141 @@
+# Redis
+import RedisPool
+# File Handling
+import csv
+import os
+import zipfile
+# JSON
+import json
+# Time Handling
+import time
+# Typing
+from typing import Iterator
+
+
+class ImportJob:
+    KEY_PREFIX: str = 'import:job'
+    # Seconds a finished job is kept for its status to be queried
+    TTL: int = 24 * 60 * 60
+    # Only the first errors are kept, the counters cover the rest
+    MAX_ERRORS: int = 200
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        self.key = f'{self.KEY_PREFIX}:{job_id}'
+        self.errors_key = f'{self.key}:errors'
+        self.redis_client = RedisPool.get_async_client()
+
+    async def create(self, course_id: int) -> None:
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(self.key, mapping={'course_id': course_id, 'status': 'queued', 'created_at': time.time(),
+                                         'rows': 0, 'photos': 0, 'photos_failed': 0})
+            pipe.expire(self.key, self.TTL)
+            await pipe.execute()
+
+    async def set_status(self, status: str) -> None:
+        await self.redis_client.hset(self.key, mapping={'status': status, 'updated_at': time.time()})
+
+    async def increment(self, counters: dict) -> None:
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            for counter, amount in counters.items():
+                if amount:
+                    pipe.hincrby(self.key, counter, amount)
+            pipe.hset(self.key, 'updated_at', time.time())
+            await pipe.execute()
+
+    async def add_errors(self, errors: list[dict]) -> None:
+        if not errors:
+            return
+        async with self.redis_client.pipeline(transaction=True) as pipe:
+            pipe.rpush(self.errors_key, *[json.dumps(error) for error in errors])
+            pipe.ltrim(self.errors_key, 0, self.MAX_ERRORS - 1)
+            pipe.expire(self.errors_key, self.TTL)
+            await pipe.execute()
+
+    @classmethod
+    async def get(cls, job_id: str) -> dict | None:
+        """
+        Retrieves the progress of an import job.
+
+        Args:
+            job_id (str): The ID of the job.
+
+        Returns:
+            dict | None: The status, counters and first errors of the job, or None if it does not exist or expired.
+        """
+
+        job = cls(job_id)
+        async with job.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(job.key)
+            pipe.lrange(job.errors_key, 0, -1)
+            state, errors = await pipe.execute()
+        if not state:
+            return None
+
+        status = {'job_id': job_id, 'errors': [json.loads(error) for error in errors]}
+        for field, value in state.items():
+            if field == 'status':
+                status[field] = value
+            elif field in ('created_at', 'updated_at'):
+                status[field] = float(value)
+            else:
+                status[field] = int(value)
+        return status
+
+
+def read_roster(path: str, batch_size: int) -> Iterator[list[dict]]:
+    """
+    Reads a roster CSV in batches without loading the whole file.
+
+    The file must have a header with FirstName, LastName and Email, and may have a Photo column with the name
+    of the student's photo inside the ZIP.
+
+    Args:
+        path (str): The path of the CSV file.
+        batch_size (int): The number of rows of each batch.
+
+    Yields:
+        list[dict]: The next batch of rows.
+    """
+
+    with open(path, newline='', encoding='utf-8-sig') as file:
+        batch = []
+        for row in csv.DictReader(file):
+            batch.append({field.strip(): (value or '').strip() for field, value in row.items() if field})
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def index_photos(photos: zipfile.ZipFile) -> dict[str, zipfile.ZipInfo]:
+    """
+    Indexes the photos of a ZIP by file name and by file name without extension, so they can be matched with the
+    Photo column of the roster or with the student's email.
+
+    Args:
+        photos (zipfile.ZipFile): The ZIP with the photos.
+
+    Returns:
+        dict[str, zipfile.ZipInfo]: The entry of each photo by lowercase name and stem.
+    """
+
+    index = {}
+    for info in photos.infolist():
+        name = os.path.basename(info.filename)
+        if info.is_dir() or not name or info.filename.startswith('__MACOSX/') or name.startswith('.'):
+            continue
+        index.setdefault(name.lower(), info)
+        index.setdefault(os.path.splitext(name)[0].lower(), info)
+    return index
+
+
+def find_photo(index: dict[str, zipfile.ZipInfo], row: dict) -> zipfile.ZipInfo | None:
+    # The Photo column wins, otherwise the photo is named after the email or its local part
+    email = row.get('Email', '').lower()
+    for name in (row.get('Photo', '').lower(), email, email.split('@')[0]):
+        if name and name in index:
+            return index[name]
+    return None
+
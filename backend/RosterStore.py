@@ -0,0 +1,152 @@
+# Numeric Processing
+import numpy as np
+import EmbeddingCodec
+# Hashing
+import hashlib
+# OS Handling
+import os
+import glob
+# Time Handling
+import time
+# Data Structures
+from collections import OrderedDict
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Folder with the encodings of the course rosters, shared by every server and worker process of the node
+ROSTER_STORE_DIR: str = os.getenv('ROSTER_STORE_DIR', 'models/rosters')
+# Versions of a course kept on disk, older ones may still be mapped by sessions that started before a change
+ROSTER_STORE_KEEP: int = int(os.getenv('ROSTER_STORE_KEEP', 4))
+# Seconds a version is kept after it was last used, live sessions touch theirs before sending it to the workers
+ROSTER_STORE_IDLE: float = float(os.getenv('ROSTER_STORE_IDLE', 3600))
+# Rosters kept mapped by each process
+ROSTER_STORE_OPEN: int = int(os.getenv('ROSTER_STORE_OPEN', 64))
+
+
+class RosterEmbeddings:
+    def __init__(self, path: str, ids: list[str], codes: np.ndarray, scales: np.ndarray | None):
+        # File of the encodings, what is sent to the workers instead of the encodings themselves
+        self.path = path
+        # StudentID of each row of `codes`
+        self.ids = ids
+        # Row of each StudentID
+        self.rows = {student_id: row for row, student_id in enumerate(ids)}
+        # Read-only memory map in the configured EMBEDDING_FORMAT, the pages are shared by every process that maps it
+        self.codes = codes
+        # Scale of each row when the encodings are stored as int8
+        self.scales = scales
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, student_id: str) -> bool:
+        return student_id in self.rows
+
+    def distances(self, encoding: np.ndarray) -> np.ndarray:
+        # Distance from a face encoding to every student of the roster, in row order
+        return EmbeddingCodec.distances(self.codes, self.scales, encoding)
+
+
+# Rosters mapped by this process, by path
+_open_rosters: OrderedDict[str, RosterEmbeddings] = OrderedDict()
+
+
+def write(course_id: int, encodings: dict) -> str:
+    """
+    Materializes the encodings of a course roster as a read-only NumPy file, versioned by its content.
+
+    Sessions of the same course with the same roster end up with the same file, it is only written once.
+
+    Args:
+        course_id (int): The ID of the course.
+        encodings (dict): The face encoding of each student keyed by StudentID, must not be empty.
+
+    Returns:
+        str: The path of the encodings file.
+    """
+
+    encodings = {str(student_id): encoding for student_id, encoding in encodings.items()}
+    ids = sorted(encodings)
+    codes, scales = EmbeddingCodec.encode(np.array([encodings[student_id] for student_id in ids]))
+
+    digest = hashlib.sha1(f'{EmbeddingCodec.EMBEDDING_FORMAT}:{",".join(ids)}'.encode('utf-8'))
+    digest.update(codes.tobytes())
+    version = digest.hexdigest()[:16]
+
+    folder = os.path.join(ROSTER_STORE_DIR, f'course_{course_id}')
+    path = os.path.join(folder, f'{version}.npy')
+    if os.path.exists(path):
+        # Touched so it is the newest version when pruning
+        os.utime(path)
+        return path
+
+    os.makedirs(folder, exist_ok=True)
+    # The ids and scales are written before the encodings, an encodings file always has them next to it
+    files = [(f'{path[:-4]}.ids.npy', np.array(ids, dtype=str))]
+    if scales is not None:
+        files.append((f'{path[:-4]}.scales.npy', scales))
+    files.append((path, codes))
+    for target, array in files:
+        temporary_path = f'{target}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as file:
+            np.save(file, array)
+        os.replace(temporary_path, target)
+
+    prune(folder)
+    return path
+
+
+def touch(path: str) -> None:
+    # Marks a version as in use, a session that is still running keeps its roster from being pruned
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def prune(folder: str) -> None:
+    # Unlinking a file that is mapped is safe, the mapping stays valid until it is closed, but a worker that opens
+    # the version afterwards would not find it, so only versions nobody touched within ROSTER_STORE_IDLE are removed
+    versions = [path for path in glob.glob(os.path.join(folder, '*.npy')) if os.path.basename(path).count('.') == 1]
+    mtimes = {}
+    for path in versions:
+        try:
+            mtimes[path] = os.path.getmtime(path)
+        except FileNotFoundError:
+            pass  # Pruned by another process
+    versions = sorted(mtimes, key=mtimes.get, reverse=True)
+    cutoff = time.time() - ROSTER_STORE_IDLE
+    for path in versions[ROSTER_STORE_KEEP:]:
+        if mtimes[path] > cutoff:
+            continue
+        for target in (path, f'{path[:-4]}.ids.npy', f'{path[:-4]}.scales.npy'):
+            try:
+                os.remove(target)
+            except FileNotFoundError:
+                pass
+
+
+def open_roster(path: str) -> RosterEmbeddings:
+    """
+    Maps the encodings of a course roster, reusing the mapping if this process already has it.
+
+    Args:
+        path (str): The path returned by `write`.
+
+    Returns:
+        RosterEmbeddings: The ids and the read-only mapped encodings of the roster.
+    """
+
+    roster = _open_rosters.get(path)
+    if roster is None:
+        ids = np.load(f'{path[:-4]}.ids.npy').tolist()
+        scales_path = f'{path[:-4]}.scales.npy'
+        scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        roster = RosterEmbeddings(path, ids, np.load(path, mmap_mode='r'), scales)
+        _open_rosters[path] = roster
+        while len(_open_rosters) > ROSTER_STORE_OPEN:
+            _open_rosters.popitem(last=False)
+    _open_rosters.move_to_end(path)
+    return roster
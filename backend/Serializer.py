@@ -0,0 +1,67 @@
+# JSON
+import json
+# Data Types
+from datetime import date, datetime, time
+from decimal import Decimal
+# OS Handling
+import os
+# Web Framework
+from fastapi.responses import JSONResponse
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serializer used by the API, 'orjson' or 'json', orjson falls back to json when it is not installed
+JSON_BACKEND: str = os.getenv('JSON_BACKEND', 'orjson').lower()
+USE_ORJSON: bool = JSON_BACKEND == 'orjson' and orjson is not None
+
+
+def default(value: any) -> any:
+    """
+    Converts the values that the JSON encoders do not handle on their own, mostly the ones in pyodbc rows.
+
+    Args:
+        value (any): The value to convert.
+
+    Returns:
+        any: A JSON serializable version of the value.
+    """
+
+    if isinstance(value, Decimal):
+        # SUM and AVG over integer columns come back as Decimal
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if USE_ORJSON:
+    # orjson writes dates natively and needs to be told to accept the integer keys of the students dictionaries
+    ORJSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(data: any) -> bytes:
+        return orjson.dumps(data, default=default, option=ORJSON_OPTIONS)
+
+    def loads(data: str | bytes) -> any:
+        return orjson.loads(data)
+
+else:
+    def dumps(data: any) -> bytes:
+        return json.dumps(data, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+    def loads(data: str | bytes) -> any:
+        return json.loads(data)
+
+
+class FastJSONResponse(JSONResponse):
+    # Same as JSONResponse, rendered with the configured serializer
+    def render(self, content: any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,294 @@
+# Redis
+import RedisPool
+# Asynchronous
+import asyncio
+# OS Handling
+import os
+import socket
+# Time Handling
+import time
+# logging
+import logging
+# Environment Variables
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Node this process runs on, and the address its WebSocket sessions can be reached at
+NODE_ID: str = os.getenv('NODE_ID', socket.gethostname())
+SESSION_ADVERTISED_URL: str = os.getenv('SESSION_ADVERTISED_URL', f'ws://{NODE_ID}:{os.getenv("API_SERVER_PORT", 80)}')
+# Seconds a session stays owned by a worker that stopped sending heartbeats
+SESSION_LEASE_TTL: float = float(os.getenv('SESSION_LEASE_TTL', 15))
+# Seconds between heartbeats, must be well below the lease
+SESSION_HEARTBEAT_INTERVAL: float = float(os.getenv('SESSION_HEARTBEAT_INTERVAL', 5))
+# Seconds the data of a session without owner is kept for a reconnect before it is dropped
+SESSION_RESUME_WINDOW: float = float(os.getenv('SESSION_RESUME_WINDOW', 300))
+
+
+class SessionOwned(Exception):
+    def __init__(self, owner: dict):
+        super().__init__(f'Session owned by {owner.get("worker")}')
+        # Owner hash of the session: worker, node, url, epoch, since
+        self.owner = owner
+
+
+class SessionLease:
+    def __init__(self, namespace: str, worker: str, epoch: int, resumed: bool):
+        self.namespace = namespace
+        # Worker that holds the lease
+        self.worker = worker
+        # Fencing token, every acquisition gets a new one and only its holder can renew or release the lease
+        self.epoch = epoch
+        # Whether the namespace already had data, left by a previous owner of the session
+        self.resumed = resumed
+        # Set when a heartbeat finds that another worker took the session over
+        self.lost = False
+        self.renewed_at = time.monotonic()
+
+    def valid(self) -> bool:
+        # A lease that could not be renewed in time may already belong to another worker
+        return not self.lost and time.monotonic() - self.renewed_at < SESSION_LEASE_TTL
+
+    def fence(self) -> tuple[list, list]:
+        # Keys and arguments of the scripts that only write while the session still has this owner and epoch
+        return [SessionRegistry.owner_key(self.namespace)], [self.worker, self.epoch]
+
+
+class SessionRegistry:
+    # Sorted set with the namespace of every session, scored by the expiry of its lease in milliseconds
+    ACTIVE_KEY: str = 'session:active'
+    # Counter the fencing tokens are taken from, never expires so tokens are never reused
+    EPOCH_KEY: str = 'session:epoch'
+    # Prefix of the hash each live worker refreshes with its heartbeat
+    WORKER_PREFIX: str = 'session:worker:'
+
+    # Takes the ownership of a session if it is free, its owner stopped sending heartbeats, its owner handed it off,
+    # or a takeover was requested.
+    # KEYS[1]: owner hash of the session, KEYS[2]: active sessions, KEYS[3]: epoch counter
+    # ARGV: worker id, node, url, lease ms, now ms, namespace, worker key prefix, takeover flag
+    ACQUIRE_SCRIPT: str = '''
+        local owner = redis.call('HGET', KEYS[1], 'worker')
+        if owner and owner ~= ARGV[1] and ARGV[8] ~= '1' then
+            local alive = redis.call('EXISTS', ARGV[7] .. owner) == 1
+            if alive and redis.call('HGET', KEYS[1], 'draining') ~= '1' then
+                return {0, 0, 0}
+            end
+        end
+        local epoch = redis.call('INCR', KEYS[3])
+        redis.call('HSET', KEYS[1], 'worker', ARGV[1], 'node', ARGV[2], 'url', ARGV[3], 'epoch', epoch,
+                   'draining', '0', 'since', ARGV[5])
+        redis.call('PEXPIRE', KEYS[1], ARGV[4])
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[5]) + tonumber(ARGV[4]), ARGV[6])
+        return {1, epoch, redis.call('EXISTS', ARGV[6] .. ':students')}
+    '''
+
+    # Extends the lease if it is still held with the same fencing token
+    # KEYS[1]: owner hash of the session, KEYS[2]: active sessions
+    # ARGV: worker id, epoch, lease ms, now ms, namespace
+    RENEW_SCRIPT: str = '''
+        if redis.call('HGET', KEYS[1], 'worker') ~= ARGV[1] or redis.call('HGET', KEYS[1], 'epoch') ~= ARGV[2] then
+            return 0
+        end
+        redis.call('PEXPIRE', KEYS[1], ARGV[3])
+        redis.call('ZADD', KEYS[2], tonumber(ARGV[4]) + tonumber(ARGV[3]), ARGV[5])
+        return 1
+    '''
+
+    # Ends the session, or hands it off so any worker can take it over right away
+    # KEYS[1]: owner hash of the session, KEYS[2]: active sessions
+    # ARGV: worker id, epoch, handoff flag, now ms, namespace
+    RELEASE_SCRIPT: str = '''
+        if redis.call('HGET', KEYS[1], 'worker') ~= ARGV[1] or redis.call('HGET', KEYS[1], 'epoch') ~= ARGV[2] then
+            return 0
+        end
+        if ARGV[3] == '1' then
+            redis.call('HSET', KEYS[1], 'draining', '1')
+            redis.call('ZADD', KEYS[2], ARGV[4], ARGV[5])
+        else
+            redis.call('DEL', KEYS[1])
+            redis.call('ZREM', KEYS[2], ARGV[5])
+        end
+        return 1
+    '''
+
+    def __init__(self, node: str = NODE_ID, url: str = SESSION_ADVERTISED_URL):
+        self.redis_client = RedisPool.get_async_client()
+        self.node = node
+        self.url = url
+        # Every uvicorn worker is its own owner, even on the same node
+        self.worker_id = f'{node}:{os.getpid()}'
+        self.worker_key = f'{self.WORKER_PREFIX}{self.worker_id}'
+        # Leases held by this process, by namespace
+        self.leases: dict[str, SessionLease] = {}
+        self.started = time.time()
+        self.acquire_script = self.redis_client.register_script(self.ACQUIRE_SCRIPT)
+        self.renew_script = self.redis_client.register_script(self.RENEW_SCRIPT)
+        self.release_script = self.redis_client.register_script(self.RELEASE_SCRIPT)
+        self.heartbeat: asyncio.Task | None = None
+
+    @staticmethod
+    def owner_key(namespace: str) -> str:
+        return f'{namespace}:owner'
+
+    async def start(self, on_abandoned) -> None:
+        # `on_abandoned` drops the data of a session no worker resumed within the resume window
+        await self.beat()
+        self.heartbeat = asyncio.create_task(self.beat_periodically(on_abandoned))
+
+    async def stop(self) -> None:
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+            try:
+                await self.heartbeat
+            except asyncio.CancelledError:
+                pass
+            self.heartbeat = None
+        # Sessions still held are handed off, another worker can resume them without waiting for the lease
+        for lease in list(self.leases.values()):
+            await self.release(lease, handoff=True)
+        await self.redis_client.delete(self.worker_key)
+
+    async def acquire(self, namespace: str, takeover: bool = False) -> SessionLease:
+        """
+        Takes the ownership of a session for this worker.
+
+        Args:
+            namespace (str): The namespace of the session.
+            takeover (bool): Whether to take the session from a live owner, the previous owner stops processing
+                it at its next heartbeat.
+
+        Returns:
+            SessionLease: The lease of the session.
+
+        Raises:
+            SessionOwned: If another live worker owns the session and no takeover was requested.
+        """
+
+        acquired, epoch, resumed = await self.acquire_script(
+            keys=[self.owner_key(namespace), self.ACTIVE_KEY, self.EPOCH_KEY],
+            args=[self.worker_id, self.node, self.url, int(SESSION_LEASE_TTL * 1000), int(time.time() * 1000),
+                  namespace, self.WORKER_PREFIX, int(takeover)],
+        )
+        if not acquired:
+            raise SessionOwned(await self.redis_client.hgetall(self.owner_key(namespace)))
+
+        # A lease this process held for the same session belongs to a connection that was replaced
+        previous = self.leases.get(namespace)
+        if previous is not None:
+            previous.lost = True
+
+        lease = SessionLease(namespace, self.worker_id, int(epoch), bool(resumed))
+        self.leases[namespace] = lease
+        return lease
+
+    async def release(self, lease: SessionLease, handoff: bool = False) -> None:
+        """
+        Gives up the ownership of a session.
+
+        Args:
+            lease (SessionLease): The lease returned by `acquire`.
+            handoff (bool): Whether the session continues elsewhere, its data is kept for the next owner.
+
+        Returns:
+            None
+        """
+
+        if self.leases.get(lease.namespace) is lease:
+            del self.leases[lease.namespace]
+        if lease.lost:
+            return
+        lease.lost = True
+        await self.release_script(
+            keys=[self.owner_key(lease.namespace), self.ACTIVE_KEY],
+            args=[self.worker_id, lease.epoch, int(handoff), int(time.time() * 1000), lease.namespace],
+        )
+
+    async def beat(self) -> None:
+        # Worker heartbeat, a worker whose key expired is treated as dead and its sessions can be taken over
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hset(self.worker_key, mapping={
+                'node': self.node, 'url': self.url, 'pid': os.getpid(),
+                'sessions': len(self.leases), 'started': int(self.started),
+            })
+            pipe.pexpire(self.worker_key, int(SESSION_LEASE_TTL * 1000))
+            await pipe.execute()
+
+        now = int(time.time() * 1000)
+        for lease in list(self.leases.values()):
+            renewed = await self.renew_script(
+                keys=[self.owner_key(lease.namespace), self.ACTIVE_KEY],
+                args=[self.worker_id, lease.epoch, int(SESSION_LEASE_TTL * 1000), now, lease.namespace],
+            )
+            if renewed:
+                lease.renewed_at = time.monotonic()
+            else:
+                logging.info(f'Session {lease.namespace} was taken over by another worker')
+                lease.lost = True
+                self.leases.pop(lease.namespace, None)
+
+    async def abandoned(self) -> list[str]:
+        # Sessions whose lease expired longer than the resume window ago, each one is claimed by a single worker
+        cutoff = int((time.time() - SESSION_RESUME_WINDOW) * 1000)
+        claimed = []
+        for namespace in await self.redis_client.zrangebyscore(self.ACTIVE_KEY, '-inf', cutoff):
+            if await self.redis_client.zrem(self.ACTIVE_KEY, namespace) and \
+                    not await self.redis_client.exists(self.owner_key(namespace)):
+                claimed.append(namespace)
+        return claimed
+
+    async def beat_periodically(self, on_abandoned) -> None:
+        while True:
+            await asyncio.sleep(SESSION_HEARTBEAT_INTERVAL)
+            try:
+                await self.beat()
+                for namespace in await self.abandoned():
+                    logging.info(f'Dropping abandoned session {namespace}')
+                    await on_abandoned(namespace)
+            except Exception as e:
+                logging.error(f'Error sending the session heartbeat: {e}')
+
+    async def workers(self) -> list[dict]:
+        workers = []
+        async for key in self.redis_client.scan_iter(f'{self.WORKER_PREFIX}*'):
+            worker = await self.redis_client.hgetall(key)
+            if worker:
+                workers.append({'worker': key[len(self.WORKER_PREFIX):], **worker})
+        return workers
+
+    async def sessions(self) -> list[dict]:
+        # Every session with data in Redis, the ones without owner can be resumed by any worker
+        sessions = []
+        for namespace, expiry in await self.redis_client.zrange(self.ACTIVE_KEY, 0, -1, withscores=True):
+            owner = await self.redis_client.hgetall(self.owner_key(namespace))
+            sessions.append({'namespace': namespace, 'owner': owner or None, 'lease_expiry': int(expiry)})
+        return sessions
+
+    async def describe(self, namespace: str) -> dict | None:
+        """
+        Describes a session, from any worker.
+
+        Args:
+            namespace (str): The namespace of the session.
+
+        Returns:
+            dict | None: The owner of the session, and the assistance and participations of its students,
+                or None if the session has no data.
+        """
+
+        owner = await self.redis_client.hgetall(self.owner_key(namespace))
+        student_ids = sorted(await self.redis_client.smembers(f'{namespace}:students'))
+        if not owner and not student_ids:
+            return None
+
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for student_id in student_ids:
+                pipe.hmget(f'{namespace}:student:{student_id}', 'assistance', 'participation_counter')
+            pipe.hgetall(f'{namespace}:visitors')
+            replies = await pipe.execute()
+
+        students = [
+            {'StudentID': student_id, 'assistance': assistance == 'true', 'participation_counter': int(counter or 0)}
+            for student_id, (assistance, counter) in zip(student_ids, replies[:-1])
+        ]
+        visitors = {visitor_id: int(counter) for visitor_id, counter in replies[-1].items()}
+        return {'namespace': namespace, 'owner': owner or None, 'students': students, 'visitors': visitors}
@@ -0,0 +1,47 @@
+# Measures the throughput of the blob storage client, meant to run against the Azurite emulator
+# Correr en terminal (desde backend/): AZURE_STORAGE_EMULATOR=true python3 -m benchmarks.blob_upload [--blobs 200] [--size-kb 2048]
+import argparse
+import asyncio
+import os
+import time
+
+from BlobStorage import BlobStorage, BLOB_MAX_CONCURRENCY
+
+
+async def main(blobs: int, size_kb: int, container_name: str) -> None:
+    storage = BlobStorage(os.getenv('AZURE_STORAGE_CONNECTION_STRING'), container_name)
+    await storage.start()
+    data = os.urandom(size_kb * 1024)
+    names = [f'benchmark-{index}' for index in range(blobs)]
+
+    try:
+        # Every operation is timed while all of them compete for the client's concurrency limit
+        async def timed(operation, *args) -> float:
+            start = time.perf_counter()
+            await operation(*args)
+            return time.perf_counter() - start
+
+        # Blobs left by an interrupted run are replaced
+        for label, operation, args in (('upload', storage.upload, (data, True)), ('delete', storage.delete, ())):
+            start = time.perf_counter()
+            latencies = sorted(await asyncio.gather(*(timed(operation, name, *args) for name in names)))
+            elapsed = time.perf_counter() - start
+
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)] * 1000
+            throughput = f', {blobs * size_kb / 1024 / elapsed:.1f} MB/s' if label == 'upload' else ''
+            print(f'{label:<8} {blobs / elapsed:8.1f} ops/s{throughput}, p50 {p50:.1f} ms, p99 {p99:.1f} ms')
+    finally:
+        await storage.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the blob storage client')
+    parser.add_argument('--blobs', type=int, default=200, help='Blobs uploaded and then deleted')
+    parser.add_argument('--size-kb', type=int, default=2048, help='Size of each blob in KB')
+    parser.add_argument('--container', default=os.getenv('AZURE_STORAGE_CONTAINER_NAME', 'benchmark'),
+                        help='Container used for the benchmark')
+    args = parser.parse_args()
+
+    print(f'{args.blobs} blobs of {args.size_kb} KB, {BLOB_MAX_CONCURRENCY} operations at a time')
+    asyncio.run(main(args.blobs, args.size_kb, args.container))
@@ -0,0 +1,80 @@
+# Login latency under a burst of concurrent logins, and how much each approach delays the event loop
+# Correr en terminal (desde backend/): python3 -m benchmarks.login_latency [--logins 200] [--concurrency 50]
+import argparse
+import asyncio
+import time
+
+from passlib.hash import argon2
+
+from PasswordHasher import ARGON2_PARAMS, HasherOverloaded, PasswordHasher
+
+FRAME_INTERVAL = 1 / 30  # A live session handles a frame about every 33 ms
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+async def frame_loop(lags: list[float], stop: asyncio.Event) -> None:
+    # Stands in for the websocket sessions, records how late each frame tick runs
+    while not stop.is_set():
+        expected = time.perf_counter() + FRAME_INTERVAL
+        await asyncio.sleep(FRAME_INTERVAL)
+        lags.append(max(time.perf_counter() - expected, 0.0))
+
+
+async def run(label: str, verify, logins: int, concurrency: int) -> None:
+    password = 'contraseña-de-prueba'
+    password_hash = argon2.using(**ARGON2_PARAMS).hash(password) if ARGON2_PARAMS else argon2.hash(password)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, lags, rejected = [], [], 0
+    stop = asyncio.Event()
+
+    async def login() -> None:
+        nonlocal rejected
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await verify(password, password_hash)
+                latencies.append(time.perf_counter() - start)
+            except HasherOverloaded:
+                rejected += 1
+
+    ticker = asyncio.create_task(frame_loop(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(login() for _ in range(logins)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker
+
+    print(f'{label:<10} {len(latencies) / elapsed:7.1f} logins/s, p50 {percentile(latencies, 0.5) * 1000:7.1f} ms, '
+          f'p99 {percentile(latencies, 0.99) * 1000:7.1f} ms, rejected {rejected}, '
+          f'frame lag p99 {percentile(lags, 0.99) * 1000:7.1f} ms, max {max(lags, default=0) * 1000:7.1f} ms')
+
+
+async def main(logins: int, concurrency: int, workers: int, queue: int) -> None:
+    print(f'{logins} logins, {concurrency} at a time, argon2 params {ARGON2_PARAMS or "passlib defaults"}')
+
+    # The previous path, verifying on the event loop
+    async def inline_verify(password: str, password_hash: str) -> bool:
+        return argon2.verify(password, password_hash)
+
+    await run('inline', inline_verify, logins, concurrency)
+
+    hasher = PasswordHasher(max_workers=workers, max_queue=queue)
+    try:
+        await run('pool', hasher.verify, logins, concurrency)
+    finally:
+        hasher.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the login latency under concurrent load')
+    parser.add_argument('--logins', type=int, default=200, help='Total logins')
+    parser.add_argument('--concurrency', type=int, default=50, help='Logins in flight at the same time')
+    parser.add_argument('--workers', type=int, default=2, help='Hashing pool workers')
+    parser.add_argument('--queue', type=int, default=32, help='Hashing pool queue depth')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.logins, args.concurrency, args.workers, args.queue))
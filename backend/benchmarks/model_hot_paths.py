@@ -0,0 +1,269 @@
+# Micro-benchmarks of the Model detection hot paths, with synthetic poses and rosters, no camera or services needed
+# Correr en terminal (desde backend/):
+#   python3 -m benchmarks.model_hot_paths [--people 1,10,50,150] [--rosters 10,50,150,500] [--galleries 1000,50000]
+#                                         [--json resultados.json]
+import argparse
+import asyncio
+import inspect
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+
+os.environ.setdefault('ROSTER_STORE_DIR', os.path.join(tempfile.gettempdir(), 'bench_rosters'))
+
+import EmbeddingCodec
+import RedisPool
+import RosterStore
+from Detection import Detection
+from FaceGallery import FaceGallery
+
+WIDTH, HEIGHT = 1920, 1080
+# One in every RAISED_EVERY people has the left arm raised
+RAISED_EVERY = 4
+
+
+class LocalRedis:
+    # Stands in for the Redis client, only the commands used by the detection paths
+    def __init__(self, *_, **__):
+        self.hashes: dict[str, dict] = {}
+
+    def register_script(self, _):
+        return None
+
+    async def hget(self, key: str, field: str):
+        return self.hashes.get(key, {}).get(field)
+
+    async def hset(self, key: str, field: str, value: str) -> None:
+        self.hashes.setdefault(key, {})[field] = value
+
+    async def hincrby(self, key: str, field: str, amount: int) -> None:
+        values = self.hashes.setdefault(key, {})
+        values[field] = str(int(values.get(field, 0)) + amount)
+
+
+class LocalInference:
+    # Stands in for the inference service, returns a fixed face encoding so only the matching is measured
+    def __init__(self, encoding: np.ndarray):
+        self.encoding = encoding
+
+    async def encode_face(self, *_) -> np.ndarray:
+        return self.encoding
+
+
+RedisPool.get_async_client = LocalRedis
+
+from Model import Model  # noqa: E402
+
+
+def make_people(count: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Builds the keypoints and boxes YOLO would report for people seated in a grid.
+
+    Args:
+        count (int): The number of people.
+
+    Returns:
+        tuple[torch.Tensor, torch.Tensor]: The poses (people x 11 x [x, y, confidence]) and the boxes
+            (people x [x_min, y_min, x_max, y_max, confidence, class]).
+    """
+
+    columns = math.ceil(math.sqrt(count * WIDTH / HEIGHT))
+    rows = math.ceil(count / columns)
+    width, height = WIDTH / columns, HEIGHT / rows
+    scale = min(width, height) / 300
+
+    poses = np.zeros((count, 11, 3), dtype=np.float32)
+    boxes = np.zeros((count, 6), dtype=np.float32)
+    for person in range(count):
+        x0, y0 = (person % columns) * width, (person // columns) * height
+        cx, top = x0 + width / 2, y0 + height * 0.3
+
+        def point(dx: float, dy: float) -> tuple:
+            return cx + dx * scale, top + dy * scale, 0.9
+
+        keypoints = [
+            point(0, 40), point(10, 35), point(-10, 35), point(20, 40), point(-20, 40),  # Face
+            point(20, 80), point(-20, 80),  # Shoulders
+        ]
+        if person % RAISED_EVERY == 0:
+            # Left arm straight up, above the face
+            keypoints += [point(30, 30), point(-25, 140), point(40, -20), point(-25, 200)]
+        else:
+            keypoints += [point(25, 140), point(-25, 140), point(25, 200), point(-25, 200)]
+        poses[person] = keypoints
+        boxes[person] = (x0 + 5, y0 + 5, x0 + width - 5, y0 + height - 5, 0.9, 0)
+
+    return torch.from_numpy(poses), torch.from_numpy(boxes)
+
+
+def make_model(encoding: np.ndarray) -> Model:
+    # The stand-in inference service keeps the model from loading YOLO
+    return Model(course_id=0, session_count=0, inference=LocalInference(encoding))
+
+
+def make_roster(size: int, seed: int = 0) -> RosterStore.RosterEmbeddings:
+    rng = np.random.default_rng(seed)
+    encodings = {student_id: rng.normal(0, 0.1, 128) for student_id in range(1, size + 1)}
+    return RosterStore.open_roster(RosterStore.write(size, encodings))
+
+
+def make_gallery(size: int, seed: int = 0) -> tuple[FaceGallery, np.ndarray]:
+    # A gallery of the whole institution in a temporary file, with the encodings it was built from
+    rng = np.random.default_rng(seed)
+    encodings = rng.normal(0, 0.1, (size, 128))
+    gallery = FaceGallery(path=os.path.join(tempfile.mkdtemp(), 'face_gallery.bin'), max_elements=size)
+    gallery.add(dict(zip(range(1, size + 1), encodings)))
+    return gallery, encodings
+
+
+def roster_encoding(roster: RosterStore.RosterEmbeddings, row: int) -> np.ndarray:
+    # The stored encoding of a student, as the live encoding of their face
+    scales = None if roster.scales is None else roster.scales[row:row + 1]
+    return EmbeddingCodec.decode(roster.codes[row:row + 1], scales)[0].astype(np.float64)
+
+
+async def measure(call, min_time: float, allocation_calls: int) -> dict:
+    """
+    Measures the throughput and the allocations of a call.
+
+    Args:
+        call (Callable): The function to measure, its result is awaited if it is awaitable.
+        min_time (float): Seconds the throughput is measured for.
+        allocation_calls (int): Calls traced to measure the allocations.
+
+    Returns:
+        dict: The operations per second, the peak memory traced and the memory retained per call.
+    """
+
+    # Warm up
+    for _ in range(3):
+        result = call()
+        if inspect.isawaitable(result):
+            await result
+
+    calls, start = 0, time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        result = call()
+        if inspect.isawaitable(result):
+            await result
+        calls += 1
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for _ in range(allocation_calls):
+        result = call()
+        if inspect.isawaitable(result):
+            await result
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'ops_per_second': calls / elapsed,
+        'peak_kib': (peak - before) / 1024,
+        'retained_bytes_per_call': (after - before) / allocation_calls,
+    }
+
+
+async def main(people_counts: list[int], roster_sizes: list[int], gallery_sizes: list[int], min_time: float,
+               allocation_calls: int) -> list:
+    results = []
+
+    async def run(name: str, case: str, call) -> None:
+        result = {'name': name, 'case': case, **await measure(call, min_time, allocation_calls)}
+        results.append(result)
+        print(f"{name:<24} {case:<16} {result['ops_per_second']:>12,.0f} ops/s  peak {result['peak_kib']:>9.1f} KiB  "
+              f"retained {result['retained_bytes_per_call']:>8.0f} B/call")
+
+    frame = np.zeros((HEIGHT, WIDTH, 3), dtype=np.uint8)
+    roster = make_roster(max(roster_sizes))
+
+    for count in people_counts:
+        poses, boxes = make_people(count)
+        model = make_model(roster_encoding(roster, 0))
+        model.roster = roster
+        keypoints = [keypoint for pose in poses for keypoint in pose]
+        faces = [{name: model.get_keypoint(pose[index]) for index, name in enumerate(
+            ('nose', 'left_eye', 'right_eye', 'left_ear', 'right_ear'))} for pose in poses]
+        arms = [({'shoulder': model.get_keypoint(pose[5]), 'elbow': model.get_keypoint(pose[7]),
+                  'wrist': model.get_keypoint(pose[9])}, model.get_face_center(face)) for pose, face in zip(poses, faces)]
+        bboxes = [tuple(int(value) for value in box[:4]) for box in boxes]
+        case = f'{count} people'
+
+        await run('get_keypoint', case, lambda: [model.get_keypoint(keypoint) for keypoint in keypoints])
+        await run('get_face_center', case, lambda: [model.get_face_center(face) for face in faces])
+        await run('is_arm_raised', case, lambda: [model.is_arm_raised(arm, center, 'left') for arm, center in arms])
+
+        # Everyone is already tracked, the worst case of the linear scan
+        model.active_detections = {
+            str(index): Detection(bbox, ((bbox[0] + bbox[2]) // 2, (bbox[1] + bbox[3]) // 2), (None, None), 0)
+            for index, bbox in enumerate(bboxes)
+        }
+        await run('check_for_detection', case, lambda: [model.check_for_detection(bbox) for bbox in bboxes])
+        await run('cleanup', case, model.cleanup)
+
+        # A whole frame, with the detections kept between frames as in a session
+        model.active_detections = {}
+        model.model_detections = {'poses': poses, 'boxes': boxes}
+
+        async def process_frame() -> None:
+            model.frame_count += 1
+            await model.iterate_over_detections(frame=frame)
+            model.cleanup()
+
+        await run('iterate_over_detections', case, process_frame)
+
+    for size in roster_sizes:
+        sized_roster = make_roster(size)
+        detection = Detection((100, 100, 400, 500), (250, 300), (250, 200), 0)
+        case = f'{size} students'
+
+        # A student of the course raises their arm
+        model = make_model(roster_encoding(sized_roster, size // 2))
+        model.roster = sized_roster
+        await run('face_rec_scan match', case, lambda: model.face_rec_scan(frame, detection))
+
+        # Someone who is not in the course, without gallery
+        stranger = make_model(np.full(128, 0.5))
+        stranger.roster = sized_roster
+        await run('face_rec_scan no match', case, lambda: stranger.face_rec_scan(frame, detection))
+
+    for size in gallery_sizes:
+        # Exhaustive with numpy when hnswlib is not installed, the case shows what that costs
+        gallery, encodings = make_gallery(size)
+        case = f'{size} identities'
+
+        # A student from another section, and someone who is not in the institution
+        await run('gallery nearest match', case, lambda: gallery.nearest(encodings[size // 2]))
+        await run('gallery nearest no match', case, lambda: gallery.nearest(np.full(128, 0.5)))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Model detection hot paths')
+    parser.add_argument('--people', default='1,10,50,150', help='People per frame, comma separated')
+    parser.add_argument('--rosters', default='10,50,150,500', help='Students per roster, comma separated')
+    parser.add_argument('--galleries', default='1000,50000', help='Identities per face gallery, comma separated')
+    parser.add_argument('--min-time', type=float, default=0.5, help='Seconds each case is measured for')
+    parser.add_argument('--allocation-calls', type=int, default=50, help='Calls traced for the allocations')
+    parser.add_argument('--json', help='Write the results to a JSON file')
+    args = parser.parse_args()
+
+    # The detection paths log every event, the benchmark measures the logic
+    logging.disable(logging.WARNING)
+    results = asyncio.run(main([int(count) for count in args.people.split(',')],
+                               [int(size) for size in args.rosters.split(',')],
+                               [int(size) for size in args.galleries.split(',')],
+                               args.min_time, args.allocation_calls))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,84 @@
+# Compares the standard library JSON path with the configured serializer on typical payloads
+# Correr en terminal (desde backend/): python3 -m benchmarks.serialization [--rows 500] [--repeat 200]
+import argparse
+import json
+import timeit
+from datetime import date, timedelta
+from decimal import Decimal
+
+from fastapi.responses import JSONResponse
+
+import Serializer
+
+
+def roster_payload(rows: int) -> dict:
+    # Shape of /courses/{course_id}/students and of the websocket hello message
+    students = [
+        {
+            'StudentID': student_id,
+            'FirstName': f'Nombre{student_id}',
+            'LastName': f'Apellido{student_id}',
+            'RoleID': 1,
+            'Email': f'a{student_id:08d}@tec.mx',
+        }
+        for student_id in range(1, rows + 1)
+    ]
+    return {'success': True, 'data': students}
+
+
+def analytics_payload(rows: int) -> dict:
+    # Shape of /dateranges, dates and SUM() totals straight from pyodbc rows
+    start = date(2024, 1, 8)
+    totals = [
+        {
+            'Date': start + timedelta(days=day),
+            'AssistanceCount': Decimal(day % 40),
+            'ParticipationCount': Decimal(day % 17),
+        }
+        for day in range(rows)
+    ]
+    return {'success': True, 'data': totals}
+
+
+def plain_values(payload: dict) -> dict:
+    # Dates and Decimals converted ahead of time, JSONResponse cannot encode them and the conversion is not timed
+    return json.loads(json.dumps(payload, default=Serializer.default))
+
+
+def stdlib_render(payload: dict) -> bytes:
+    # Plain JSONResponse with the standard encoder, given values it can encode
+    return JSONResponse(content=payload).body
+
+
+def fast_render(payload: dict) -> bytes:
+    return Serializer.FastJSONResponse(content=payload).body
+
+
+def measure(name: str, function, payload, repeat: int) -> float:
+    seconds = min(timeit.repeat(lambda: function(payload), number=repeat, repeat=5)) / repeat
+    print(f'{name:<40} {seconds * 1e6:>10.1f} us/op')
+    return seconds
+
+
+def main(rows: int, repeat: int) -> None:
+    print(f'Serializer: {"orjson" if Serializer.USE_ORJSON else "json"}, {rows} rows, {repeat} iterations')
+
+    # The Serializer gets the rows as they come from pyodbc, the baseline gets them already converted
+    for label, payload in (('roster', roster_payload(rows)), ('analytics', analytics_payload(rows))):
+        baseline = measure(f'{label} response (stdlib)', stdlib_render, plain_values(payload), repeat)
+        fast = measure(f'{label} response (Serializer)', fast_render, payload, repeat)
+        print(f'{"":<40} {baseline / fast:>10.1f}x')
+
+    message = json.dumps({'students': roster_payload(rows)['data'], 'date': '2024-01-08'})
+    baseline = measure('websocket hello parsing (json.loads)', json.loads, message, repeat)
+    fast = measure('websocket hello parsing (Serializer)', Serializer.loads, message, repeat)
+    print(f'{"":<40} {baseline / fast:>10.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the JSON serialization of the API responses')
+    parser.add_argument('--rows', type=int, default=500, help='Rows in each payload')
+    parser.add_argument('--repeat', type=int, default=200, help='Iterations per measurement')
+    args = parser.parse_args()
+
+    main(args.rows, args.repeat)
@@ -0,0 +1,244 @@
+# Replays a recorded class through the real WebSocket pipeline, with local stand-ins for SQL and Redis
+# Correr en terminal (desde backend/, con pip3 install -r benchmarks/requirements.txt):
+#   python3 -m benchmarks.session_replay --video clase.mp4 --fps 10 --sessions 4 --save benchmarks/baselines/clase.json
+#   python3 -m benchmarks.session_replay --video clase.mp4 --fps 10 --sessions 4 --compare benchmarks/baselines/clase.json
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2 as cv
+import fakeredis
+import numpy as np
+import uvicorn
+import websockets
+
+# The server reads its settings when it is imported
+os.environ.setdefault('API_SERVER_PORT', '8000')
+os.environ['SESSION_FRAME_ACK'] = 'true'
+os.environ.setdefault('ROSTER_STORE_DIR', os.path.join(tempfile.gettempdir(), 'replay_rosters'))
+os.environ.setdefault('FACE_GALLERY_PATH', os.path.join(tempfile.gettempdir(), 'replay_gallery.bin'))
+
+import RedisPool
+
+# Every client, async or sync, talks to the same in-memory Redis
+fake_server = fakeredis.FakeServer()
+RedisPool.get_async_client = lambda: fakeredis.aioredis.FakeRedis(server=fake_server, decode_responses=True)
+RedisPool.get_sync_client = lambda: fakeredis.FakeRedis(server=fake_server, decode_responses=True)
+
+import server  # noqa: E402
+
+COURSE_ID = 1
+DATE = '2024-01-01'
+
+
+class LocalDatabase:
+    # Stands in for the SQL database, the roster encodings are cached so no query needs a result
+    def __init__(self):
+        self.calls = Counter()
+
+    async def run(self, work, *args) -> dict:
+        self.calls[work.__name__] += 1
+        return {}
+
+    def close(self) -> None:
+        pass
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)] if values else 0.0
+
+
+def load_frames(video: str | None, fps: float, seconds: float, quality: int) -> list[bytes]:
+    # JPEG frames at the replay rate, encoded up front so the client does not compete with the server for CPU
+    count = int(fps * seconds)
+    params = [cv.IMWRITE_JPEG_QUALITY, quality]
+    if video is None:
+        # Noise frames, exercise the decode and inference path without anyone in them
+        rng = np.random.default_rng(0)
+        frame = rng.integers(0, 255, (720, 1280, 3), dtype=np.uint8)
+        return [cv.imencode('.jpg', frame, params)[1].tobytes()] * count
+
+    capture = cv.VideoCapture(video)
+    step = (capture.get(cv.CAP_PROP_FPS) or fps) / fps
+    frames, index, next_index = [], 0, 0.0
+    while len(frames) < count:
+        ok, frame = capture.read()
+        if not ok:
+            break
+        if index >= next_index:
+            frames.append(cv.imencode('.jpg', frame, params)[1].tobytes())
+            next_index += step
+        index += 1
+    capture.release()
+    if not frames:
+        raise SystemExit(f'No frames could be read from {video}')
+    # Short videos are looped to fill the replay
+    return [frames[i % len(frames)] for i in range(count)]
+
+
+def roster_hello(students: int) -> str:
+    return json.dumps({'date': DATE, 'students': [
+        {'StudentID': student_id, 'FirstName': 'Estudiante', 'LastName': str(student_id),
+         'Email': f'estudiante{student_id}@replay.local'}
+        for student_id in range(1, students + 1)
+    ]})
+
+
+async def replay(port: int, session_count: int, frames: list[bytes], hello: str, fps: float,
+                 max_in_flight: int) -> dict:
+    sent_at, latencies = deque(), []
+    sent, dropped = 0, 0
+
+    async with websockets.connect(f'ws://127.0.0.1:{port}/ws/{COURSE_ID}/{session_count}', max_size=None) as ws:
+        await ws.send(hello)
+
+        async def receive_acks() -> None:
+            async for message in ws:
+                if json.loads(message).get('ack') and sent_at:
+                    latencies.append(time.perf_counter() - sent_at.popleft())
+
+        receiver = asyncio.create_task(receive_acks())
+        start = time.perf_counter()
+        for index, frame in enumerate(frames):
+            delay = start + index / fps - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # A camera does not wait for the server, frames captured while it is behind are lost
+            if len(sent_at) >= max_in_flight:
+                dropped += 1
+                continue
+            sent_at.append(time.perf_counter())
+            await ws.send(frame)
+            sent += 1
+
+        # Wait for the frames still in flight
+        deadline = time.perf_counter() + 30
+        while sent_at and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+        receiver.cancel()
+
+    return {'sent': sent, 'dropped': dropped, 'acked': len(latencies), 'elapsed': elapsed, 'latencies': latencies}
+
+
+async def main(args: argparse.Namespace) -> dict:
+    frames = load_frames(args.video, args.fps, args.seconds, args.quality)
+    hello = roster_hello(args.students)
+
+    server.db = LocalDatabase()
+    # Threads instead of processes, they share the in-memory Redis
+    assistance_executor = ThreadPoolExecutor(max_workers=server.ASSISTANCE_WORKERS)
+    server.get_assistance_executor = lambda: assistance_executor
+    if args.assistance_interval is not None:
+        server.ASSISTANCE_TIME_LIMIT = args.assistance_interval
+
+    # Roster encodings are already cached, as after a roster import
+    rng = np.random.default_rng(1)
+    await server.encoding_cache.set_many({
+        student_id: rng.normal(0, 0.1, 128) for student_id in range(1, args.students + 1)
+    })
+    await server.session_registry.start(server.drop_abandoned_session)
+    await server.outbox.start()
+    if server.inference_service is not None:
+        await server.inference_service.start()
+
+    config = uvicorn.Config(server.app, host='127.0.0.1', port=args.port, lifespan='off', log_level='warning')
+    uvicorn_server = uvicorn.Server(config)
+    serving = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        await asyncio.sleep(0.05)
+
+    try:
+        sessions = await asyncio.gather(*(
+            replay(args.port, session_count, frames, hello, args.fps, args.max_in_flight)
+            for session_count in range(1, args.sessions + 1)
+        ))
+    finally:
+        uvicorn_server.should_exit = True
+        await serving
+        await server.outbox.stop()
+        await server.session_registry.stop()
+        if server.inference_service is not None:
+            server.inference_service.close()
+        assistance_executor.shutdown(wait=True)
+
+    latencies = [latency for session in sessions for latency in session['latencies']]
+    elapsed = max(session['elapsed'] for session in sessions)
+    sent = sum(session['sent'] for session in sessions)
+    dropped = sum(session['dropped'] for session in sessions)
+    return {
+        'config': {
+            'video': os.path.basename(args.video) if args.video else None,
+            'fps': args.fps, 'seconds': args.seconds, 'sessions': args.sessions, 'students': args.students,
+            'max_in_flight': args.max_in_flight, 'inference_service': server.inference_service is not None,
+            'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(),
+        },
+        'frames_per_second': sum(session['acked'] for session in sessions) / elapsed if elapsed else 0.0,
+        'sent': sent,
+        'dropped': dropped,
+        'drop_rate': dropped / (sent + dropped) if sent + dropped else 0.0,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.5) * 1000,
+            'p90': percentile(latencies, 0.9) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': max(latencies, default=0.0) * 1000,
+        },
+        'db_calls': dict(server.db.calls),
+    }
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    # Regressions beyond the tolerance, as a fraction of the baseline
+    regressions = []
+    if result['frames_per_second'] < baseline['frames_per_second'] * (1 - tolerance):
+        regressions.append(f"throughput {result['frames_per_second']:.1f} < {baseline['frames_per_second']:.1f} fps")
+    for key in ('p50', 'p99'):
+        if result['latency_ms'][key] > baseline['latency_ms'][key] * (1 + tolerance):
+            regressions.append(f"{key} latency {result['latency_ms'][key]:.1f} > {baseline['latency_ms'][key]:.1f} ms")
+    if result['drop_rate'] > baseline['drop_rate'] + tolerance / 10:
+        regressions.append(f"drop rate {result['drop_rate']:.1%} > {baseline['drop_rate']:.1%}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay a recorded class through the WebSocket sessions')
+    parser.add_argument('--video', help='Recorded class, noise frames are used without it')
+    parser.add_argument('--fps', type=float, default=10, help='Frames sent per second by each session')
+    parser.add_argument('--seconds', type=float, default=60, help='Length of the replay')
+    parser.add_argument('--sessions', type=int, default=1, help='Sessions replaying at the same time')
+    parser.add_argument('--students', type=int, default=40, help='Students in the synthetic roster')
+    parser.add_argument('--quality', type=int, default=80, help='JPEG quality of the frames')
+    parser.add_argument('--max-in-flight', type=int, default=2, help='Frames sent without an ack before dropping')
+    parser.add_argument('--assistance-interval', type=float, help='Seconds between assistance checks')
+    parser.add_argument('--port', type=int, default=8765, help='Port of the local server')
+    parser.add_argument('--save', help='Write the results as a JSON baseline')
+    parser.add_argument('--compare', help='JSON baseline to compare against, exits with 1 on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed regression against the baseline')
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    latency = result['latency_ms']
+    print(f"{result['config']['sessions']} sessions at {args.fps} fps: {result['frames_per_second']:.1f} frames/s, "
+          f"dropped {result['dropped']} of {result['sent'] + result['dropped']} ({result['drop_rate']:.1%}), "
+          f"latency p50 {latency['p50']:.1f} ms, p90 {latency['p90']:.1f} ms, p99 {latency['p99']:.1f} ms, "
+          f"max {latency['max']:.1f} ms")
+
+    if args.save:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        with open(args.save, 'w') as file:
+            json.dump(result, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,34 @@
+# Builds the institution-wide face gallery from the encodings stored with the student photos
+# Correr en terminal: python3 build_face_gallery.py
+import asyncio
+import logging
+import os
+
+import numpy as np
+
+from Database import Database
+from FaceGallery import FaceGallery
+
+db = Database.from_env()
+
+SELECT_ENCODINGS_QUERY = 'SELECT StudentID, FaceEncoding FROM Student WHERE FaceEncoding IS NOT NULL'
+
+
+async def main() -> None:
+    # Start from an empty gallery, students deleted since the last build are left out
+    gallery = FaceGallery()
+    if os.path.exists(gallery.path):
+        os.remove(gallery.path)
+        gallery.load()
+
+    async for batch in db.stream(SELECT_ENCODINGS_QUERY):
+        gallery.add({row['StudentID']: np.frombuffer(row['FaceEncoding'], dtype=np.float64) for row in batch})
+
+    gallery.dirty = True
+    gallery.save()
+    db.close()
+    logging.info(f'Face gallery built with {len(gallery)} students in {gallery.path}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
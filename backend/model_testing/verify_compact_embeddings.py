@@ -0,0 +1,137 @@
+# Measures how the compact embedding formats change the match decisions at the compare_faces tolerance
+# Correr en terminal (desde backend/):
+#   python3 -m model_testing.verify_compact_embeddings --images fotos/        # Una carpeta con fotos de estudiantes
+#   python3 -m model_testing.verify_compact_embeddings --encodings enc.npy    # Codificaciones ya calculadas (N x 128)
+#   python3 -m model_testing.verify_compact_embeddings --synthetic 2000       # Datos sintéticos cerca de la tolerancia
+import argparse
+import os
+import sys
+
+import numpy as np
+
+import EmbeddingCodec
+
+# Same tolerance face_recognition.compare_faces uses by default
+TOLERANCE = 0.6
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def load_images(folder: str) -> np.ndarray:
+    import face_recognition as face_rec
+
+    encodings = []
+    for root, _, files in os.walk(folder):
+        for name in sorted(files):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                found = face_rec.face_encodings(face_rec.load_image_file(os.path.join(root, name)))
+                if found:
+                    encodings.append(found[0])
+    return np.array(encodings)
+
+
+def synthetic(count: int, seed: int = 0) -> np.ndarray:
+    # Four photos per identity, with the noise chosen so the distances of the same person fall around the tolerance
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(0, 0.1, (max(count // 4, 1), 128))
+    return np.repeat(centers, 4, axis=0)[:count] + rng.normal(0, 0.038, (count, 128))
+
+
+def distances(live: np.ndarray, stored: np.ndarray, stored_norms: np.ndarray) -> np.ndarray:
+    # Euclidean distances as ‖a‖² + ‖b‖² - 2ab with a matrix product, never a (live x stored x 128) difference
+    squared = (live * live).sum(axis=1)[:, None] + stored_norms[None, :] - 2 * live @ stored.T
+    # Rounding can leave tiny negatives where the distance is zero
+    return np.sqrt(np.maximum(squared, 0))
+
+
+def compare(encodings: np.ndarray, embedding_format: str, block: int = 512) -> dict:
+    """
+    Compares every stored encoding against every live encoding, as float64 and in a compact format.
+
+    In a session the live face is float64 and the roster is stored, so only the stored side is compacted.
+
+    Args:
+        encodings (np.ndarray): The encodings, one per row.
+        embedding_format (str): The compact format to verify.
+        block (int): Rows compared at once, bounds the memory used.
+
+    Returns:
+        dict: Flipped decisions, nearest neighbour changes and distance errors.
+    """
+
+    codes, scales = EmbeddingCodec.encode(encodings, embedding_format)
+    stored = EmbeddingCodec.decode(codes, scales).astype(np.float64)
+    count = len(encodings)
+    encoding_norms, stored_norms = (encodings * encodings).sum(axis=1), (stored * stored).sum(axis=1)
+
+    flips, false_accepts, false_rejects, nearest_changes, boundary = 0, 0, 0, 0, 0
+    errors = []
+    for start in range(0, count, block):
+        live = encodings[start:start + block]
+        exact = distances(live, encodings, encoding_norms)
+        compact = distances(live, stored, stored_norms)
+
+        # A face is never compared against its own photo
+        rows = np.arange(len(live))
+        exact[rows, start + rows] = np.inf
+        compact[rows, start + rows] = np.inf
+
+        exact_match, compact_match = exact <= TOLERANCE, compact <= TOLERANCE
+        flips += int((exact_match != compact_match).sum())
+        false_accepts += int((compact_match & ~exact_match).sum())
+        false_rejects += int((exact_match & ~compact_match).sum())
+        nearest_changes += int((exact.argmin(axis=1) != compact.argmin(axis=1)).sum())
+        boundary += int((np.abs(exact - TOLERANCE) < 0.01).sum())
+
+        finite = np.isfinite(exact)
+        errors.append(np.abs(exact - compact)[finite])
+
+    errors = np.concatenate(errors)
+    return {
+        'format': embedding_format,
+        'bytes': EmbeddingCodec.nbytes(embedding_format),
+        'pairs': count * (count - 1),
+        'flips': flips,
+        'false_accepts': false_accepts,
+        'false_rejects': false_rejects,
+        'nearest_changes': nearest_changes,
+        'boundary_pairs': boundary,
+        'max_error': float(errors.max()) if len(errors) else 0.0,
+        'p99_error': float(np.percentile(errors, 99)) if len(errors) else 0.0,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description='Verify the compact embedding formats against float64')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--images', help='Folder with student photos, one face per photo')
+    source.add_argument('--encodings', help='.npy file with the encodings, one per row')
+    source.add_argument('--synthetic', type=int, help='Number of synthetic encodings')
+    parser.add_argument('--max-flips', type=int, default=0, help='Flipped decisions allowed before failing')
+    args = parser.parse_args()
+
+    if args.images:
+        encodings = load_images(args.images)
+    elif args.encodings:
+        encodings = np.load(args.encodings)
+    else:
+        encodings = synthetic(args.synthetic)
+    encodings = np.asarray(encodings, dtype=np.float64)
+    if len(encodings) < 2:
+        print('At least two encodings are needed')
+        return 1
+
+    print(f'{len(encodings)} encodings, tolerance {TOLERANCE}, float64 takes {EmbeddingCodec.nbytes("float64")} bytes each')
+    failed = False
+    for embedding_format in ('float16', 'int8'):
+        result = compare(encodings, embedding_format)
+        print(f"{result['format']:<8} {result['bytes']:>4} bytes, {result['flips']} of {result['pairs']} decisions "
+              f"changed ({result['false_accepts']} accepted, {result['false_rejects']} rejected), "
+              f"{result['nearest_changes']} nearest neighbours changed, distance error max {result['max_error']:.5f} "
+              f"p99 {result['p99_error']:.5f}, {result['boundary_pairs']} pairs within 0.01 of the tolerance")
+        failed = failed or result['flips'] > args.max_flips
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+# Rebuilds the daily summaries from the Assistance and Participation history
+# Correr en terminal: python3 rebuild_summaries.py [--course COURSE_ID]
+import argparse
+import asyncio
+import logging
+
+from Database import Database
+
+db = Database.from_env()
+
+REBUILD_SUMMARIES_QUERY = '''
+    DELETE FROM StudentDailySummary WHERE ? IS NULL OR CourseID = ?;
+    DELETE FROM CourseDailySummary WHERE ? IS NULL OR CourseID = ?;
+
+    INSERT INTO StudentDailySummary (CourseID, StudentID, SummaryDate, AssistanceCount, ParticipationCount)
+    SELECT CourseID, StudentID, SummaryDate, SUM(AssistanceCount), SUM(ParticipationCount)
+    FROM (
+        SELECT CourseID, StudentID, AssistanceDate AS SummaryDate, AssistanceCount, 0 AS ParticipationCount
+        FROM Assistance
+        WHERE ? IS NULL OR CourseID = ?
+
+        UNION ALL
+
+        SELECT CourseID, StudentID, ParticipationDate AS SummaryDate, 0 AS AssistanceCount, ParticipationCount
+        FROM Participation
+        WHERE ? IS NULL OR CourseID = ?
+    ) AS combined_data
+    WHERE SummaryDate IS NOT NULL AND StudentID IS NOT NULL
+    GROUP BY CourseID, StudentID, SummaryDate;
+
+    INSERT INTO CourseDailySummary (CourseID, SummaryDate, AssistanceCount, ParticipationCount)
+    SELECT CourseID, SummaryDate, SUM(AssistanceCount), SUM(ParticipationCount)
+    FROM StudentDailySummary
+    WHERE ? IS NULL OR CourseID = ?
+    GROUP BY CourseID, SummaryDate;
+'''
+
+
+def rebuild_summaries(conn, cursor, course_id: int | None) -> None:
+    # Everything is replaced in a single transaction, readers never see half-built summaries
+    cursor.execute(REBUILD_SUMMARIES_QUERY, (course_id,) * 10)
+    conn.commit()
+
+
+async def main(course_id: int | None) -> None:
+    await db.run(rebuild_summaries, course_id)
+    db.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the daily summaries from the Assistance and Participation history')
+    parser.add_argument('--course', type=int, default=None, help='Only rebuild this course')
+    args = parser.parse_args()
+
+    asyncio.run(main(args.course))
+    logging.info(f'Daily summaries rebuilt for {"course " + str(args.course) if args.course else "all courses"}')
@@ -1,25 +1,33 @@
 # Web Framework
-from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Query, Request, WebSocket, WebSocketDisconnect
 import uvicorn
 import json
 # API Response Handling
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response, StreamingResponse
 from fastapi import HTTPException
+import Serializer
+from ResponseCache import ResponseCache
 # Middleware
 from fastapi.middleware.cors import CORSMiddleware
 # File Upload
 from fastapi import File, UploadFile
 # Cloud Storage
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceExistsError
+from BlobStorage import BlobStorage
 # Database Connectivity
-from sqlalchemy import create_engine, URL
+from Database import Database
 # Asynchronous
 import asyncio
-from multiprocessing import Process
+from concurrent.futures import ProcessPoolExecutor
+from typing import Awaitable, Callable
 # Environment Variables
 from dotenv import load_dotenv
 # OS Handling
 import os
+# File Handling
+import shutil
+import tempfile
+import zipfile
 # Image Processing
 import io
 import cv2 as cv
@@ -29,42 +37,55 @@ import face_recognition as face_rec
 import numpy as np
 # Time Handling
 import time
-from passlib.hash import argon2
+# Password Hashing
+from PasswordHasher import HasherOverloaded, PasswordHasher
 # logging
 import logging
 # Redis
-import redis
+import RedisPool
+from EncodingCache import EncodingCache
 # Model
 from Model import Model
+from FaceGallery import FaceGallery
+import RosterStore
+# Session ownership
+from SessionRegistry import SessionOwned, SessionRegistry
+# Inference
+from InferenceService import INFERENCE_SERVICE, InferenceService
+# Session flushes
+from Outbox import Outbox
+from FlushCoordinator import FlushCoordinator
+# Roster imports
+import RosterImport
+import PhotoIngest
+from RosterImport import ImportJob
+# ID's
+from uuid import uuid4
 
 logging.basicConfig(level=logging.INFO)
 
 # Load variables from env file
 load_dotenv()
 port = int(os.getenv('API_SERVER_PORT'))
-driver = '{ODBC Driver 18 for SQL Server}'
-server = os.getenv('DB_SERVER')
-database = os.getenv('DB_SERVER_DATABASE_NAME')
-username = os.getenv('DB_SERVER_USER')
-password = os.getenv('DB_SERVER_PASS')
 conn_string = os.getenv('AZURE_STORAGE_CONNECTION_STRING')
 container_name = os.getenv('AZURE_STORAGE_CONTAINER_NAME')
 
-odbc_conn = f'DRIVER={driver};SERVER={server};PORT=1433;DATABASE={database};UID={username};PWD={password}'
-connection_url = URL.create(
-    drivername="mssql+pyodbc",
-    query={
-        "odbc_connect": odbc_conn
-    }
-)
-
-engine = create_engine(connection_url)
-blob_service_client = BlobServiceClient.from_connection_string(conn_string)
-container_client = blob_service_client.get_container_client(container_name)
+# Azure SQL connection pool, configured from the DB_* variables
+db = Database.from_env()
+# Async client shared by every request, started with the app
+blob_storage = BlobStorage(conn_string, container_name)
 
 # Constants
 DB_TIME_LIMIT = 300  # Five minutes
 ASSISTANCE_TIME_LIMIT = 600  # Ten minutes
+ASSISTANCE_WORKERS = int(os.getenv('ASSISTANCE_WORKERS', 2))  # Processes shared by all sessions for the assistance checker
+STUDENT_ROLE_ID = int(os.getenv('STUDENT_ROLE_ID', 1))  # RoleID given to the students created in bulk
+BULK_MAX_ROWS = int(os.getenv('BULK_MAX_ROWS', 5000))  # Maximum students in a single bulk request
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', 2))  # Processes that normalize and encode the student photos
+IMPORT_BATCH_ROWS = int(os.getenv('IMPORT_BATCH_ROWS', 200))  # Roster rows inserted and photos processed at once
+IMPORT_MAX_PHOTO_BYTES = int(os.getenv('IMPORT_MAX_PHOTO_BYTES', 10 * 1024 * 1024))  # Larger photos are rejected
+IMPORT_PHOTO_WINDOW = int(os.getenv('IMPORT_PHOTO_WINDOW', PHOTO_WORKERS * 2))  # Photos read and processed at once
+STREAM_PAGE_ROWS = int(os.getenv('STREAM_PAGE_ROWS', 500))  # Rows read per query by the streaming listings
 
 # Create FastAPI instance
 app = FastAPI()
@@ -89,27 +110,174 @@ app.add_middleware(
 # Function to send return the payload
 def res(status: int, success: bool, data: any):
     content = {'success': success, 'data': data}
-    return JSONResponse(content=content, status_code=status)
+    return Serializer.FastJSONResponse(content=content, status_code=status)
+
+
+# Function to stream the rows of a query as newline delimited JSON, read one page at a time so no connection is held
+# while the client reads. The query takes the page size and the last key of the previous page before `params`
+def stream_res(query: str, params: tuple, key: str):
+    async def rows():
+        after = 0
+        try:
+            while True:
+                page = await db.fetch_all(query, (STREAM_PAGE_ROWS, after, *params))
+                if page:
+                    yield b''.join(Serializer.dumps(row) + b'\n' for row in page)
+                if len(page) < STREAM_PAGE_ROWS:
+                    break
+                after = page[-1][key]
+        except Exception as e:
+            # The status was already sent, the last line tells the client the listing is incomplete
+            logging.error(f'{e}')
+            yield Serializer.dumps({'error': f'Internal server error: {e}'}) + b'\n'
+
+    return StreamingResponse(rows(), media_type='application/x-ndjson')
+
+
+# Function to build a LIKE pattern that matches the search literally
+def like_pattern(search: str | None) -> str | None:
+    if not search:
+        return None
+    escaped = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_').replace('[', '\\[')
+    return f'%{escaped}%'
+
+
+# Cache for the listings that rarely change, invalidated by the handlers that modify them
+response_cache = ResponseCache(
+    max_entries=int(os.getenv('CACHE_MAX_ENTRIES', 1024)),
+    ttl=float(os.getenv('CACHE_TTL', 60)),
+    use_redis=os.getenv('CACHE_REDIS', 'false').lower() == 'true',
+)
+
+
+# Function to send back a cached payload, loading it on a miss, browsers revalidate it with its ETag
+async def cached_res(req: Request, key: str, tags: tuple, load: Callable[[], Awaitable[any]]):
+    cached = await response_cache.get(key)
+    if cached is None:
+        # Taken before loading, a payload read before an invalidation is sent but not cached
+        generation = await response_cache.generation(tags)
+        response = res(status=200, success=True, data=await load())
+        cached = await response_cache.set(key, response.body, tags, generation)
+
+    body, etag = cached
+    headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+    if etag in [tag.strip() for tag in req.headers.get('if-none-match', '').split(',')]:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type='application/json', headers=headers)
+
+
+# Pool of worker processes for the assistance checker, each worker keeps its own Redis pool between runs
+assistance_executor: ProcessPoolExecutor | None = None
+
+
+def get_assistance_executor() -> ProcessPoolExecutor:
+    global assistance_executor
+    if assistance_executor is None:
+        assistance_executor = ProcessPoolExecutor(max_workers=ASSISTANCE_WORKERS, initializer=RedisPool.init_worker)
+    return assistance_executor
+
+
+# Pool of worker processes for the student photos of uploads and roster imports, kept apart from the assistance checker
+photo_executor: ProcessPoolExecutor | None = None
+# Roster imports running in the background, referenced so they are not garbage collected
+import_tasks: set[asyncio.Task] = set()
+
+
+def get_photo_executor() -> ProcessPoolExecutor:
+    global photo_executor
+    if photo_executor is None:
+        photo_executor = ProcessPoolExecutor(max_workers=PHOTO_WORKERS)
+    return photo_executor
+
+
+# Argon2 runs in its own bounded pool, a burst of logins cannot stall the live sessions
+password_hasher = PasswordHasher()
+# Seconds clients are told to wait when the password hashing pool is full
+PASSWORD_HASH_RETRY_AFTER = os.getenv('PASSWORD_HASH_RETRY_AFTER', '1')
+
+
+# Face encodings of the students, computed once and reused by every session
+encoding_cache = EncodingCache()
+# Nearest neighbour index over the encodings of every student, to recognize students from other sections
+face_gallery = FaceGallery()
+# Which worker owns each live session, shared by every worker and node through Redis
+session_registry = SessionRegistry()
+# Close codes the frontend sends when the class ends, any other disconnect keeps the session for a reconnect
+SESSION_END_CODES = (1000, 1001, 1005)
+# Close code sent when the session is owned by another worker, the message before it says where
+SESSION_MOVED_CODE = 4001
+# Whether every frame is acknowledged once processed, the replay benchmark measures the latency with it
+SESSION_FRAME_ACK = os.getenv('SESSION_FRAME_ACK', 'false').lower() == 'true'
+# Pose inference and face encoding in local worker processes, optional
+inference_service = InferenceService() if INFERENCE_SERVICE else None
+snapshot_and_reset_script = RedisPool.get_async_client().register_script(Model.SNAPSHOT_AND_RESET_SCRIPT)
+delete_namespace_script = RedisPool.get_async_client().register_script(Model.DELETE_NAMESPACE_SCRIPT)
+
+
+async def drop_abandoned_session(namespace: str) -> None:
+    # Data of a session whose owner died and that was never resumed, what it counted since its last flush is sent
+    # first. Both scripts require the session to have no owner, a worker that resumes it in between keeps it
+    keys, args = [f'{namespace}:students', SessionRegistry.owner_key(namespace)], [namespace, '', '']
+    snapshot = await snapshot_and_reset_script(keys=keys, args=args)
+    if snapshot is None:
+        return
+    date = await RedisPool.get_async_client().get(f'{namespace}:date')
+    students = Model.parse_snapshot(snapshot)
+    if students and date is not None:
+        course_id = int(namespace.split(':')[1])
+        await send_students_info_to_db(namespace, course_id, students, date)
+    elif students:
+        logging.error(f'Session {namespace} has no date, its last counts could not be sent')
+    await delete_namespace_script(keys=keys, args=args)
+
+
+@app.on_event('startup')
+async def startup():
+    await outbox.start()
+    await response_cache.start()
+    await blob_storage.start()
+    await face_gallery.start()
+    await session_registry.start(drop_abandoned_session)
+    if inference_service is not None:
+        await inference_service.start()
+
+
+@app.on_event('shutdown')
+async def shutdown():
+    await outbox.stop()
+    await response_cache.stop()
+    for task in import_tasks:
+        task.cancel()
+    await asyncio.gather(*import_tasks, return_exceptions=True)
+    if assistance_executor is not None:
+        assistance_executor.shutdown(wait=False, cancel_futures=True)
+    if photo_executor is not None:
+        photo_executor.shutdown(wait=False, cancel_futures=True)
+    await blob_storage.close()
+    await face_gallery.stop()
+    await session_registry.stop()
+    if inference_service is not None:
+        inference_service.close()
+    await RedisPool.close_async_pool()
+    password_hasher.close()
+    db.close()
 
 
 # Function to format the HTTPException to the res() function
 @app.exception_handler(HTTPException)
 async def exception_handler(_, exc: HTTPException):
-    return res(status=exc.status_code, success=False, data={'error': exc.detail})
+    response = res(status=exc.status_code, success=False, data={'error': exc.detail})
+    if exc.headers:
+        response.headers.update(exc.headers)
+    return response
 
 
 # ======================================================GET METHODS===================================================
 
 # Get all students from this course
 @app.get('/courses/{course_id}/students')
-async def get_students(course_id: int):
-    conn = None
-    cursor = None
-
+async def get_students(course_id: int, req: Request):
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         # Execute SQL query to get students associated with the course_id from the StudentCourseRelation table
         query = '''
             SELECT s.StudentID, s.FirstName, s.LastName, s.RoleID, s.Email
@@ -117,95 +285,82 @@ async def get_students(course_id: int):
             JOIN StudentCourseRelation scr ON s.StudentID = scr.StudentID
             WHERE scr.CourseID = ?
         '''
-        cursor.execute(query, (course_id,))
-        students = cursor.fetchall()
-
-        # Convert the list of tuples into a list of dictionaries to send back
-        students = [dict(zip([column[0] for column in cursor.description], row)) for row in students]
 
-        return res(status=200, success=True, data=students)
+        return await cached_res(req, f'course:{course_id}:students', (f'course:{course_id}:students', 'course_students'),
+                                lambda: db.fetch_all(query, (course_id,)))
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.get('/students')
-async def get_students_list():
-    conn = None
-    cursor = None
-
+async def get_students_list(req: Request):
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         # Execute SQL query
-        cursor.execute('SELECT StudentID, FirstName, LastName, RoleID, Email FROM Student')
-        students = cursor.fetchall()
-        # We convert list of tuples into a dict to send back
-        students = [dict(zip([column[0] for column in cursor.description], row)) for row in students]
+        query = 'SELECT StudentID, FirstName, LastName, RoleID, Email FROM Student'
 
-        return res(status=200, success=True, data=students)
+        return await cached_res(req, 'students', ('students',), lambda: db.fetch_all(query))
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+
+# Students filtered by name or email, one page at a time ordered by ID, `after` is the last ID of the previous page
+@app.get('/students/page')
+async def get_students_page(after: int = 0, limit: int = Query(default=50, ge=1, le=500), search: str | None = None):
+    try:
+        pattern = like_pattern(search)
+        query = '''
+            SELECT TOP (?) StudentID, FirstName, LastName, RoleID, Email
+            FROM Student
+            WHERE StudentID > ?
+                AND (? IS NULL OR FirstName LIKE ? ESCAPE '\\' OR LastName LIKE ? ESCAPE '\\' OR Email LIKE ? ESCAPE '\\')
+            ORDER BY StudentID
+        '''
+        students = await db.fetch_all(query, (limit, after, pattern, pattern, pattern, pattern))
+        next_after = students[-1]['StudentID'] if len(students) == limit else None
+
+        return res(status=200, success=True, data={'items': students, 'next_after': next_after})
+
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
+# All the students filtered by name or email, streamed as newline delimited JSON
+@app.get('/students/stream')
+async def stream_students(search: str | None = None):
+    pattern = like_pattern(search)
+    query = '''
+        SELECT TOP (?) StudentID, FirstName, LastName, RoleID, Email
+        FROM Student
+        WHERE StudentID > ?
+            AND (? IS NULL OR FirstName LIKE ? ESCAPE '\\' OR LastName LIKE ? ESCAPE '\\' OR Email LIKE ? ESCAPE '\\')
+        ORDER BY StudentID
+    '''
+    return stream_res(query, (pattern, pattern, pattern, pattern), 'StudentID')
 
 
 # Get all courses for User
 @app.get('/courses/{user_id}')
-async def get_courses(user_id: int):
-    conn = None
-    cursor = None
-
+async def get_courses(user_id: int, req: Request):
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         # Execute SQL query
         query = 'SELECT * FROM Course WHERE UserID = ?'
-        cursor.execute(query, (user_id,))
-        courses = cursor.fetchall()
-        # We convert list of tuples into a dict to send back
-        courses = [dict(zip([column[0] for column in cursor.description], row)) for row in courses]
 
-        return res(status=200, success=True, data=courses)
+        return await cached_res(req, f'user:{user_id}:courses', (f'user:{user_id}:courses', 'user_courses'),
+                                lambda: db.fetch_all(query, (user_id,)))
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # Get all courses for student
 @app.get('/courses/{email}/users')
 async def get_courses(email: str):
-    conn = None
-    cursor = None
-
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         query = '''
             SELECT c.*
             FROM Course c
@@ -213,10 +368,7 @@ async def get_courses(email: str):
             JOIN Student s ON s.StudentID = scr.StudentID
             WHERE s.Email = ?
         '''
-        cursor.execute(query, (email,))
-        courses = cursor.fetchall()
-
-        courses = [dict(zip([column[0] for column in cursor.description], row)) for row in courses]
+        courses = await db.fetch_all(query, (email,))
 
         return res(status=200, success=True, data=courses)
 
@@ -224,117 +376,126 @@ async def get_courses(email: str):
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # Get all professors from this course
 @app.get('/courses/{course_id}/professors')
-async def get_professors(course_id: int):
-    conn = None
-    cursor = None
-
+async def get_professors(course_id: int, req: Request):
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         # Execute SQL query
         query = 'SELECT * FROM Professor WHERE CourseID = ?'
-        cursor.execute(query, (course_id,))
-        professors = cursor.fetchall()
-        # We convert list of tuples into a dict to send back
-        professors = [dict(zip([column[0] for column in cursor.description], row)) for row in professors]
 
-        return res(status=200, success=True, data=professors)
+        return await cached_res(req, f'course:{course_id}:professors', (f'course:{course_id}:professors',),
+                                lambda: db.fetch_all(query, (course_id,)))
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # Get Users
 @app.get('/users')
-async def get_users():
-    conn = None
-    cursor = None
-
+async def get_users(req: Request):
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         # Execute SQL query
         query = 'SELECT * FROM ProfessorsUsers'
-        cursor.execute(query)
-        users = cursor.fetchall()
-        # We convert list of tuples into a dict to send back
-        users = [dict(zip([column[0] for column in cursor.description], row)) for row in users]
 
-        return res(status=200, success=True, data=users)
+        return await cached_res(req, 'users', ('users',), lambda: db.fetch_all(query))
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+
+# Users filtered by email and role, one page at a time ordered by ID, `after` is the last ID of the previous page
+@app.get('/users/page')
+async def get_users_page(after: int = 0, limit: int = Query(default=50, ge=1, le=500),
+                         search: str | None = None, role_id: int | None = None):
+    try:
+        pattern = like_pattern(search)
+        query = '''
+            SELECT TOP (?) UserID, Email, RoleID
+            FROM ProfessorsUsers
+            WHERE UserID > ? AND (? IS NULL OR Email LIKE ? ESCAPE '\\') AND (? IS NULL OR RoleID = ?)
+            ORDER BY UserID
+        '''
+        users = await db.fetch_all(query, (limit, after, pattern, pattern, role_id, role_id))
+        next_after = users[-1]['UserID'] if len(users) == limit else None
+
+        return res(status=200, success=True, data={'items': users, 'next_after': next_after})
+
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
+# All the users filtered by email and role, streamed as newline delimited JSON
+@app.get('/users/stream')
+async def stream_users(search: str | None = None, role_id: int | None = None):
+    pattern = like_pattern(search)
+    query = '''
+        SELECT TOP (?) UserID, Email, RoleID
+        FROM ProfessorsUsers
+        WHERE UserID > ? AND (? IS NULL OR Email LIKE ? ESCAPE '\\') AND (? IS NULL OR RoleID = ?)
+        ORDER BY UserID
+    '''
+    return stream_res(query, (pattern, pattern, role_id, role_id), 'UserID')
+
+
+# Progress of a roster import
+@app.get('/import/jobs/{job_id}')
+async def get_import_job(job_id: str):
+    try:
+        job = await ImportJob.get(job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail="Import job not found")
+
+        return res(status=200, success=True, data=job)
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
 
 @app.post('/participation/assistance/{course_id}/{date}')
 async def get_participation_assistance(course_id: int, date: str, req: Request):
-    conn = None
-    cursor = None
+    def select_participation_assistance(_, cursor, student_ids):
+        # One query for the whole student set on the daily summary, the ID set is sent once as JSON
+        cursor.execute("""
+            WITH Roster AS (
+                SELECT DISTINCT StudentID FROM OPENJSON(?) WITH (StudentID INT '$')
+            )
+            SELECT S.StudentID, S.AssistanceCount, S.ParticipationCount
+            FROM StudentDailySummary S
+            JOIN Roster R ON R.StudentID = S.StudentID
+            WHERE S.CourseID = ? AND S.SummaryDate = ?
+        """, (json.dumps(student_ids), course_id, date))
+
+        # Stream the rows into each student's data
+        student_results = {}
+        while rows := cursor.fetchmany(500):
+            for student_id, assistance_count, participation_count in rows:
+                student_results.setdefault(str(student_id), []).append(
+                    {"AssistanceCount": assistance_count, "ParticipationCount": participation_count})
+        return student_results
+
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
         student_data_list = await req.json()
+        student_ids = [student_data.get('StudentID') for student_data in student_data_list]
+
+        student_results = await db.run(select_participation_assistance, student_ids)
 
-        result_data = []
-        for student_data in student_data_list:
-            student_id = student_data.get('StudentID')
-            cursor.execute("""
-                SELECT 
-                    COALESCE(A.AssistanceCount, 0) AS AssistanceCount, 
-                    COALESCE(P.ParticipationCount, 0) AS ParticipationCount 
-                FROM 
-                    Assistance AS A
-                FULL JOIN 
-                    Participation AS P 
-                    ON A.StudentID = P.StudentID AND A.CourseID = P.CourseID AND A.AssistanceDate = P.ParticipationDate
-                WHERE 
-                    (A.StudentID = ? AND A.CourseID = ? AND A.AssistanceDate = ?) OR 
-                    (P.StudentID = ? AND P.CourseID = ? AND P.ParticipationDate = ?)
-            """, (student_id, course_id, date, student_id, course_id, date))
-
-            student_result = cursor.fetchall()
-            student_result_dict = [dict(zip([column[0] for column in cursor.description], row)) for row in student_result]
-            result_data.append({"StudentID": student_id, "Data": student_result_dict, "Date": date})
-
-        return JSONResponse(content={"success": True, "data": result_data}, status_code=200)
+        result_data = [{"StudentID": student_id, "Data": student_results.get(str(student_id), []), "Date": date}
+                       for student_id in student_ids]
+
+        return res(status=200, success=True, data=result_data)
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.post('/dateranges/{course_id}/{dates}')
 async def get_date_ranges(
@@ -342,79 +503,74 @@ async def get_date_ranges(
         dates: str,
         req: Request
 ):
-    conn = None
-    cursor = None
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
         student_data_list = await req.json()
         start_date, end_date = map(str, dates.split(','))
+        student_ids = json.dumps([student_data.get('StudentID') for student_data in student_data_list])
 
-        cursor.execute("""
-            SELECT DISTINCT AssistanceDate 
-            FROM Assistance 
-            WHERE CourseID = ? AND AssistanceDate BETWEEN ? AND ?
-        """, (course_id, start_date, end_date))
-
-        distinct_dates = [str(row[0]) for row in cursor.fetchall()]
-
-        result_data = {}
+        # The student ID set is sent once as JSON. When it is the course's roster the totals are read straight
+        # from the course summary, otherwise they are added up from the summaries of the students in the set
+        query = """
+            SET NOCOUNT ON;
+            DECLARE @Roster TABLE (StudentID INT PRIMARY KEY);
+            INSERT INTO @Roster
+            SELECT DISTINCT StudentID FROM OPENJSON(?) WITH (StudentID INT '$') WHERE StudentID IS NOT NULL;
+
+            DECLARE @CourseID INT = ?, @StartDate DATE = ?, @EndDate DATE = ?;
+
+            IF NOT EXISTS (
+                SELECT StudentID FROM StudentCourseRelation WHERE CourseID = @CourseID AND StudentID IS NOT NULL
+                EXCEPT
+                SELECT StudentID FROM @Roster
+            ) AND NOT EXISTS (
+                SELECT StudentID FROM @Roster
+                EXCEPT
+                SELECT StudentID FROM StudentCourseRelation WHERE CourseID = @CourseID
+            )
+                SELECT SummaryDate AS Date, AssistanceCount, ParticipationCount
+                FROM CourseDailySummary
+                WHERE CourseID = @CourseID AND SummaryDate BETWEEN @StartDate AND @EndDate
+                ORDER BY SummaryDate;
+            ELSE
+                SELECT S.SummaryDate AS Date, SUM(S.AssistanceCount) AS AssistanceCount, SUM(S.ParticipationCount) AS ParticipationCount
+                FROM StudentDailySummary S
+                JOIN @Roster R ON R.StudentID = S.StudentID
+                WHERE S.CourseID = @CourseID AND S.SummaryDate BETWEEN @StartDate AND @EndDate
+                GROUP BY S.SummaryDate
+                ORDER BY S.SummaryDate;
+        """
+        result_data = await db.fetch_all(query, (student_ids, course_id, start_date, end_date))
 
-        for student_data in student_data_list:
-            student_id = student_data.get('StudentID')
-            cursor.execute("""
-                SELECT AssistanceDate, SUM(AssistanceCount) as TotalAssistance, SUM(ParticipationCount) as TotalParticipation
-                FROM (
-                    SELECT AssistanceDate, AssistanceCount, 0 as ParticipationCount
-                    FROM Assistance
-                    WHERE CourseID = ? AND StudentID = ? AND AssistanceDate BETWEEN ? AND ?
+        final_result_data = [{"Date": str(data["Date"]), "AssistanceCount": data["AssistanceCount"],
+                              "ParticipationCount": data["ParticipationCount"]} for data in result_data]
 
-                    UNION ALL
+        return res(status=200, success=True, data=final_result_data)
 
-                    SELECT ParticipationDate as AssistanceDate, 0 as AssistanceCount, ParticipationCount
-                    FROM Participation
-                    WHERE CourseID = ? AND StudentID = ? AND ParticipationDate BETWEEN ? AND ?
-                ) AS combined_data
-                WHERE AssistanceDate IS NOT NULL
-                GROUP BY AssistanceDate
-            """, (course_id, student_id, start_date, end_date, course_id, student_id, start_date, end_date))
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-            for row in cursor.fetchall():
-                date, total_assistance, total_participation = row
-                if date not in result_data:
-                    result_data[date] = {"AssistanceCount": 0, "ParticipationCount": 0}
 
-                result_data[date]["AssistanceCount"] += total_assistance
-                result_data[date]["ParticipationCount"] += total_participation
+@app.get('/metrics/redis')
+async def get_redis_metrics():
+    return res(status=200, success=True, data=RedisPool.metrics())
 
-        final_result_data = [{"Date": str(date), "AssistanceCount": data["AssistanceCount"],
-                              "ParticipationCount": data["ParticipationCount"]} for date, data in result_data.items()]
 
-        return JSONResponse(content={"success": True, "data": final_result_data}, status_code=200)
+@app.get('/metrics/db')
+async def get_db_metrics():
+    return res(status=200, success=True, data=db.pool_metrics())
 
-    except Exception as e:
-        logging.error(f'{e}')
-        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+@app.get('/metrics/passwords')
+async def get_password_metrics():
+    return res(status=200, success=True, data=password_hasher.metrics())
 
 
 @app.get('/session/count/{course_id}')
 async def get_session_count(course_id: int):
-    conn = None
-    cursor = None
     try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         # Execute SQL query
-        cursor.execute('SELECT SessionCount FROM Course WHERE CourseID = ?', (course_id,))
-        row = cursor.fetchone()
+        row = await db.fetch_one('SELECT SessionCount FROM Course WHERE CourseID = ?', (course_id,))
 
         if row:
             session_count = row[0]
@@ -426,31 +582,42 @@ async def get_session_count(course_id: int):
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
+@app.get('/sessions')
+async def get_sessions():
+    try:
+        sessions = await session_registry.sessions()
+        workers = await session_registry.workers()
+        return res(status=200, success=True, data={'sessions': sessions, 'workers': workers})
 
-# ======================================================POST METHODS===================================================
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-# Create a new course
-@app.post('/courses/{user_id}')
-async def add_course(user_id: int, req: Request):
-    conn = None
-    cursor = None
 
+@app.get('/sessions/{course_id}/{session_count}')
+async def get_session(course_id: int, session_count: int):
     try:
-        course_data = await req.json()
-        course_name = course_data.get('CourseName')
-        if course_name is None or user_id is None:
-            logging.info("No course name")
-            raise HTTPException(status_code=400, detail="CourseName field is required")
+        # Answered from Redis, no matter which worker owns the session
+        session = await session_registry.describe(f'course:{course_id}:session:{session_count}')
+        if session is None:
+            raise HTTPException(status_code=404, detail='Session not found')
+        return res(status=200, success=True, data=session)
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
+# ======================================================POST METHODS===================================================
 
+# Create a new course
+@app.post('/courses/{user_id}')
+async def add_course(user_id: int, req: Request):
+    def insert_course(conn, cursor, course_name):
         query = """
         SET NOCOUNT ON;
         DECLARE @CourseID INT;
@@ -464,6 +631,17 @@ async def add_course(user_id: int, req: Request):
         # Fetch the output parameter
         course_id = cursor.fetchone()[0]
         conn.commit()
+        return course_id
+
+    try:
+        course_data = await req.json()
+        course_name = course_data.get('CourseName')
+        if course_name is None or user_id is None:
+            logging.info("No course name")
+            raise HTTPException(status_code=400, detail="CourseName field is required")
+
+        course_id = await db.run(insert_course, course_name)
+        await response_cache.invalidate(f'user:{user_id}:courses')
 
         return res(status=200, success=True,
                    data={'message': 'Course added successfully', 'CourseID': course_id, 'UserID': user_id, })
@@ -472,31 +650,204 @@ async def add_course(user_id: int, req: Request):
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
 
+# Resolves the emails, creates the missing students if asked to and enrolls them, all in a single round trip
+BULK_ENROLL_QUERY = '''
+    SET NOCOUNT ON;
+
+    DECLARE @Rows TABLE (RowIndex INT PRIMARY KEY, FirstName NVARCHAR(100), LastName NVARCHAR(100), Email NVARCHAR(255));
+    DECLARE @Created TABLE (StudentID INT PRIMARY KEY);
+    DECLARE @Enrolled TABLE (StudentID INT PRIMARY KEY);
+
+    INSERT INTO @Rows (RowIndex, FirstName, LastName, Email)
+    SELECT RowIndex, FirstName, LastName, Email
+    FROM OPENJSON(?) WITH (
+        RowIndex INT '$.RowIndex',
+        FirstName NVARCHAR(100) '$.FirstName',
+        LastName NVARCHAR(100) '$.LastName',
+        Email NVARCHAR(255) '$.Email'
+    );
+
+    INSERT INTO Student (FirstName, LastName, Email, RoleID)
+    OUTPUT inserted.StudentID INTO @Created (StudentID)
+    SELECT r.FirstName, r.LastName, r.Email, ?
+    FROM @Rows AS r
+    WHERE ? = 1 AND NOT EXISTS (SELECT 1 FROM Student AS s WHERE s.Email = r.Email);
+
+    INSERT INTO StudentCourseRelation (StudentID, CourseID)
+    OUTPUT inserted.StudentID INTO @Enrolled (StudentID)
+    SELECT DISTINCT s.StudentID, ?
+    FROM @Rows AS r
+    JOIN Student AS s ON s.Email = r.Email
+    WHERE NOT EXISTS (
+        SELECT 1 FROM StudentCourseRelation AS scr WHERE scr.StudentID = s.StudentID AND scr.CourseID = ?
+    );
+
+    SELECT r.RowIndex, s.StudentID,
+        CASE
+            WHEN s.StudentID IS NULL THEN 'not_found'
+            WHEN c.StudentID IS NOT NULL THEN 'created'
+            WHEN e.StudentID IS NOT NULL THEN 'enrolled'
+            ELSE 'already_enrolled'
+        END AS Status
+    FROM @Rows AS r
+    LEFT JOIN Student AS s ON s.Email = r.Email
+    LEFT JOIN @Created AS c ON c.StudentID = s.StudentID
+    LEFT JOIN @Enrolled AS e ON e.StudentID = s.StudentID
+    ORDER BY r.RowIndex;
+'''
+
+
+# Function to enroll many students in a course, returns the outcome of each row in the order they were sent
+async def bulk_enroll(course_id: int, students: list[dict], create: bool) -> dict:
+    def enroll(conn, cursor, rows_json):
+        cursor.execute(BULK_ENROLL_QUERY, (rows_json, STUDENT_ROLE_ID, int(create), course_id, course_id))
+        rows = cursor.fetchall()
+        conn.commit()
+        return rows
+
+    results = [None] * len(students)
+    rows = []
+    seen = set()
+    for index, student in enumerate(students):
+        # Rows come straight from the request body, anything that is not a dict of strings is reported, not raised
+        email = student.get('Email') if isinstance(student, dict) else None
+        email = email.strip() if isinstance(email, str) else email
+        results[index] = {'Email': email, 'StudentID': None, 'Status': 'invalid'}
+
+        if not isinstance(email, str) or not email:
+            continue
+        names = (student.get('FirstName'), student.get('LastName'))
+        if any(name is not None and not isinstance(name, str) for name in names) or (create and not all(names)):
+            continue
+        # Emails are compared like the database collation does, the first occurrence wins
+        if email.lower() in seen:
+            results[index]['Status'] = 'duplicate'
+            continue
+        seen.add(email.lower())
+        rows.append({'RowIndex': index, 'FirstName': student.get('FirstName'), 'LastName': student.get('LastName'),
+                     'Email': email})
+
+    if rows:
+        for row_index, student_id, status in await db.run(enroll, json.dumps(rows)):
+            results[row_index].update({'StudentID': student_id, 'Status': status})
+
+    summary = {}
+    for result in results:
+        summary[result['Status']] = summary.get(result['Status'], 0) + 1
+
+    tags = [f'course:{course_id}:students']
+    if summary.get('created'):
+        tags.append('students')
+    await response_cache.invalidate(*tags)
+
+    return {'summary': summary, 'results': results}
+
+
+# Function to copy an upload to a temporary file, so it outlives the request
+def save_upload(upload: UploadFile, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as file:
+        try:
+            shutil.copyfileobj(upload.file, file)
+        except BaseException:
+            file.close()
+            os.remove(file.name)
+            raise
+        return file.name
+
+
+# Function to import a roster in the background, reporting its progress in the job
+async def run_roster_import(job: ImportJob, course_id: int, roster_path: str, photos_path: str | None):
+    def store_images(conn, cursor, images):
+        cursor.fast_executemany = True
+        cursor.executemany('UPDATE Student SET Image = ?, FaceEncoding = ?, ImageHash = ? WHERE StudentID = ?', images)
+        conn.commit()
 
-# Add all students to this course
-@app.post('/courses/{course_id}/students')
-async def add_students(course_id: int, req: Request):
-    conn = None
-    cursor = None
-
+    loop = asyncio.get_running_loop()
+    photos = None
     try:
-        body = await req.json()
-        first_name = body.get('FirstName')
-        last_name = body.get('LastName')
-        email = body.get('Email')
+        await job.set_status('running')
+        if photos_path:
+            photos = zipfile.ZipFile(photos_path)
+        photo_index = RosterImport.index_photos(photos) if photos else {}
+
+        # The CSV is read one batch at a time, each batch is enrolled in a single round trip
+        batches = RosterImport.read_roster(roster_path, IMPORT_BATCH_ROWS)
+        offset = 0
+        while batch := await asyncio.to_thread(next, batches, None):
+            enrolled = await bulk_enroll(course_id, batch, create=True)
+            errors = [
+                {'row': offset + index + 1, 'Email': result['Email'], 'error': result['Status']}
+                for index, result in enumerate(enrolled['results'])
+                if result['Status'] in ('invalid', 'duplicate', 'not_found')
+            ]
+
+            # Photos of the students that ended up in the course
+            pending = []
+            for index, (row, result) in enumerate(zip(batch, enrolled['results'])):
+                info = RosterImport.find_photo(photo_index, row) if result['StudentID'] else None
+                if info is None:
+                    continue
+                if info.file_size > IMPORT_MAX_PHOTO_BYTES:
+                    errors.append({'row': offset + index + 1, 'Email': result['Email'], 'error': 'Photo too large'})
+                    continue
+                pending.append((offset + index + 1, result, info))
+
+            # Each photo is only read once a place in the window is free, a batch of large photos is never
+            # held in memory or sent to the workers all at once
+            window = asyncio.Semaphore(IMPORT_PHOTO_WINDOW)
+
+            async def normalize(info):
+                async with window:
+                    data = await asyncio.to_thread(photos.read, info)
+                    return await loop.run_in_executor(get_photo_executor(), PhotoIngest.normalize_photo, data)
+
+            normalized = await asyncio.gather(*(normalize(info) for _, _, info in pending), return_exceptions=True)
+
+            stored_images = []
+            stored_encodings = {}
+            for (row, result, _), photo in zip(pending, normalized):
+                if isinstance(photo, Exception):
+                    errors.append({'row': row, 'Email': result['Email'], 'error': str(photo)})
+                    continue
+                image_data, encoding, image_hash = photo
+                stored_images.append((image_data, encoding.tobytes(), image_hash, result['StudentID']))
+                stored_encodings[result['StudentID']] = encoding
+
+            if stored_images:
+                await db.run(store_images, stored_images)
+                # Pre-warm the encodings, the first session of the course does not have to compute them
+                await encoding_cache.set_many(stored_encodings)
+                face_gallery.add(stored_encodings)
+
+            await job.increment({'rows': len(batch), **enrolled['summary'], 'photos': len(stored_images),
+                                 'photos_failed': len(pending) - len(stored_images)})
+            await job.add_errors(errors)
+            offset += len(batch)
+
+        await job.set_status('done')
+
+    except asyncio.CancelledError:
+        await job.set_status('cancelled')
+        raise
 
-        if not first_name or not last_name or not email:
-            raise HTTPException(status_code=400, detail="Both Email / FirstName and LastName fields are required")
+    except Exception as e:
+        logging.error(f'Error importing roster {job.job_id}: {e}')
+        await job.add_errors([{'error': str(e)}])
+        await job.set_status('failed')
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
+    finally:
+        if photos:
+            photos.close()
+        for path in (roster_path, photos_path):
+            if path:
+                os.remove(path)
 
+
+# Add all students to this course
+@app.post('/courses/{course_id}/students')
+async def add_students(course_id: int, req: Request):
+    def insert_student(conn, cursor, first_name, last_name, email):
         query = 'EXEC AddStudents @FirstName=?, @LastName=?, @Email = ?'
         cursor.execute(query, (first_name, last_name, email))
         conn.commit()
@@ -511,70 +862,148 @@ async def add_students(course_id: int, req: Request):
         cursor.execute(query2, (student_id, course_id))
         conn.commit()
 
+    try:
+        body = await req.json()
+        first_name = body.get('FirstName')
+        last_name = body.get('LastName')
+        email = body.get('Email')
+
+        if not first_name or not last_name or not email:
+            raise HTTPException(status_code=400, detail="Both Email / FirstName and LastName fields are required")
+
+        await db.run(insert_student, first_name, last_name, email)
+        await response_cache.invalidate(f'course:{course_id}:students', 'students')
+
         return res(status=200, success=True, data={'message': 'Student added to the course successfully'})
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.post('/courses/students/add')
 async def add_students(req: Request):
-    conn = None
-    cursor = None
-
     try:
         body = await req.json()
         first_name = body.get('FirstName')
         last_name = body.get('LastName')
         email = body.get('Email')
         image_data = body.get('Img')
+
+        if not first_name or not last_name or not email:
+            raise HTTPException(status_code=400, detail="Both Email / FirstName and LastName fields are required")
+
         image_response = image_data['file']['response'].encode('utf-8')
         if image_response:
-            image_stream = io.BytesIO(image_response)
-            container_client.upload_blob(name=email, data=image_stream)
+            # Never replaces the photo of a student that already exists
+            try:
+                await blob_storage.upload(name=email, data=image_response)
+            except ResourceExistsError:
+                raise HTTPException(status_code=409, detail=f"An image for '{email}' already exists")
             logging.info(f"Image '{email}' uploaded successfully.")
         else:
             logging.info("No image data received.")
 
+        query = 'EXEC AddStudents @FirstName=?, @LastName=?, @Email = ?'
+        await db.execute(query, (first_name, last_name, email))
+        await response_cache.invalidate('students')
 
-        if not first_name or not last_name or not email:
-            raise HTTPException(status_code=400, detail="Both Email / FirstName and LastName fields are required")
+        return res(status=200, success=True, data={'message': 'Student added successfully'})
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
+    except HTTPException:
+        raise
 
-        query = 'EXEC AddStudents @FirstName=?, @LastName=?, @Email = ?'
-        cursor.execute(query, (first_name, last_name, email))
-        conn.commit()
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
+# Add many students to this course at once, the ones that do not exist yet are created
+@app.post('/courses/{course_id}/students/bulk')
+async def add_students_bulk(course_id: int, req: Request):
+    try:
+        body = await req.json()
+        students = body.get('Students')
+
+        if not isinstance(students, list) or not students:
+            raise HTTPException(status_code=400, detail="Students field must be a non empty list")
+        if len(students) > BULK_MAX_ROWS:
+            raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ROWS} students can be added at once")
+
+        data = await bulk_enroll(course_id, students, create=True)
+
+        return res(status=200, success=True, data=data)
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
+
+
+# Enroll many existing students in this course by their email
+@app.post('/courses/{course_id}/enrollments')
+async def enroll_students(course_id: int, req: Request):
+    try:
+        body = await req.json()
+        emails = body.get('Email')
+
+        if not isinstance(emails, list) or not emails:
+            raise HTTPException(status_code=400, detail="Email field must be a non empty list")
+        if len(emails) > BULK_MAX_ROWS:
+            raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ROWS} students can be enrolled at once")
+
+        data = await bulk_enroll(course_id, [{'Email': email} for email in emails], create=False)
+
+        return res(status=200, success=True, data=data)
+
+    except HTTPException:
+        raise
+
+    except Exception as e:
+        logging.error(f'{e}')
+        raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-        return res(status=200, success=True, data={'message': 'Student added successfully'})
+
+# Import a roster CSV and, optionally, a ZIP with the photos of the students, returns the job to follow its progress
+@app.post('/courses/{course_id}/students/import')
+async def import_students(course_id: int, roster: UploadFile = File(...), photos: UploadFile | None = File(None)):
+    roster_path = photos_path = task = None
+    try:
+        roster_path = await asyncio.to_thread(save_upload, roster, '.csv')
+        photos_path = await asyncio.to_thread(save_upload, photos, '.zip') if photos else None
+
+        if photos_path and not zipfile.is_zipfile(photos_path):
+            raise HTTPException(status_code=400, detail="Photos must be a ZIP file")
+
+        job = ImportJob(uuid4().hex)
+        await job.create(course_id)
+
+        task = asyncio.create_task(run_roster_import(job, course_id, roster_path, photos_path))
+        import_tasks.add(task)
+        task.add_done_callback(import_tasks.discard)
+
+        return res(status=202, success=True, data={'job_id': job.job_id})
+
+    except HTTPException:
+        raise
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
     finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+        # Once the import is started it removes the files, until then the request does
+        if task is None:
+            for path in (roster_path, photos_path):
+                if path:
+                    os.remove(path)
 
 
 # Add professor to this course
 @app.post('/courses/{course_id}/professors')
 async def add_professor(course_id: int, req: Request):
-    conn = None
-    cursor = None
-
     try:
         body = await req.json()
         professor_name = body.get('ProfessorName')
@@ -582,12 +1011,9 @@ async def add_professor(course_id: int, req: Request):
         if not professor_name:
             raise HTTPException(status_code=400, detail="Professor name field is required")
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         query = 'EXEC AddProfessor @ProfessorName=?, @CourseID=?'
-        cursor.execute(query, (professor_name, course_id))
-        conn.commit()
+        await db.execute(query, (professor_name, course_id))
+        await response_cache.invalidate(f'course:{course_id}:professors')
 
         return res(status=200, success=True, data={'message': 'Professor added to the course successfully'})
 
@@ -595,19 +1021,19 @@ async def add_professor(course_id: int, req: Request):
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # Add User
 @app.post('/users')
 async def add_user(req: Request):
-    conn = None
-    cursor = None
+    def insert_user(conn, cursor, email, hashed_password, role_id):
+        query1 = 'SELECT COUNT(*) FROM ProfessorsUsers WHERE Email = ?'
+        cursor.execute(query1, (email,))
+        if cursor.fetchone()[0] > 0:
+            raise HTTPException(status_code=400, detail="Email already exists")
+
+        query2 = 'INSERT INTO ProfessorsUsers (Email, PasswordHash, RoleID) VALUES (?, ?, ?)'
+        cursor.execute(query2, (email, hashed_password, role_id))
+        conn.commit()
 
     try:
         user_data = await req.json()
@@ -616,55 +1042,38 @@ async def add_user(req: Request):
         role_id = user_data.get('RoleID')
 
         # Hash the password using passlib and argon2
-        hashed_password = argon2.hash(password)
+        hashed_password = await password_hasher.hash(password)
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
-        query1 = 'SELECT COUNT(*) FROM ProfessorsUsers WHERE Email = ?'
-        cursor.execute(query1, (email,))
-        if cursor.fetchone()[0] > 0:
-            raise HTTPException(status_code=400, detail="Email already exists")
-
-        query2 = 'INSERT INTO ProfessorsUsers (Email, PasswordHash, RoleID) VALUES (?, ?, ?)'
-        cursor.execute(query2, (email, hashed_password, role_id))
-        conn.commit()
+        await db.run(insert_user, email, hashed_password, role_id)
+        await response_cache.invalidate('users')
 
         return res(status=200, success=True, data={'message': 'User added successfully'})
 
+    except HasherOverloaded as e:
+        logging.warning(f'Password hashing overloaded: {e}')
+        raise HTTPException(status_code=503, detail="Server busy, try again",
+                            headers={'Retry-After': PASSWORD_HASH_RETRY_AFTER})
+
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.post('/users/login')
 async def login_user(req: Request):
-    conn = None
-    cursor = None
-
     try:
         user_data = await req.json()
         user_email = user_data.get('Email')
         user_password = user_data.get('Password')
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         query = 'SELECT UserID, RoleID, PasswordHash FROM ProfessorsUsers WHERE Email = ?'
-        cursor.execute(query, (user_email,))
-        user_data = cursor.fetchone()
+        user_data = await db.fetch_one(query, (user_email,))
 
         if user_data:
             user_id, role_id, hashed_password = user_data
 
             # Verify the provided plain-text password against the stored hashed password
-            if argon2.verify(user_password, hashed_password):
+            if await password_hasher.verify(user_password, hashed_password):
                 return res(status=200, success=True,
                            data={'message': 'User exists and credentials are correct', 'RoleID': role_id,
                                  'UserID': user_id})
@@ -673,33 +1082,24 @@ async def login_user(req: Request):
         else:
             return res(status=401, success=False, data={'message': 'Invalid email or password'})
 
+    except HasherOverloaded as e:
+        logging.warning(f'Password hashing overloaded: {e}')
+        raise HTTPException(status_code=503, detail="Server busy, try again",
+                            headers={'Retry-After': PASSWORD_HASH_RETRY_AFTER})
+
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.post('/students/login')
 async def login_user(req: Request):
-    conn = None
-    cursor = None
-
     try:
         student_data = await req.json()
         email = student_data.get('Email')
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
         query = 'SELECT StudentID, RoleID FROM Student WHERE Email = ?'
-        cursor.execute(query, (email,))
-
-        student = cursor.fetchone()
+        student = await db.fetch_one(query, (email,))
 
         if student:
             user_id, role_id = student
@@ -713,29 +1113,17 @@ async def login_user(req: Request):
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # ======================================================PUT METHODS===================================================
 
 
 @app.put('/session/count/{course_id}')
 async def add_session(course_id: int):
-    conn = None
-    cursor = None
-
     try:
         if not course_id:
             raise HTTPException(status_code=400, detail="Select a Course")
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
 
-        cursor.execute("EXEC IncrementSessionCount @course_id = ?", (course_id,))
-        conn.commit()
+        await db.execute("EXEC IncrementSessionCount @course_id = ?", (course_id,))
 
         return res(status=200, success=True, data={'message': 'Session counted successfully'})
 
@@ -743,19 +1131,19 @@ async def add_session(course_id: int):
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # Update User
 @app.put('/users/{user_id}')
 async def update_user(user_id: int, req: Request):
-    conn = None
-    cursor = None
+    def update_user_row(conn, cursor, new_email, new_password_hash, new_role_id):
+        query1 = 'SELECT COUNT(*) FROM ProfessorsUsers WHERE UserID = ?'
+        cursor.execute(query1, (user_id,))
+        if cursor.fetchone()[0] == 0:
+            raise HTTPException(status_code=404, detail="User not found")
+
+        query2 = 'UPDATE ProfessorsUsers SET Email = ?, PasswordHash = ?, RoleID = ? WHERE UserID = ?'
+        cursor.execute(query2, (new_email, new_password_hash, new_role_id, user_id))
+        conn.commit()
 
     try:
         user_data = await req.json()
@@ -764,47 +1152,26 @@ async def update_user(user_id: int, req: Request):
         new_role_id = user_data.get('RoleID')
 
         # Hash the new password using passlib and argon2
-        new_password_hash = argon2.hash(new_password)
+        new_password_hash = await password_hasher.hash(new_password)
 
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
-        query1 = 'SELECT COUNT(*) FROM ProfessorsUsers WHERE UserID = ?'
-        cursor.execute(query1, (user_id,))
-        if cursor.fetchone()[0] == 0:
-            raise HTTPException(status_code=404, detail="User not found")
-
-        query2 = 'UPDATE ProfessorsUsers SET Email = ?, PasswordHash = ?, RoleID = ? WHERE UserID = ?'
-        cursor.execute(query2, (new_email, new_password_hash, new_role_id, user_id))
-        conn.commit()
+        await db.run(update_user_row, new_email, new_password_hash, new_role_id)
+        await response_cache.invalidate('users')
 
         return res(status=200, success=True, data={'message': 'User updated successfully'})
 
+    except HasherOverloaded as e:
+        logging.warning(f'Password hashing overloaded: {e}')
+        raise HTTPException(status_code=503, detail="Server busy, try again",
+                            headers={'Retry-After': PASSWORD_HASH_RETRY_AFTER})
+
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.put('/student/{student_id}')
 async def update_student(student_id: int, req: Request):
-    conn = None
-    cursor = None
-
-    try:
-        user_data = await req.json()
-        new_email = user_data.get('Email')
-        new_first_name = user_data.get('FirstName')
-        new_last_name = user_data.get('LastName')
-
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
+    def update_student_row(conn, cursor, new_email, new_first_name, new_last_name):
         query1 = 'SELECT COUNT(*) FROM Student WHERE StudentID = ?'
         cursor.execute(query1, (student_id,))
         if cursor.fetchone()[0] == 0:
@@ -814,74 +1181,109 @@ async def update_student(student_id: int, req: Request):
         cursor.execute(query2, (new_email, new_first_name, new_last_name, student_id))
         conn.commit()
 
+    try:
+        user_data = await req.json()
+        new_email = user_data.get('Email')
+        new_first_name = user_data.get('FirstName')
+        new_last_name = user_data.get('LastName')
+
+        await db.run(update_student_row, new_email, new_first_name, new_last_name)
+        # The student may be listed in any course
+        await response_cache.invalidate('students', 'course_students')
+
         return res(status=200, success=True, data={'message': 'Student updated successfully'})
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+
+# Recomputes the daily summaries of a student and their course on a date from the Assistance and Participation rows
+RECOMPUTE_DAILY_SUMMARIES_QUERY = '''
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+    DECLARE @CourseID INT = ?, @StudentID INT = ?, @SummaryDate DATE = ?;
+
+    MERGE StudentDailySummary WITH (HOLDLOCK) AS target
+    USING (
+        SELECT @CourseID AS CourseID, @StudentID AS StudentID, @SummaryDate AS SummaryDate,
+            COALESCE((SELECT SUM(AssistanceCount) FROM Assistance
+                      WHERE CourseID = @CourseID AND StudentID = @StudentID AND AssistanceDate = @SummaryDate), 0)
+                AS AssistanceCount,
+            COALESCE((SELECT SUM(ParticipationCount) FROM Participation
+                      WHERE CourseID = @CourseID AND StudentID = @StudentID AND ParticipationDate = @SummaryDate), 0)
+                AS ParticipationCount
+    ) AS source
+    ON target.CourseID = source.CourseID AND target.StudentID = source.StudentID AND target.SummaryDate = source.SummaryDate
+    WHEN MATCHED THEN
+        UPDATE SET target.AssistanceCount = source.AssistanceCount, target.ParticipationCount = source.ParticipationCount
+    WHEN NOT MATCHED THEN
+        INSERT (CourseID, StudentID, SummaryDate, AssistanceCount, ParticipationCount)
+        VALUES (source.CourseID, source.StudentID, source.SummaryDate, source.AssistanceCount, source.ParticipationCount);
+
+    MERGE CourseDailySummary WITH (HOLDLOCK) AS target
+    USING (
+        SELECT CourseID, SummaryDate, SUM(AssistanceCount) AS AssistanceCount, SUM(ParticipationCount) AS ParticipationCount
+        FROM StudentDailySummary
+        WHERE CourseID = @CourseID AND SummaryDate = @SummaryDate
+        GROUP BY CourseID, SummaryDate
+    ) AS source
+    ON target.CourseID = source.CourseID AND target.SummaryDate = source.SummaryDate
+    WHEN MATCHED THEN
+        UPDATE SET target.AssistanceCount = source.AssistanceCount, target.ParticipationCount = source.ParticipationCount
+    WHEN NOT MATCHED THEN
+        INSERT (CourseID, SummaryDate, AssistanceCount, ParticipationCount)
+        VALUES (source.CourseID, source.SummaryDate, source.AssistanceCount, source.ParticipationCount);
+'''
 
 
 @app.put('/data/student/{course_id}/{student_id}/{date}')
 async def update_student_data(course_id: int, student_id: int, date: str, req: Request):
-    conn = None
-    cursor = None
-
-    try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-        student_data = await req.json()
-        assistance_count = student_data.get('AssistanceCount')
-        participation_count = student_data.get('ParticipationCount')
-
-        query1 = 'SELECT COUNT(*) FROM Participation WHERE CourseID = ? AND StudentID = ? AND ParticipationDate = ?'
+    def update_student_counts(conn, cursor, assistance_count, participation_count):
+        query1 = 'SELECT ParticipationCount FROM Participation WHERE CourseID = ? AND StudentID = ? AND ParticipationDate = ?'
         cursor.execute(query1, (course_id, student_id, date))
-        if cursor.fetchone()[0] == 0:
+        participation_row = cursor.fetchone()
+        if participation_row is None:
             raise HTTPException(status_code=404, detail="Student not found")
 
-        query2 = 'SELECT COUNT(*) FROM Assistance WHERE CourseID = ? AND StudentID = ? AND AssistanceDate = ?'
+        query2 = 'SELECT AssistanceCount FROM Assistance WHERE CourseID = ? AND StudentID = ? AND AssistanceDate = ?'
         cursor.execute(query2, (course_id, student_id, date))
-        if cursor.fetchone()[0] == 0:
+        assistance_row = cursor.fetchone()
+        if assistance_row is None:
             raise HTTPException(status_code=404, detail="Student not found")
 
         query3 = 'UPDATE Assistance SET AssistanceCount = ? WHERE CourseID = ? AND StudentID = ? AND AssistanceDate = ?'
         cursor.execute(query3, (assistance_count, course_id, student_id, date))
-        conn.commit()
 
         query4 = 'UPDATE Participation SET ParticipationCount = ? WHERE CourseID = ? AND StudentID = ? AND ParticipationDate = ?'
         cursor.execute(query4, (participation_count, course_id, student_id, date))
+
+        # The summaries are recomputed from the updated rows in the same transaction, they can never drift apart
+        cursor.execute(RECOMPUTE_DAILY_SUMMARIES_QUERY, (course_id, student_id, date))
+        while cursor.nextset():
+            pass
         conn.commit()
 
+    try:
+        student_data = await req.json()
+        assistance_count = student_data.get('AssistanceCount')
+        participation_count = student_data.get('ParticipationCount')
+
+        await db.run(update_student_counts, assistance_count, participation_count)
+
         return res(status=200, success=True, data={'message': 'Student updated successfully'})
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.put('/assign-course/{course_id}')
 async def assign_course(course_id: int, request: Request):
-    conn = None
-    cursor = None
-
-    try:
-        student_data = await request.json()
-        student_emails = student_data.get('Email')
-
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
+    def insert_relations(conn, cursor, student_emails):
         for email in student_emails:
             query = 'SELECT StudentID FROM Student WHERE Email = ?'
             cursor.execute(query, (email,))
@@ -898,86 +1300,79 @@ async def assign_course(course_id: int, request: Request):
 
         conn.commit()
 
+    try:
+        student_data = await request.json()
+        student_emails = student_data.get('Email')
+
+        await db.run(insert_relations, student_emails)
+        await response_cache.invalidate(f'course:{course_id}:students')
+
         return {"success": True, "message": "Students updated successfully"}
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # ======================================================DELETE METHODS=================================================
 
 # Delete a course
 @app.delete('/courses/{course_id}')
 async def del_course(course_id: int):
-    conn = None
-    cursor = None
+    def delete_course_rows(conn, cursor):
+        try:
+            # Comenzar transaction
+            cursor.execute("BEGIN TRANSACTION")
 
-    try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
+            # Update de professors CourseID a NULL
+            update_professors_course_query = "UPDATE Professor SET CourseID = NULL WHERE CourseID = ?"
+            cursor.execute(update_professors_course_query, (course_id,))
 
-        # Comenzar transaction
-        cursor.execute("BEGIN TRANSACTION")
+            delete_student_participation_query = 'DELETE FROM Participation WHERE CourseID = ?'
+            cursor.execute(delete_student_participation_query, (course_id,))
+            conn.commit()
 
-        # Update de professors CourseID a NULL
-        update_professors_course_query = "UPDATE Professor SET CourseID = NULL WHERE CourseID = ?"
-        cursor.execute(update_professors_course_query, (course_id,))
+            delete_student_assistance_query = 'DELETE FROM Assistance WHERE CourseID = ?'
+            cursor.execute(delete_student_assistance_query, (course_id,))
+            conn.commit()
 
-        delete_student_participation_query = 'DELETE FROM Participation WHERE CourseID = ?'
-        cursor.execute(delete_student_participation_query, (course_id,))
-        conn.commit()
+            delete_summaries_query = 'DELETE FROM StudentDailySummary WHERE CourseID = ?; DELETE FROM CourseDailySummary WHERE CourseID = ?'
+            cursor.execute(delete_summaries_query, (course_id, course_id))
+            conn.commit()
 
-        delete_student_assistance_query = 'DELETE FROM Assistance WHERE CourseID = ?'
-        cursor.execute(delete_student_assistance_query, (course_id,))
-        conn.commit()
+            # Remover la relacion de students con curso, sin eliminar el estudiante
+            update_student_course_query = "DELETE FROM StudentCourseRelation WHERE CourseID = ?"
+            cursor.execute(update_student_course_query, (course_id,))
 
-        # Remover la relacion de students con curso, sin eliminar el estudiante
-        update_student_course_query = "DELETE FROM StudentCourseRelation WHERE CourseID = ?"
-        cursor.execute(update_student_course_query, (course_id,))
+            # Eliminar Course
+            delete_course_query = "DELETE FROM Course WHERE CourseID = ?"
+            cursor.execute(delete_course_query, (course_id,))
 
-        # Eliminar Course
-        delete_course_query = "DELETE FROM Course WHERE CourseID = ?"
-        cursor.execute(delete_course_query, (course_id,))
+            # Commit
+            cursor.execute("COMMIT TRANSACTION")
+            conn.commit()
 
-        # Commit
-        cursor.execute("COMMIT TRANSACTION")
-        conn.commit()
+        except Exception:
+            # Rollback
+            cursor.execute("ROLLBACK TRANSACTION")
+            raise
+
+    try:
+        await db.run(delete_course_rows)
+        # The owner of the course is not known here, so the course listings of every user are dropped
+        await response_cache.invalidate(f'course:{course_id}:students', f'course:{course_id}:professors', 'user_courses')
 
         return {"status": 200, "success": True, "message": "Course and related data deleted successfully"}
 
     except Exception as e:
-        # Rollback
-        if cursor:
-            cursor.execute("ROLLBACK TRANSACTION")
-
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        # Close connections
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 # Delete User
 @app.delete('/users/{user_id}')
 async def delete_user(user_id: int):
-    conn = None
-    cursor = None
-
-    try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
+    def delete_user_row(conn, cursor):
         query1 = 'SELECT COUNT(*) FROM ProfessorsUsers WHERE UserID = ?'
         cursor.execute(query1, (user_id,))
         if cursor.fetchone()[0] == 0:
@@ -987,28 +1382,20 @@ async def delete_user(user_id: int):
         cursor.execute(query2, (user_id,))
         conn.commit()
 
+    try:
+        await db.run(delete_user_row)
+        await response_cache.invalidate('users')
+
         return res(status=200, success=True, data={'message': 'User deleted successfully'})
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.delete('/student/{student_id}')
 async def delete_student(student_id: int):
-    conn = None
-    cursor = None
-
-    try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
+    def delete_student_rows(conn, cursor):
         delete_student_participation_query = 'DELETE FROM Participation WHERE StudentID = ?'
         cursor.execute(delete_student_participation_query, (student_id,))
         conn.commit()
@@ -1017,6 +1404,19 @@ async def delete_student(student_id: int):
         cursor.execute(delete_student_assistance_query, (student_id,))
         conn.commit()
 
+        # Take the student's counts out of the course totals before deleting their summaries
+        delete_student_summaries_query = '''
+            UPDATE C
+            SET C.AssistanceCount = C.AssistanceCount - S.AssistanceCount,
+                C.ParticipationCount = C.ParticipationCount - S.ParticipationCount
+            FROM CourseDailySummary C
+            JOIN StudentDailySummary S ON S.CourseID = C.CourseID AND S.SummaryDate = C.SummaryDate
+            WHERE S.StudentID = ?;
+            DELETE FROM StudentDailySummary WHERE StudentID = ?;
+        '''
+        cursor.execute(delete_student_summaries_query, (student_id, student_id))
+        conn.commit()
+
         update_student_course_query = "UPDATE StudentCourseRelation SET StudentID = NULL WHERE StudentID = ?"
         cursor.execute(update_student_course_query, (student_id,))
 
@@ -1025,24 +1425,23 @@ async def delete_student(student_id: int):
         cursor.execute(delete_student_query, (student_id,))
         conn.commit()
 
+    try:
+        await db.run(delete_student_rows)
+        await response_cache.invalidate('students', 'course_students')
+        await encoding_cache.delete(student_id)
+        face_gallery.remove(student_id)
+
         return res(status=200, success=True, data={'message': 'Student deleted successfully'})
 
     except Exception as e:
         logging.error(f'{e}')
         raise HTTPException(status_code=500, detail=f"Internal server error: {e}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
 @app.delete('/image/{student_email}')
 async def delete_student_img(student_email: str):
     try:
-        blob_client = container_client.get_blob_client(student_email)
-        blob_client.delete_blob()
+        await blob_storage.delete(student_email)
         logging.info(f"Image '{student_email}' deleted successfully.")
 
         return res(status=200, success=True, data={'message': 'Student Image deleted successfully'})
@@ -1055,13 +1454,31 @@ async def delete_student_img(student_email: str):
 # ======================================================WEBSOCKET METHODS==============================================
 
 
+# Function to get the face encoding of a student's image
+def get_face_encoding(image_data: bytes) -> np.ndarray:
+    image = Image.open(io.BytesIO(image_data))
+    decompressed_image = image.convert("RGB")
+    image_array = np.array(decompressed_image)
+    return face_rec.face_encodings(image_array)[0]
+
+
+# Function to get the stored face encodings of the students, and the images of the ones uploaded before they were stored
+def select_student_faces(_, cursor, emails: list[str]) -> dict[str, tuple]:
+    select_query = '''
+        SELECT s.Email, s.FaceEncoding, CASE WHEN s.FaceEncoding IS NULL THEN s.Image END AS Image
+        FROM Student AS s
+        JOIN OPENJSON(?) WITH (Email NVARCHAR(255) '$') AS e ON e.Email = s.Email
+        WHERE s.FaceEncoding IS NOT NULL OR s.Image IS NOT NULL
+    '''
+    cursor.execute(select_query, (json.dumps(emails),))
+    return {row.Email: (row.FaceEncoding, row.Image) for row in cursor.fetchall()}
+
+
 # Function to get the students info including id, name, email and image
-def get_students_info(message: str) -> tuple:
-    conn = None
-    cursor = None
+async def get_students_info(message: str) -> tuple:
     students_info = {}
     try:
-        received_data = json.loads(message)
+        received_data = Serializer.loads(message)
         students = received_data.get("students")
         date = received_data.get("date")
         # Save the students
@@ -1074,25 +1491,27 @@ def get_students_info(message: str) -> tuple:
                 'participation_counter': 0,
             }
 
-        # Get the students images
-        for student_id, student_data in students_info.items():
-            email = student_data['email']
+        # Encodings already computed by a previous session or a roster import
+        encodings = await encoding_cache.get_many(list(students_info))
 
-            conn = engine.raw_connection()
-            cursor = conn.cursor()
+        # Get the encodings stored with the photos of the rest of the students
+        missing = [student_id for student_id in students_info if student_id not in encodings]
+        emails = [students_info[student_id]['email'] for student_id in missing]
+        faces = await db.run(select_student_faces, emails) if emails else {}
 
-            select_query = "SELECT Image FROM Student WHERE Email = ?"
-            cursor.execute(select_query, (email,))
-            row = cursor.fetchone()
+        computed = {}
+        for student_id in missing:
+            stored_encoding, image_data = faces.get(students_info[student_id]['email'], (None, None))
+            if stored_encoding:
+                computed[student_id] = np.frombuffer(stored_encoding, dtype=np.float64)
+            elif image_data:
+                # Photos uploaded before the encodings were stored are decoded outside the event loop
+                computed[student_id] = await asyncio.to_thread(get_face_encoding, image_data)
+        await encoding_cache.set_many(computed)
+        face_gallery.add(computed)
 
-            if row and row.Image:
-                image_data = row.Image
-                image = Image.open(io.BytesIO(image_data))
-                decompressed_image = image.convert("RGB")
-                image_array = np.array(decompressed_image)
-                image_encoding = face_rec.face_encodings(image_array)[0]
-
-                students_info[student_id]['img'] = image_encoding
+        for student_id, encoding in {**encodings, **computed}.items():
+            students_info[student_id]['img'] = encoding
 
         return students_info, date
 
@@ -1100,50 +1519,160 @@ def get_students_info(message: str) -> tuple:
         logging.error(f'Error getting students info: {e}')
         return {}, ""
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 
-# Send students_info info to the db
-async def send_students_info_to_db(course_id: int, students_info: dict, date: str) -> None:
-    conn = None
-    cursor = None
-    try:
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
-
-        for student_id, student_info in students_info.items():
-            assistance_sent = student_info['assistance_sent']
-            assistance = student_info['assistance']
-            participation_counter = student_info['participation_counter']
-
-            if not assistance_sent:
-                query1 = "EXEC UpdateAssistanceCount @StudentID=?, @CourseID=?, @AssistanceCount=?, @AssistanceDate=?"
-                cursor.execute(query1, (student_id, course_id, assistance, date))
-
-            query2 = "EXEC UpdateParticipationCount @StudentID=?, @CourseID=?, @NewParticipationCount=?, @ParticipationDate=?"
-            cursor.execute(query2, (student_id, course_id, participation_counter, date))
-
-        conn.commit()
-
-    except Exception as e:
-        logging.info(f"An error occurred: {str(e)}")
-        conn.rollback()
+# Staging table for the results of a session flush, one row per student
+CREATE_SESSION_RESULTS_QUERY = '''
+    IF OBJECT_ID('tempdb..#SessionResults') IS NOT NULL DROP TABLE #SessionResults;
+    CREATE TABLE #SessionResults (
+        StudentID INT NOT NULL,
+        CourseID INT NOT NULL,
+        SessionDate DATE NOT NULL,
+        AssistanceCount INT NULL,  -- NULL when the assistance was already sent
+        ParticipationCount INT NOT NULL,
+        FlushKey NVARCHAR(200) NOT NULL
+    );
+'''
+
+INSERT_SESSION_RESULTS_QUERY = '''
+    INSERT INTO #SessionResults (StudentID, CourseID, SessionDate, AssistanceCount, ParticipationCount, FlushKey)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+# Upserts the staged results, adding the counts like UpdateAssistanceCount and UpdateParticipationCount do,
+# and adds them to the daily summaries. Flushes already applied are skipped, so retrying a batch never counts it twice
+MERGE_SESSION_RESULTS_QUERY = '''
+    SET NOCOUNT ON;
+    SET XACT_ABORT ON;
+
+    DELETE s FROM #SessionResults s JOIN SessionFlushLog l ON l.FlushKey = s.FlushKey;
+
+    MERGE Assistance WITH (HOLDLOCK) AS target
+    USING (
+        SELECT StudentID, CourseID, SessionDate, SUM(AssistanceCount) AS AssistanceCount
+        FROM #SessionResults
+        WHERE AssistanceCount IS NOT NULL
+        GROUP BY StudentID, CourseID, SessionDate
+    ) AS source
+    ON target.StudentID = source.StudentID AND target.CourseID = source.CourseID AND target.AssistanceDate = source.SessionDate
+    WHEN MATCHED THEN
+        UPDATE SET target.AssistanceCount = target.AssistanceCount + source.AssistanceCount
+    WHEN NOT MATCHED THEN
+        INSERT (StudentID, CourseID, AssistanceCount, AssistanceDate)
+        VALUES (source.StudentID, source.CourseID, source.AssistanceCount, source.SessionDate);
+
+    MERGE Participation WITH (HOLDLOCK) AS target
+    USING (
+        SELECT StudentID, CourseID, SessionDate, SUM(ParticipationCount) AS ParticipationCount
+        FROM #SessionResults
+        GROUP BY StudentID, CourseID, SessionDate
+    ) AS source
+    ON target.StudentID = source.StudentID AND target.CourseID = source.CourseID AND target.ParticipationDate = source.SessionDate
+    WHEN MATCHED THEN
+        UPDATE SET target.ParticipationCount = target.ParticipationCount + source.ParticipationCount
+    WHEN NOT MATCHED THEN
+        INSERT (StudentID, CourseID, ParticipationCount, ParticipationDate)
+        VALUES (source.StudentID, source.CourseID, source.ParticipationCount, source.SessionDate);
+
+    MERGE StudentDailySummary WITH (HOLDLOCK) AS target
+    USING (
+        SELECT StudentID, CourseID, SessionDate,
+            SUM(COALESCE(AssistanceCount, 0)) AS AssistanceCount, SUM(ParticipationCount) AS ParticipationCount
+        FROM #SessionResults
+        GROUP BY StudentID, CourseID, SessionDate
+    ) AS source
+    ON target.CourseID = source.CourseID AND target.StudentID = source.StudentID AND target.SummaryDate = source.SessionDate
+    WHEN MATCHED THEN
+        UPDATE SET target.AssistanceCount = target.AssistanceCount + source.AssistanceCount,
+                   target.ParticipationCount = target.ParticipationCount + source.ParticipationCount
+    WHEN NOT MATCHED THEN
+        INSERT (CourseID, StudentID, SummaryDate, AssistanceCount, ParticipationCount)
+        VALUES (source.CourseID, source.StudentID, source.SessionDate, source.AssistanceCount, source.ParticipationCount);
+
+    MERGE CourseDailySummary WITH (HOLDLOCK) AS target
+    USING (
+        SELECT CourseID, SessionDate,
+            SUM(COALESCE(AssistanceCount, 0)) AS AssistanceCount, SUM(ParticipationCount) AS ParticipationCount
+        FROM #SessionResults
+        GROUP BY CourseID, SessionDate
+    ) AS source
+    ON target.CourseID = source.CourseID AND target.SummaryDate = source.SessionDate
+    WHEN MATCHED THEN
+        UPDATE SET target.AssistanceCount = target.AssistanceCount + source.AssistanceCount,
+                   target.ParticipationCount = target.ParticipationCount + source.ParticipationCount
+    WHEN NOT MATCHED THEN
+        INSERT (CourseID, SummaryDate, AssistanceCount, ParticipationCount)
+        VALUES (source.CourseID, source.SessionDate, source.AssistanceCount, source.ParticipationCount);
+
+    INSERT INTO SessionFlushLog (FlushKey)
+    SELECT DISTINCT FlushKey FROM #SessionResults;
+
+    DROP TABLE #SessionResults;
+'''
+
+
+# Upsert the results of a session flush
+def upsert_session_results(conn, cursor, session_results: list[tuple]) -> None:
+    if session_results:
+        # Stage all the students with a single bulk insert and upsert them in one batch
+        cursor.execute(CREATE_SESSION_RESULTS_QUERY)
+        cursor.fast_executemany = True
+        cursor.executemany(INSERT_SESSION_RESULTS_QUERY, session_results)
+        cursor.execute(MERGE_SESSION_RESULTS_QUERY)
+        # An error in a later statement of the batch may only surface when its result set is reached
+        while cursor.nextset():
+            pass
+
+    conn.commit()
+
+
+# Write the rows of a group of flushes to the db in one transaction
+async def write_session_results(session_results: list[tuple]) -> None:
+    await db.run(upsert_session_results, session_results)
+
+
+# Coalesces the flushes of all courses into a few batched transactions
+flush_coordinator = FlushCoordinator(
+    writer=write_session_results,
+    max_batch_rows=int(os.getenv('FLUSH_MAX_BATCH_ROWS', 5000)),
+    max_concurrency=int(os.getenv('FLUSH_MAX_CONCURRENCY', 2)),
+)
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
+# Durable outbox for the session flushes, drained in the background by each server process.
+# Records arriving within the coalescing window, like the storm at the end of the hour, are written together
+outbox = Outbox(
+    writer=flush_coordinator.write,
+    batch_size=int(os.getenv('OUTBOX_BATCH_SIZE', 500)),
+    coalesce_ms=int(os.getenv('FLUSH_COALESCE_MS', 2000)),
+    max_backoff=float(os.getenv('OUTBOX_MAX_BACKOFF', 60)),
+    max_failures=int(os.getenv('OUTBOX_MAX_FAILURES', 5)),
+)
 
 
-# Function to run in parallel from the main process
-def get_students_assistance(frame_container: list[np.ndarray], student_images: dict[str, np.ndarray], namespace: str) -> None:
-    # Create a new Redis connection for this process
-    redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Send students_info info to the db through the outbox
+async def send_students_info_to_db(namespace: str, course_id: int, students_info: dict, date: str) -> None:
+    # The assistance is only sent until it has been marked as sent once
+    session_results = [
+        (student_id,
+         None if student_info['assistance_sent'] else int(student_info['assistance']),
+         student_info['participation_counter'])
+        for student_id, student_info in students_info.items()
+    ]
+
+    # Every flush gets its own key, the records are only applied once no matter how many times they are retried
+    await outbox.enqueue(f'{namespace}:{uuid4().hex}', course_id, date, session_results)
+
+
+# Function to run in a worker process from the main process
+def get_students_assistance(frame_container: list[np.ndarray], roster_path: str | None, namespace: str) -> dict:
+    # Redis client backed by this worker's own pool, reused between runs
+    redis_client = RedisPool.get_sync_client()
+    mark_present_script = redis_client.register_script(Model.MARK_PRESENT_SCRIPT)
+    record_visitors_script = redis_client.register_script(Model.RECORD_VISITORS_SCRIPT)
+    # Encodings of the course, mapped from the roster store instead of being copied into the worker
+    roster = RosterStore.open_roster(roster_path) if roster_path else None
+    # Gallery of the whole institution, reloaded when the server saves changes
+    face_gallery = FaceGallery.shared()
+    visitors = set()
 
     # Get all the students info
     students_info = {}
@@ -1172,44 +1701,77 @@ def get_students_assistance(frame_container: list[np.ndarray], student_images: d
         # Find all the faces and face encodings in the current frame of video
         face_locations = face_rec.face_locations(frame)
         face_encodings = face_rec.face_encodings(frame, face_locations)
-        # Separate the info into lists to add to face_recognition methods
-        ids = [student_id for student_id, student_info in students_info.items() if student_info['assistance'] is False]
-        faces = [student_images[student_id] for student_id in ids]
+        # Only the students that are still absent can be matched
+        absent = None
+        if roster is not None:
+            absent = np.array([students_info.get(student_id, {}).get('assistance') is False for student_id in roster.ids])
         # Iterate over the face encodings to find a match
         for face_encoding in face_encodings:
-            # See if the face is a match for the known face(s)
-            matches = face_rec.compare_faces(faces, face_encoding)
-            try:
-                # Get the index of the match
-                index = matches.index(True)
-                match_student_id = ids[index]
-                # Change student's assistance to true in the Redis DB
-                redis_client.hset(f'{namespace}:student:{match_student_id}', 'assistance', 'true')
-                students_info[match_student_id]['assistance'] = True  # Mark as present locally
-
-            except ValueError:
-                # Silently ignore if `True` is not found in the list
-                pass
-
-    redis_client.close()  # Close the client connection
-    redis_client.connection_pool.disconnect()  # Disconnect the connection pool
+            # See if the face is a match for the known face(s), the closest one in the course wins
+            if absent is not None and absent.any():
+                distances = np.where(absent, roster.distances(face_encoding), np.inf)
+                index = int(np.argmin(distances))
+                if distances[index] <= FaceGallery.TOLERANCE:
+                    match_student_id = roster.ids[index]
+                    # Change student's assistance to true in the Redis DB, unless the session already ended
+                    mark_present_script(keys=[f'{namespace}:student:{match_student_id}'])
+                    students_info[match_student_id]['assistance'] = True  # Mark as present locally
+                    absent[index] = False
+                    continue
+
+            # Not in the course, it may be a student from another section
+            match = face_gallery.nearest(face_encoding)
+            if match is not None and str(match[0]) not in students_info:
+                visitors.add(str(match[0]))
+
+    # Record the visitors with no participations yet, unless the session already ended
+    if visitors:
+        record_visitors_script(keys=[f'{namespace}:students', f'{namespace}:visitors'], args=list(visitors))
+
+    # Send the pool metrics back to the main process
+    return RedisPool.worker_metrics()
+
+
+def record_assistance_result(future: asyncio.Future) -> None:
+    if future.cancelled():
+        return
+    if future.exception():
+        logging.error(f'Error getting students assistance: {future.exception()}')
+    else:
+        RedisPool.record_worker_metrics(future.result())
 
 
 @app.websocket("/ws/{course_id}/{session_count}")
-async def websocket_endpoint(course_id: int, session_count: int, websocket: WebSocket):
+async def websocket_endpoint(course_id: int, session_count: int, websocket: WebSocket, takeover: bool = False):
     await websocket.accept()
     logging.info(f'Comenzando conexión websocket en curso {course_id}, sesión {session_count}')
+
+    # Only one worker processes a session, a reconnect that lands on another one is told where the session is
+    try:
+        lease = await session_registry.acquire(f'course:{course_id}:session:{session_count}', takeover)
+    except SessionOwned as e:
+        await websocket.send_text(Serializer.dumps({'redirect': e.owner}).decode('utf-8'))
+        await websocket.close(code=SESSION_MOVED_CODE)
+        return
+
     # Initialize Model class
-    model = Model(course_id=course_id, session_count=session_count)
-    # Process initialization
-    process = None
+    model = Model(course_id=course_id, session_count=session_count, face_gallery=face_gallery,
+                  inference=inference_service)
+    model.lease = lease
+    # Assistance checker run
+    assistance_future = None
+    # Whether the session ends with this connection, otherwise its data is kept for the next owner
+    ending = True
 
     try:
         # Get course info
         message = await websocket.receive_text()
-        data, model.date = get_students_info(message)
-        # Save students info to model and Redis DB
-        model.save_data(data)
+        data, date = await get_students_info(message)
+        await model.save_date(date)
+        # Save students info to model and Redis DB, a resumed session keeps what was already counted
+        await model.save_data(data, resume=lease.resumed)
+        if lease.resumed:
+            logging.info(f'Resuming session {model.namespace}')
 
         if len(data) == 0:
             raise Exception('Error: No students info found')
@@ -1220,6 +1782,13 @@ async def websocket_endpoint(course_id: int, session_count: int, websocket: WebS
         last_db_action_time = time.time()
 
         while True:
+            # Another worker took the session over, it owns the namespace from now on
+            if not lease.valid():
+                logging.info(f'Session {model.namespace} moved to another worker')
+                ending = False
+                await websocket.close(code=SESSION_MOVED_CODE)
+                break
+
             # Get current time
             current_time = time.time()
             # Receive image blob from WebSocket
@@ -1232,14 +1801,11 @@ async def websocket_endpoint(course_id: int, session_count: int, websocket: WebS
                 # Increase frame counter
                 model.frame_count += 1
                 # Get all the poses and bounding box in the current frame
-                results = model.yolo_model(frame, verbose=False)[0]
-                # We only want to get the arms and shoulders of the pose
-                model.model_detections['poses'] = results.keypoints.data[:, 0:11, :]
-                model.model_detections['boxes'] = results.boxes.data
+                await model.detect(frame)
 
                 # Check if all students have marked assistance
                 if not model.finished_assistance:
-                    model.finished_assistance = model.check_assistance()
+                    model.finished_assistance = await model.check_assistance()
 
                 # Assistance checker
                 if (current_time - last_assistance_action_time >= ASSISTANCE_TIME_LIMIT and
@@ -1250,12 +1816,16 @@ async def websocket_endpoint(course_id: int, session_count: int, websocket: WebS
 
                     # Extract necessary data
                     frame_container = model.frame_container.copy()
-                    student_images = model.student_images.copy()
+                    roster_path = model.roster.path if model.roster is not None else None
                     namespace = model.namespace
+                    if roster_path is not None:
+                        # Still in use, the worker opens it by path
+                        RosterStore.touch(roster_path)
 
-                    # Run in a separate process
-                    process = Process(target=get_students_assistance, args=(frame_container, student_images, namespace))
-                    process.start()
+                    # Run in a worker process, only the path of the roster is sent, the worker maps it
+                    assistance_future = asyncio.get_running_loop().run_in_executor(
+                        get_assistance_executor(), get_students_assistance, frame_container, roster_path, namespace)
+                    assistance_future.add_done_callback(record_assistance_result)
 
                 elif not model.finished_assistance and len(model.frame_container) < 10:
                     # We add a new frame to the container
@@ -1264,28 +1834,36 @@ async def websocket_endpoint(course_id: int, session_count: int, websocket: WebS
                 # Send students info to DB
                 if current_time - last_db_action_time >= DB_TIME_LIMIT:
                     last_db_action_time = current_time
-                    # Get the students info to send
-                    students_info = model.get_all_students_info()
-                    # Run concurrently
-                    asyncio.create_task(send_students_info_to_db(course_id, students_info, model.date))
-                    for student_id, student_info in students_info.items():
-                        # Reset participation counter
-                        model.update_field(student_id, 'participation_counter', 0)
-                        # Mark all assistance's as done
-                        if student_info['assistance']:
-                            model.update_field(student_id, 'assistance_sent', True)
+                    # Get the students info to send, resetting participation counters and marking assistance's as done
+                    students_info = await model.snapshot_and_reset()
+                    if students_info is None:
+                        # Taken over before the heartbeat noticed, the new owner sends the counts
+                        lease.lost = True
+                        continue
+                    # Written to the outbox, the database is updated in the background
+                    await send_students_info_to_db(model.namespace, course_id, students_info, model.date)
 
                 # Iterate over poses
-                model.iterate_over_detections(frame=frame)
+                await model.iterate_over_detections(frame=frame)
 
                 # Detections cleanup process
                 model.cleanup()
 
-    except WebSocketDisconnect:
-        logging.info('WebSocket disconnected')
-        # Send last data of students
-        students = model.get_all_students_info()
-        await send_students_info_to_db(course_id, students, model.date)
+            if SESSION_FRAME_ACK:
+                await websocket.send_text('{"ack":true}')
+
+    except WebSocketDisconnect as e:
+        logging.info(f'WebSocket disconnected ({e.code})')
+        # Dropped connection or worker shutting down, the data is kept for the worker that resumes the session
+        ending = e.code in SESSION_END_CODES
+        # What was counted is sent and the counters reset, so the next owner does not send it again. Checked against
+        # the owner in Redis in the same call, a lease renewed before a takeover still looks valid here
+        students = await model.snapshot_and_reset() if lease.valid() else None
+        if students is None:
+            # The new owner sends the data from now on
+            ending = False
+        else:
+            await send_students_info_to_db(model.namespace, course_id, students, model.date)
 
     except Exception as e:
         # Close the websocket connection
@@ -1293,58 +1871,66 @@ async def websocket_endpoint(course_id: int, session_count: int, websocket: WebS
         logging.error(f'Error: {e}')
 
     finally:
-        # Check if the assistance process is still running and terminate if necessary
-        if process and process.is_alive():
-            process.terminate()
-            process.join()  # Wait for the process to terminate
-
-        # Delete Redis session namespace
-        model.delete_all_data()
+        # Cancel the assistance run if it has not started yet, a running one skips the ended session
+        if assistance_future and not assistance_future.done():
+            assistance_future.cancel()
 
-        # Terminate Redis connection
-        model.redis_client.close()  # Close the client connection
-        model.redis_client.connection_pool.disconnect()  # Disconnect the connection pool
+        if ending and lease.valid():
+            # Delete Redis session namespace, only if no other worker took the session over since the last flush
+            await model.delete_all_data()
+        # Handed off sessions can be resumed right away by any worker
+        await session_registry.release(lease, handoff=not ending)
 
 
 # ======================================================IMAGE METHODS==================================================
 
 @app.post("/upload_student_image/{email}")
 async def upload_student_image(email: str, image: UploadFile = File(...)):
-    conn = None
-    cursor = None
-    try:
-        # Create a cursor to perform database operations
-        conn = engine.raw_connection()
-        cursor = conn.cursor()
+    def select_student(_, cursor):
+        query = 'SELECT StudentID, ImageHash FROM Student WHERE Email = ?'
+        cursor.execute(query, (email,))
+        return cursor.fetchone()
 
+    def update_student_image(conn, cursor, student_id, image_data, encoding, image_hash):
+        # Save the normalized image, its face encoding and the hash of the upload for a specific student
+        update_query = "UPDATE Student SET Image = ?, FaceEncoding = ?, ImageHash = ? WHERE StudentID = ?"
+        cursor.execute(update_query, (image_data, encoding, image_hash, student_id))
+        conn.commit()
+
+    try:
         # Read the uploaded image file
         contents = await image.read()
 
-        query = 'SELECT StudentID FROM Student WHERE Email = ?'
-        cursor.execute(query, (email,))
-        student_record = cursor.fetchone()
-
+        student_record = await db.run(select_student)
         if not student_record:
             raise HTTPException(status_code=404, detail=f"Student with email {email} not found")
+        student_id, stored_hash = student_record
 
-        student_id = student_record[0]
+        # The same photo was already normalized and stored
+        if stored_hash == PhotoIngest.content_hash(contents):
+            return {"message": "Image uploaded and associated with the student successfully"}
 
-        # Save image data to the database for a specific student
-        update_query = "UPDATE Student SET Image = ? WHERE StudentID = ?"
-        cursor.execute(update_query, (contents, student_id))
-        conn.commit()
+        # Orientation, face crop, resize and encoding run in the photo workers
+        try:
+            loop = asyncio.get_running_loop()
+            image_data, encoding, image_hash = await loop.run_in_executor(
+                get_photo_executor(), PhotoIngest.normalize_photo, contents
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid image: {e}")
+
+        await db.run(update_student_image, student_id, image_data, encoding.tobytes(), image_hash)
+        await encoding_cache.set_many({student_id: encoding})
+        face_gallery.add({student_id: encoding})
 
         return {"message": "Image uploaded and associated with the student successfully"}
 
+    except HTTPException:
+        raise
+
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error uploading image: {str(e)}")
 
-    finally:
-        if cursor:
-            cursor.close()
-        if conn:
-            conn.close()
-
 if __name__ == "__main__":
     uvicorn.run("server:app", host="0.0.0.0", port=80, reload=True)
 
@@ -0,0 +1,5 @@
+-- Idempotency keys of the session flushes already applied to Assistance and Participation
+CREATE TABLE SessionFlushLog (
+    FlushKey NVARCHAR(200) NOT NULL PRIMARY KEY,
+    AppliedAt DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+);
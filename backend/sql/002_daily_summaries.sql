@@ -0,0 +1,23 @@
+-- Daily rollups of Assistance and Participation, kept up to date by the session flushes and the manual edits.
+-- Fill them with the history already stored by running `python rebuild_summaries.py`
+
+-- One row per student, course and date with both counts
+CREATE TABLE StudentDailySummary (
+    CourseID INT NOT NULL,
+    StudentID INT NOT NULL,
+    SummaryDate DATE NOT NULL,
+    AssistanceCount INT NOT NULL DEFAULT 0,
+    ParticipationCount INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (CourseID, SummaryDate, StudentID)
+);
+
+CREATE INDEX IX_StudentDailySummary_StudentID ON StudentDailySummary (StudentID);
+
+-- One row per course and date with the totals of all its students
+CREATE TABLE CourseDailySummary (
+    CourseID INT NOT NULL,
+    SummaryDate DATE NOT NULL,
+    AssistanceCount INT NOT NULL DEFAULT 0,
+    ParticipationCount INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (CourseID, SummaryDate)
+);
@@ -0,0 +1,4 @@
+-- Face encoding computed when the photo is uploaded (128 float64 values) and the hash of the uploaded photo
+ALTER TABLE Student ADD
+    FaceEncoding VARBINARY(1024) NULL,
+    ImageHash CHAR(64) NULL;